@@ -0,0 +1,223 @@
+import logging
+import os
+import re
+import time
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import psycopg
+from psycopg import sql
+
+# The concept_ancestor table as a compressed sparse row (CSR) matrix: row i lists the indices of the ancestors of
+# concept_ids[i] in indices[indptr[i]:indptr[i + 1]]. Rolling up record counts to ancestors is then a sparse
+# matrix-vector product, computed with np.bincount.
+
+# A row of a binary COPY of two INT columns: the field count, and the length and value of each field:
+_ANCESTOR_ROW_TYPE = np.dtype([("field_count", ">i2"),
+                               ("descendant_length", ">i4"),
+                               ("descendant_concept_id", ">i4"),
+                               ("ancestor_length", ">i4"),
+                               ("ancestor_concept_id", ">i4")])
+_COPY_HEADER_SIZE = 19
+
+
+def get_ancestor_version(conn: psycopg.Connection, schema: str) -> str:
+    """
+    Identifies the version of the concept_ancestor table by the vocabulary version in the vocabulary table, which is a
+    single row lookup. Vocabularies without that table (such as synthetic vocabularies) are identified by the number
+    of rows and the highest concept IDs of the concept_ancestor table instead, which takes a full scan.
+    """
+    if conn.execute("SELECT to_regclass(%s)", (f'"{schema}".vocabulary',)).fetchone()[0] is not None:
+        version = conn.execute(sql.SQL("SELECT vocabulary_version FROM {schema}.vocabulary "
+                                       "WHERE vocabulary_id = 'None'").format(schema=sql.Identifier(schema))).fetchone()
+        if version is not None:
+            return version[0]
+    statement = sql.SQL("SELECT COUNT(*), MAX(descendant_concept_id), MAX(ancestor_concept_id) "
+                        "FROM {schema}.concept_ancestor").format(schema=sql.Identifier(schema))
+    count, max_descendant_id, max_ancestor_id = conn.execute(statement).fetchone()
+    return f"{count}|{max_descendant_id}|{max_ancestor_id}"
+
+
+def download_ancestors(conn: psycopg.Connection, schema: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Downloads the concept_ancestor table using a binary COPY, decoding the rows with NumPy as they arrive.
+
+    Returns:
+        A tuple of the descendant and ancestor concept IDs.
+    """
+    statement = sql.SQL("COPY (SELECT descendant_concept_id, ancestor_concept_id FROM {schema}.concept_ancestor) "
+                        "TO STDOUT (FORMAT BINARY)").format(schema=sql.Identifier(schema))
+    descendants = []
+    ancestors = []
+    buffer = b""
+    header = True
+    with conn.cursor().copy(statement) as copy:
+        for data in copy:
+            buffer += bytes(data)
+            if header:
+                if len(buffer) < _COPY_HEADER_SIZE:
+                    continue
+                buffer = buffer[_COPY_HEADER_SIZE:]
+                header = False
+            # Whatever is left after the complete rows is either a partial row, or the 2-byte trailer:
+            count = len(buffer) // _ANCESTOR_ROW_TYPE.itemsize
+            if count == 0:
+                continue
+            rows = np.frombuffer(buffer, dtype=_ANCESTOR_ROW_TYPE, count=count)
+            descendants.append(rows["descendant_concept_id"].astype(np.int32))
+            ancestors.append(rows["ancestor_concept_id"].astype(np.int32))
+            buffer = buffer[count * _ANCESTOR_ROW_TYPE.itemsize:]
+    if len(descendants) == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+    return np.concatenate(descendants), np.concatenate(ancestors)
+
+
+class AncestorMatrix:
+    """
+    A local copy of the concept_ancestor table, stored as a CSR matrix from descendants to ancestors in a NumPy .npz
+    file, so record counts can be rolled up without querying the vocabulary database.
+    """
+
+    def __init__(self,
+                 concept_ids: np.ndarray,
+                 indptr: np.ndarray,
+                 indices: np.ndarray,
+                 schema: str = "",
+                 version: str = ""):
+        self.concept_ids = concept_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.schema = schema
+        self.version = version
+
+    @classmethod
+    def from_pairs(cls,
+                   descendants: np.ndarray,
+                   ancestors: np.ndarray,
+                   schema: str = "",
+                   version: str = "") -> "AncestorMatrix":
+        concept_ids = np.unique(np.concatenate([descendants, ancestors]))
+        descendant_indices = np.searchsorted(concept_ids, descendants)
+        order = np.argsort(descendant_indices, kind="stable")
+        indices = np.searchsorted(concept_ids, ancestors[order]).astype(np.int32)
+        indptr = np.zeros(len(concept_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(descendant_indices, minlength=len(concept_ids)), out=indptr[1:])
+        return cls(concept_ids, indptr, indices, schema, version)
+
+    @classmethod
+    def load(cls, path: str) -> "AncestorMatrix":
+        with np.load(path) as data:
+            # Caches created by older versions have no version, so are never current:
+            version = str(data["version"]) if "version" in data else ""
+            return cls(data["concept_ids"], data["indptr"], data["indices"], str(data["schema"]), version)
+
+    def save(self, path: str) -> None:
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # np.savez appends .npz to names without it, so write to a temporary name that already has it:
+        temp_path = path + ".tmp.npz"
+        np.savez(temp_path,
+                 concept_ids=self.concept_ids,
+                 indptr=self.indptr,
+                 indices=self.indices,
+                 schema=np.array(self.schema),
+                 version=np.array(self.version))
+        os.replace(temp_path, path)
+
+    def pair_count(self) -> int:
+        return len(self.indices)
+
+    def roll_up(self, concept_ids: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sums the counts of each concept into all its ancestors (including the concept itself, which is its own
+        ancestor in concept_ancestor). Concepts that are not in the matrix are ignored, like the join with
+        concept_ancestor does.
+
+        Args:
+            concept_ids: The concept IDs with counts.
+            counts: A (concepts x count columns) matrix.
+
+        Returns:
+            A tuple of the ancestor concept IDs that have at least one descendant with a count, and their summed
+            (concepts x count columns) counts.
+        """
+        positions = np.minimum(np.searchsorted(self.concept_ids, concept_ids), len(self.concept_ids) - 1)
+        found = self.concept_ids[positions] == concept_ids
+        if not found.all():
+            logging.info(f"{int((~found).sum())} concepts with counts are not in the concept_ancestor table")
+        rows = positions[found]
+        counts = counts[found]
+        # Gather the ancestors of all rows with counts at once:
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(int(lengths.sum()))
+        ancestors = self.indices[offsets]
+        size = len(self.concept_ids)
+        reached = np.bincount(ancestors, minlength=size) > 0
+        totals = np.column_stack([np.bincount(ancestors, weights=np.repeat(counts[:, j], lengths), minlength=size)
+                                  for j in range(counts.shape[1])])
+        return self.concept_ids[reached], totals[reached]
+
+
+def get_ancestor_matrix(cache_path: str, schema: str, refresh: bool = False) -> AncestorMatrix:
+    """
+    Loads the ancestor matrix from the cache, or downloads it from the vocabulary database if the cache does not exist,
+    was created from another schema or another version of the concept_ancestor table, or refresh is true.
+    """
+    with psycopg.connect(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", "")) as conn:
+        version = get_ancestor_version(conn, schema)
+        if os.path.exists(cache_path) and not refresh:
+            matrix = AncestorMatrix.load(cache_path)
+            if matrix.schema == schema and matrix.version == version:
+                logging.info(f"Loaded {matrix.pair_count()} ancestor pairs from {cache_path}")
+                return matrix
+            if matrix.schema != schema:
+                logging.info(f"Ancestor cache was created from schema '{matrix.schema}', downloading from '{schema}'")
+            else:
+                logging.info(f"The concept_ancestor table has changed since the ancestor cache was created, "
+                             f"downloading it again")
+        start_time = time.time()
+        descendants, ancestors = download_ancestors(conn, schema)
+    matrix = AncestorMatrix.from_pairs(descendants, ancestors, schema, version)
+    matrix.save(cache_path)
+    logging.info(f"Downloaded {matrix.pair_count()} ancestor pairs in {time.time() - start_time:.0f} seconds, cached "
+                 f"in {cache_path}")
+    return matrix
+
+
+def count_column_names(file_names: List[str]) -> List[str]:
+    """
+    Names the count column of each count file. A single file gives the record_count column. With several files, each
+    gets a column named after the file, and record_count holds their sum.
+    """
+    if len(file_names) == 1:
+        return ["record_count"]
+    names = []
+    for file_name in file_names:
+        label = re.sub(r"[^a-z0-9]+", "_", os.path.splitext(os.path.basename(file_name))[0].lower()).strip("_")
+        names.append(f"record_count_{label}")
+    if len(set(names)) != len(names):
+        raise ValueError(f"Count files must have different names, got {file_names}")
+    return names
+
+
+def read_count_files(file_names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads one or more CSV files with concept_id and record_count columns.
+
+    Returns:
+        A tuple of the concept IDs in any of the files, and a (concepts x files) matrix of their counts, with 0 for
+        concepts missing from a file.
+    """
+    files = []
+    for file_name in file_names:
+        data = pd.read_csv(file_name, encoding="utf-8-sig", usecols=["concept_id", "record_count"])
+        files.append((data["concept_id"].to_numpy(dtype=np.int64), data["record_count"].to_numpy(dtype=np.float64)))
+        logging.info(f"Read {len(data)} concept counts from {file_name}")
+    concept_ids = np.unique(np.concatenate([ids for ids, _ in files]))
+    counts = np.zeros((len(concept_ids), len(files)), dtype=np.float64)
+    for j, (ids, values) in enumerate(files):
+        np.add.at(counts[:, j], np.searchsorted(concept_ids, ids), values)
+    return concept_ids, counts
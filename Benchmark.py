@@ -0,0 +1,303 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+import psycopg
+import yaml
+from dotenv import load_dotenv
+from psycopg import sql
+
+from EmbeddingManifest import EmbeddingManifest
+from Logging import open_log
+from MockEmbeddingServer import MockEmbeddingServer
+from SyntheticVocabulary import generate_vocabulary, write_record_counts
+from UploadEmbeddingVectors import get_concept_term_table
+
+load_dotenv()
+
+_SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+_VECTOR_TABLE = "concept_vector"
+
+
+def _run_stage(script: str, settings_path: str, work_folder: str, env: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Runs one pipeline script in its own process, measuring its wall time and peak resident set size.
+    """
+    start_time = time.time()
+    with open(os.path.join(work_folder, "log", f"output{os.path.splitext(script)[0]}.txt"), "w") as output:
+        process = subprocess.Popen([sys.executable, os.path.join(_SCRIPT_FOLDER, script), settings_path],
+                                   cwd=work_folder,
+                                   env=env,
+                                   stdout=output,
+                                   stderr=subprocess.STDOUT)
+        if hasattr(os, "wait4"):
+            # wait4 returns the resource usage of this child only (ru_maxrss is in KB on Linux):
+            _, status, usage = os.wait4(process.pid, 0)
+            return_code = os.waitstatus_to_exitcode(status)
+            process.returncode = return_code
+            peak_rss_mb = usage.ru_maxrss / 1024
+        else:
+            return_code = process.wait()
+            peak_rss_mb = None
+    if return_code != 0:
+        raise Exception(f"{script} failed with exit code {return_code}, see the output in the log folder")
+    return {"wall_seconds": round(time.time() - start_time, 3),
+            "peak_rss_mb": peak_rss_mb,
+            "metrics": _read_final_metrics(work_folder, os.path.splitext(script)[0])}
+
+
+def _read_final_metrics(work_folder: str, stage: str) -> Optional[Dict[str, Any]]:
+    """
+    Reads the last metrics snapshot a stage wrote to its log folder, if any.
+    """
+    path = os.path.join(work_folder, "log", f"metrics{stage}.jsonl")
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        lines = file.read().splitlines()
+    if not lines:
+        return None
+    snapshot = json.loads(lines[-1])
+    return {"counters": snapshot["counters"], "histograms": snapshot["histograms"]}
+
+
+def _count_table(connection_string: str, schema: str, table: str) -> int:
+    with psycopg.connect(connection_string) as conn:
+        return conn.execute(sql.SQL("SELECT COUNT(*) FROM {schema}.{table}").format(
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(table))).fetchone()[0]
+
+
+def _count_terms(terms_db_path: str) -> int:
+    with sqlite3.connect(terms_db_path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM terms").fetchone()[0]
+
+
+def _create_settings(args: argparse.Namespace, work_folder: str) -> str:
+    """
+    Creates the settings for the benchmark from the default Settings.yaml, with all paths in the work folder.
+    """
+    with open(os.path.join(_SCRIPT_FOLDER, "Settings.yaml")) as file:
+        config = yaml.safe_load(file)
+    config["system"].update({
+        "log_folder": os.path.join(work_folder, "log"),
+        "terms_db_path": os.path.join(work_folder, "Vocab.sqlite"),
+        "fast_extraction": True,
+        "lexical_index": None,
+        "embeddings_folder": os.path.join(work_folder, "Embeddings"),
+        "delta_embeddings_folder": os.path.join(work_folder, "DeltaEmbeddings"),
+        "batch_jobs_folder": None,
+        "local_index_folder": os.path.join(work_folder, "LocalIndex"),
+        "embedding_batch_size": args.embedding_batch_size,
+        "embedding_concurrency": args.embedding_concurrency,
+        "requests_per_minute": args.requests_per_minute,
+        "tokens_per_minute": args.tokens_per_minute,
+        "embedding_stats_path": None,
+        "embedding_batch_mode": False,
+        "embedding_cache_path": None,
+        "parquet_vector_dtype": "float32",
+        "pipeline_persist": False,
+    })
+    config["terms"].update({
+        "domain_ids": ["Condition", "Observation", "Measurement", "Procedure", "Drug"],
+        "restrict_to_used_concepts": False,
+        "incremental_refresh": False,
+        "deduplicate_terms": args.deduplicate_terms,
+    })
+    config["database_details"].update({
+        "store_type": "pgvector",
+        "record_count_files": [os.path.join(work_folder, "ConceptRecordCounts.csv")],
+        "record_counts_path": None,
+        "ancestor_cache_path": None,
+        "upload_workers": args.upload_workers,
+        # Parallel upload workers require a staging table:
+        "use_staging_table": True,
+        "partition_by_domain": False,
+        "create_indexes": args.create_indexes,
+        "maintenance_work_mem": None,
+        "max_parallel_maintenance_workers": None,
+    })
+    settings_path = os.path.join(work_folder, "Settings.yaml")
+    with open(settings_path, "w") as file:
+        yaml.safe_dump(config, file)
+    return settings_path
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    work_folder = os.path.abspath(args.work_folder)
+    os.makedirs(os.path.join(work_folder, "log"), exist_ok=True)
+    connection_string = args.connection_string.replace("+psycopg", "")
+    stages = {}
+
+    if not args.skip_generate:
+        start_time = time.time()
+        counts = generate_vocabulary(connection_string, args.schema, args.concepts, seed=args.seed)
+        stages["GenerateVocabulary"] = {"wall_seconds": round(time.time() - start_time, 3),
+                                        "peak_rss_mb": None,
+                                        "rows": sum(counts.values())}
+    write_record_counts(os.path.join(work_folder, "ConceptRecordCounts.csv"), args.concepts, seed=args.seed)
+
+    # Remove the outputs of an earlier run:
+    for path in ["Vocab.sqlite", "Embeddings"] + [os.path.join("log", name)
+                                                   for name in os.listdir(os.path.join(work_folder, "log"))
+                                                   if name.startswith("metrics")]:
+        path = os.path.join(work_folder, path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+    with psycopg.connect(connection_string) as conn:
+        for table in ["concept_record_count", _VECTOR_TABLE, get_concept_term_table(_VECTOR_TABLE),
+                      f"{_VECTOR_TABLE}_staging", get_concept_term_table(f"{_VECTOR_TABLE}_staging")]:
+            conn.execute(sql.SQL("DROP TABLE IF EXISTS {schema}.{table}").format(
+                schema=sql.Identifier(args.schema),
+                table=sql.Identifier(table)))
+
+    server = MockEmbeddingServer(dimensions=args.dimensions,
+                                 latency=args.latency,
+                                 requests_per_minute=args.requests_per_minute,
+                                 tokens_per_minute=args.tokens_per_minute).start()
+    env = dict(os.environ)
+    env.update({
+        "VOCAB_CONNECTION_STRING": args.connection_string,
+        "VOCAB_SCHEMA": args.schema,
+        "VOCAB_VECTOR_TABLE": _VECTOR_TABLE,
+        "GENAI_PROVIDER": "lm-studio",
+        "LM_STUDIO_ENDPOINT": server.url,
+        "EMBEDDING_MODEL": "mock",
+    })
+    settings_path = _create_settings(args, work_folder)
+    try:
+        stage_counts = [
+            ("CreateConceptRecordCountTable.py",
+             lambda: _count_table(connection_string, args.schema, "concept_record_count")),
+            ("DownloadTerms.py", lambda: _count_terms(os.path.join(work_folder, "Vocab.sqlite"))),
+            ("CreateEmbeddings.py", lambda: EmbeddingManifest(os.path.join(work_folder, "Embeddings")).row_count()),
+            ("UploadEmbeddingVectors.py", lambda: _count_table(connection_string, args.schema, _VECTOR_TABLE)),
+        ]
+        for script, count in stage_counts:
+            logging.info(f"Running {script}")
+            stage = _run_stage(script, settings_path, work_folder, env)
+            stage["rows"] = count()
+            stages[os.path.splitext(script)[0]] = stage
+    finally:
+        server.stop()
+        logging.info(f"Mock embedding server received {server.request_count} requests, of which "
+                     f"{server.rate_limited_count} were rate limited")
+
+    for stage in stages.values():
+        stage["rows_per_second"] = round(stage["rows"] / stage["wall_seconds"], 1) if stage["wall_seconds"] else None
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "parameters": {key: value for key, value in vars(args).items()
+                       if key not in ["connection_string", "baseline", "output", "compare"]},
+        "stages": stages,
+    }
+
+
+def compare_results(baseline: Dict[str, Any], results: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Compares the throughput and memory use of each stage with a baseline, logging the differences.
+
+    Returns:
+        A list of regressions: stages that are slower or use more memory than the baseline, beyond the tolerance.
+    """
+    if baseline.get("parameters", {}).get("concepts") != results.get("parameters", {}).get("concepts"):
+        logging.warning("The baseline was created with a different number of concepts")
+    regressions = []
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        old = baseline["stages"][name]
+        if old.get("rows_per_second") and stage.get("rows_per_second"):
+            change = stage["rows_per_second"] / old["rows_per_second"] - 1
+            message = (f"{name}: {stage['rows_per_second']} rows/sec vs {old['rows_per_second']} in baseline "
+                       f"({100 * change:+.1f}%)")
+            logging.info(message)
+            if change < -tolerance:
+                regressions.append(message)
+        if old.get("peak_rss_mb") and stage.get("peak_rss_mb"):
+            change = stage["peak_rss_mb"] / old["peak_rss_mb"] - 1
+            message = (f"{name}: peak RSS {stage['peak_rss_mb']:.0f} MB vs {old['peak_rss_mb']:.0f} MB in baseline "
+                       f"({100 * change:+.1f}%)")
+            logging.info(message)
+            if change > tolerance:
+                regressions.append(message)
+    return regressions
+
+
+def _load_json(path: str) -> Dict[str, Any]:
+    with open(path) as file:
+        return json.load(file)
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on a synthetic vocabulary, using a mock "
+                                                 "embedding server and a local Postgres database.")
+    parser.add_argument("--work-folder", default="benchmark")
+    parser.add_argument("--connection-string", default=os.getenv("VOCAB_CONNECTION_STRING"),
+                        help="SqlAlchemy connection string of the Postgres database. Defaults to "
+                             "VOCAB_CONNECTION_STRING.")
+    parser.add_argument("--schema", default="vocab_benchmark", help="Schema to create the synthetic vocabulary in.")
+    parser.add_argument("--concepts", type=int, default=10000, help="Number of standard concepts to generate.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-generate", action="store_true",
+                        help="Reuse the synthetic vocabulary of an earlier run.")
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds the mock embedding server waits before answering a request.")
+    parser.add_argument("--requests-per-minute", type=int, default=None)
+    parser.add_argument("--tokens-per-minute", type=int, default=None)
+    parser.add_argument("--embedding-batch-size", type=int, default=100)
+    parser.add_argument("--embedding-concurrency", type=int, default=4)
+    parser.add_argument("--upload-workers", type=int, default=2)
+    parser.add_argument("--create-indexes", action="store_true")
+    parser.add_argument("--deduplicate-terms", action="store_true",
+                        help="Embed and store one vector per unique text.")
+    parser.add_argument("--output", default=None,
+                        help="File to write the results to. Defaults to benchmark_<timestamp>.json in the work "
+                             "folder.")
+    parser.add_argument("--baseline", default=None, help="Results of an earlier run to compare against.")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"), default=None,
+                        help="Only compare two earlier results.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Fraction of throughput loss or memory growth allowed before reporting a regression.")
+    args = parser.parse_args(args)
+
+    os.makedirs(os.path.join(args.work_folder, "log"), exist_ok=True)
+    open_log(os.path.join(args.work_folder, "log", "logBenchmark.txt"))
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    if args.compare:
+        regressions = compare_results(_load_json(args.compare[0]), _load_json(args.compare[1]), args.tolerance)
+    else:
+        if not args.connection_string:
+            raise Exception("Must provide a connection string, or set VOCAB_CONNECTION_STRING")
+        results = run_benchmark(args)
+        for name, stage in results["stages"].items():
+            rss = "n/a" if stage["peak_rss_mb"] is None else f"{stage['peak_rss_mb']:.0f} MB"
+            logging.info(f"{name}: {stage['rows']} rows in {stage['wall_seconds']:.1f} s "
+                         f"({stage['rows_per_second']} rows/sec), peak RSS {rss}")
+        output = args.output or os.path.join(args.work_folder,
+                                             f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+        logging.info(f"Results written to {output}")
+        regressions = []
+        if args.baseline:
+            regressions = compare_results(_load_json(args.baseline), results, args.tolerance)
+    if regressions:
+        logging.warning("Regressions found:\n" + "\n".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import io
+import os
+import sys
+import time
+from typing import List
+
+import psycopg
+import yaml
+from dotenv import load_dotenv
+from pgvector.psycopg import register_vector
+from psycopg.copy import Copy, FileWriter
+
+from BinaryCopy import COPY_SIGNATURE, COPY_TRAILER
+from EmbeddingFiles import list_embedding_files, read_embedding_batches
+from Settings import Settings
+from UploadEmbeddingVectors import write_vectors
+
+load_dotenv()
+
+# Compares the row-by-row psycopg COPY encoding with the vectorized encoder on the vectors in the embeddings
+# folder. Both encode to memory only, so nothing is written to the database, but a connection is needed for psycopg
+# to look up the pgvector types.
+
+
+def encode_row_by_row(conn: psycopg.Connection, batches: List, vector_type: str) -> bytes:
+    buffer = io.BytesIO()
+    with conn.cursor() as cursor:
+        with Copy(cursor, binary=True, writer=FileWriter(buffer)) as copy:
+            copy.set_types(["int4", "varchar", vector_type])
+            for attributes, vectors in batches:
+                write_vectors(copy, attributes, vectors, vector_type, vectorized=False)
+    return buffer.getvalue()
+
+
+def encode_vectorized(conn: psycopg.Connection, batches: List, vector_type: str) -> bytes:
+    buffer = io.BytesIO()
+    with conn.cursor() as cursor:
+        with Copy(cursor, binary=True, writer=FileWriter(buffer)) as copy:
+            copy.write(COPY_SIGNATURE)
+            for attributes, vectors in batches:
+                write_vectors(copy, attributes, vectors, vector_type, vectorized=True)
+            copy.write(COPY_TRAILER)
+    return buffer.getvalue()
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = Settings(config)
+    max_files = int(args[1]) if len(args) > 1 else 100
+    vector_type = "vector" if settings.store_type == settings.PGVECTOR else "halfvec"
+
+    batches = []
+    for file_name in list_embedding_files(settings.embeddings_folder)[:max_files]:
+        batches.extend(read_embedding_batches(os.path.join(settings.embeddings_folder, file_name)))
+    row_count = sum(attributes.num_rows for attributes, _ in batches)
+    print(f"Encoding {row_count} vectors from {len(batches)} row groups as {vector_type}")
+
+    conn = psycopg.connect(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", ""))
+    register_vector(conn)
+    results = {}
+    for name, encoder in [("row-by-row", encode_row_by_row), ("vectorized", encode_vectorized)]:
+        start = time.perf_counter()
+        data = encoder(conn, batches, vector_type)
+        seconds = time.perf_counter() - start
+        results[name] = data
+        print(f"{name:>12}: {seconds:.3f} seconds, {row_count / seconds:,.0f} rows/sec, {len(data):,} bytes")
+    conn.close()
+    if results["row-by-row"] == results["vectorized"]:
+        print("Output is byte-for-byte identical")
+    else:
+        raise Exception("Output of the vectorized encoder differs from the row-by-row encoder")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        raise Exception("Must provide path to yaml file, and optionally the maximum number of files, as arguments")
+    else:
+        main(sys.argv[1:])
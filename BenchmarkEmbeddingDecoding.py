@@ -0,0 +1,72 @@
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+import numpy as np
+
+from CreateEmbeddings import store_in_parquet
+from GenAIApi import get_embedding_vectors
+from MockEmbeddingServer import MockEmbeddingServer
+from SyntheticVocabulary import _names
+
+# Compares the transport encodings and vector types of the embedding client on a mock embedding server: time and peak
+# Python memory (measured with tracemalloc) of embedding a set of synthetic terms and writing them to a Parquet file.
+# The mock server runs in this process, so its allocations are included in the peak memory of every configuration.
+
+_CONFIGURATIONS = [("float", "float32"), ("base64", "float32"), ("base64", "float16")]
+
+
+def run_configuration(texts: List[str], encoding_format: str, vector_dtype: str, folder: str) -> np.ndarray:
+    embeddings = get_embedding_vectors(texts,
+                                       max_workers=4,
+                                       vector_dtype=vector_dtype,
+                                       encoding_format=encoding_format)["embeddings"]
+    store_in_parquet(concept_ids=list(range(len(texts))),
+                     term_types=["name"] * len(texts),
+                     embeddings=embeddings,
+                     file_name=os.path.join(folder, f"{encoding_format}_{vector_dtype}.parquet"),
+                     vector_dtype=vector_dtype)
+    return embeddings
+
+
+def main(args: List[str]):
+    text_count = int(args[0]) if len(args) > 0 else 20000
+    dimensions = int(args[1]) if len(args) > 1 else 1024
+    texts = _names(np.random.default_rng(0), text_count)
+
+    server = MockEmbeddingServer(dimensions=dimensions).start()
+    os.environ["GENAI_PROVIDER"] = "lm-studio"
+    os.environ["LM_STUDIO_ENDPOINT"] = server.url
+    os.environ["EMBEDDING_MODEL"] = "mock"
+    print(f"Embedding {text_count} texts of {dimensions} dimensions")
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            for encoding_format, vector_dtype in _CONFIGURATIONS:
+                tracemalloc.start()
+                start = time.perf_counter()
+                embeddings = run_configuration(texts, encoding_format, vector_dtype, folder)
+                seconds = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                file_size = os.path.getsize(os.path.join(folder, f"{encoding_format}_{vector_dtype}.parquet"))
+                results[(encoding_format, vector_dtype)] = embeddings
+                print(f"{encoding_format:>7} {vector_dtype}: {seconds:.3f} seconds, {text_count / seconds:,.0f} "
+                      f"texts/sec, peak memory {peak / 2 ** 20:,.1f} MB, vectors {embeddings.nbytes / 2 ** 20:,.1f} MB, "
+                      f"Parquet file {file_size / 2 ** 20:,.1f} MB")
+    finally:
+        server.stop()
+    if not np.array_equal(results[("float", "float32")], results[("base64", "float32")]):
+        raise Exception("Vectors decoded from base64 differ from the vectors decoded from floats")
+    max_error = np.abs(results[("base64", "float16")].astype(np.float32) - results[("base64", "float32")]).max()
+    print(f"Vectors are identical for both encodings, maximum float16 rounding error is {max_error:.2e}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3:
+        raise Exception("Can optionally provide the number of texts and the number of dimensions as arguments")
+    else:
+        main(sys.argv[1:])
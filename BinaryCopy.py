@@ -0,0 +1,172 @@
+import struct
+from typing import List, Tuple, Any, Optional
+
+import numpy as np
+import pyarrow as pa
+
+from Quantization import quantize_binary
+
+# Encoder for the PostgreSQL binary COPY format (https://www.postgresql.org/docs/current/sql-copy.html), working on
+# whole columns at once instead of row by row. The output is identical to what psycopg's copy.write_row() produces
+# for the same values, but is built with NumPy directly into one pre-allocated buffer, so it can be written to the
+# copy stream in large blocks.
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+
+# Big-endian types of the supported scalar columns:
+_SCALAR_TYPES = {
+    "int4": np.dtype(">i4"),
+    "float8": np.dtype(">f8"),
+}
+
+# Big-endian element types of the pgvector binary formats:
+_VECTOR_ELEMENT_TYPES = {
+    "vector": np.dtype(">f4"),
+    "halfvec": np.dtype(">f2"),
+}
+
+
+def _string_parts(values: Any) -> Tuple[np.ndarray, np.ndarray, Any]:
+    """
+    Returns the UTF-8 data buffer, the offsets, and the NULL mask (or None if there are no NULLs) of a string column,
+    without copying for Arrow string arrays.
+    """
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    if not isinstance(values, pa.Array):
+        values = pa.array(values, type=pa.string())
+    if pa.types.is_large_string(values.type):
+        offset_type = np.int64
+    elif pa.types.is_string(values.type):
+        offset_type = np.int32
+    else:
+        values = values.cast(pa.string())
+        offset_type = np.int32
+    nulls = values.is_null().to_numpy(zero_copy_only=False) if values.null_count > 0 else None
+    buffers = values.buffers()
+    offsets = np.frombuffer(buffers[1], dtype=offset_type)[values.offset:values.offset + len(values) + 1]
+    data = np.frombuffer(buffers[2], dtype=np.uint8) if buffers[2] is not None else np.empty(0, dtype=np.uint8)
+    return data, offsets.astype(np.int64), nulls
+
+
+def _byte_view(buffer: bytearray, dtype: Any, count: Optional[int] = None) -> np.ndarray:
+    """
+    Creates a view of the buffer in which element i starts at byte i, so values can be written at arbitrary
+    (unaligned) byte offsets using fancy indexing. When count is set each element is a vector of count values, also
+    when count is 1, so the view always has two dimensions.
+    """
+    dtype = np.dtype(dtype)
+    if count is None:
+        return np.ndarray((len(buffer) - dtype.itemsize + 1,), dtype=dtype, buffer=buffer, strides=(1,))
+    size = len(buffer) - dtype.itemsize * count + 1
+    return np.ndarray((size, count), dtype=dtype, buffer=buffer, strides=(1, dtype.itemsize))
+
+
+class _Column:
+
+    def __init__(self, pg_type: str, values: Any):
+        self.pg_type = pg_type
+        if pg_type in _SCALAR_TYPES:
+            if isinstance(values, (pa.Array, pa.ChunkedArray)):
+                if values.null_count > 0:
+                    raise ValueError("NULL values are not supported by the binary COPY encoder")
+                values = values.to_numpy()
+            self.values = np.asarray(values)
+            self.length = len(self.values)
+        elif pg_type == "varchar":
+            self.data, self.offsets, self.nulls = _string_parts(values)
+            # The offsets of a NULL string are equal, so its length is 0:
+            self.lengths = np.diff(self.offsets)
+            self.length = len(self.lengths)
+        elif pg_type in _VECTOR_ELEMENT_TYPES:
+            self.values = np.asarray(values)
+            if self.values.ndim != 2:
+                raise ValueError("Vectors must be provided as a (rows x dimensions) matrix")
+            self.dimensions = self.values.shape[1]
+            self.element_type = _VECTOR_ELEMENT_TYPES[pg_type]
+            self.length = self.values.shape[0]
+        elif pg_type == "bit":
+            values = np.asarray(values)
+            if values.ndim != 2:
+                raise ValueError("Vectors must be provided as a (rows x dimensions) matrix")
+            self.dimensions = values.shape[1]
+            self.values = quantize_binary(values)
+            self.length = self.values.shape[0]
+        else:
+            raise ValueError(f"Unsupported type for binary COPY: {pg_type}")
+
+    def value_lengths(self) -> Any:
+        """
+        Returns the length in bytes of the value of this field, per row or as a scalar if it is the same for all rows.
+        """
+        if self.pg_type in _SCALAR_TYPES:
+            return _SCALAR_TYPES[self.pg_type].itemsize
+        if self.pg_type == "varchar":
+            return self.lengths
+        if self.pg_type == "bit":
+            return 4 + self.values.shape[1]
+        return 4 + self.dimensions * self.element_type.itemsize
+
+    def fill(self, buffer: bytearray, positions: np.ndarray) -> None:
+        """
+        Writes the length header and the value of this field for all rows, starting at the given byte positions.
+        """
+        _byte_view(buffer, ">i4")[positions] = self.value_lengths()
+        if self.pg_type == "varchar" and self.nulls is not None:
+            # A NULL field is a length of -1 without a value:
+            _byte_view(buffer, ">i4")[positions[self.nulls]] = -1
+        positions = positions + 4
+        if self.pg_type in _SCALAR_TYPES:
+            _byte_view(buffer, _SCALAR_TYPES[self.pg_type])[positions] = self.values
+        elif self.pg_type == "varchar":
+            # Strings of equal length can be written as a matrix, so write each length in one go:
+            for length in np.unique(self.lengths):
+                if length == 0:
+                    continue
+                rows = np.flatnonzero(self.lengths == length)
+                strings = self.data[self.offsets[rows, np.newaxis] + np.arange(length)]
+                _byte_view(buffer, np.uint8, int(length))[positions[rows]] = strings
+        elif self.pg_type == "bit":
+            # The number of bits, followed by the bits packed most significant bit first:
+            _byte_view(buffer, ">i4")[positions] = self.dimensions
+            _byte_view(buffer, np.uint8, self.values.shape[1])[positions + 4] = self.values
+        else:
+            _byte_view(buffer, ">u2", 2)[positions] = (self.dimensions, 0)
+            _byte_view(buffer, self.element_type, self.dimensions)[positions + 4] = self.values
+
+
+def encode_rows(columns: List[Tuple[str, Any]]) -> bytearray:
+    """
+    Encodes a set of columns as tuples in the PostgreSQL binary COPY format, without the signature and trailer.
+
+    Args:
+        columns: A list of (type, values) tuples, one per column in COPY order. Supported types are 'int4' (integer
+                 values), 'float8' (float values), 'varchar' (Arrow string array or list of str, may contain NULLs), and 'vector' and 'halfvec' (a NumPy
+                 rows x dimensions matrix), and 'bit' (a NumPy rows x dimensions matrix, binary quantized).
+                 Float vectors are converted to float16 for 'halfvec'.
+
+    Returns:
+        A buffer with the encoded tuples.
+    """
+    encoded_columns = [_Column(pg_type, values) for pg_type, values in columns]
+    n = encoded_columns[0].length
+    if any(column.length != n for column in encoded_columns):
+        raise ValueError("All columns must have the same length")
+    if n == 0:
+        return bytearray()
+
+    # Each tuple is a 2-byte field count, followed by a 4-byte length and the value of each field:
+    row_widths = np.full(n, 2, dtype=np.int64)
+    for column in encoded_columns:
+        row_widths += 4 + np.asarray(column.value_lengths(), dtype=np.int64)
+    row_offsets = np.zeros(n, dtype=np.int64)
+    np.cumsum(row_widths[:-1], out=row_offsets[1:])
+
+    buffer = bytearray(int(row_widths.sum()))
+    _byte_view(buffer, ">i2")[row_offsets] = len(encoded_columns)
+    positions = row_offsets + 2
+    for column in encoded_columns:
+        column.fill(buffer, positions)
+        positions = positions + 4 + column.value_lengths()
+    return buffer
@@ -0,0 +1,129 @@
+import logging
+import os
+import sys
+from typing import List
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import yaml
+from tqdm import tqdm
+
+from EmbeddingManifest import EmbeddingManifest, Shard, file_checksum
+from Logging import open_log
+from Metrics import instrument_stage, timer, increment
+from Settings import Settings
+
+
+def get_row_group_size(schema: pa.Schema, target_bytes: int) -> int:
+    """
+    Computes the number of rows per row group that makes a row group about the target size, based on the size of
+    the vectors.
+    """
+    row_bytes = 16
+    for field in schema:
+        if pa.types.is_fixed_size_list(field.type):
+            row_bytes += field.type.list_size * field.type.value_type.bit_width // 8
+        elif pa.types.is_floating(field.type) or pa.types.is_integer(field.type):
+            row_bytes += field.type.bit_width // 8
+    return max(1, target_bytes // row_bytes)
+
+
+def compact_folder(folder: str, rows_per_file: int, row_group_bytes: int) -> None:
+    """
+    Merges the shards in an embeddings folder into large files, in term ID order. The new files are written first,
+    then the manifest is replaced, and only then are the old shards removed, so the folder is valid at any time.
+    """
+    manifest = EmbeddingManifest(folder)
+    if not manifest.exists():
+        raise Exception(f"No manifest found in {folder}")
+    problems = manifest.verify()
+    if problems:
+        raise Exception("Cannot compact an inconsistent folder: " + ", ".join(problems))
+    shards = sorted(manifest.shards, key=lambda shard: shard.first_term_id)
+    if len(shards) == 0:
+        return
+    row_group_size = get_row_group_size(pq.read_schema(os.path.join(folder, shards[0].file)), row_group_bytes)
+    logging.info(f"Compacting {len(shards)} shards into files of {rows_per_file} rows, with row groups of "
+                 f"{row_group_size} rows")
+
+    # Group consecutive shards into files of about rows_per_file rows:
+    groups = []
+    group = []
+    group_rows = 0
+    for shard in shards:
+        if group and group_rows + shard.row_count > rows_per_file:
+            groups.append(group)
+            group = []
+            group_rows = 0
+        group.append(shard)
+        group_rows += shard.row_count
+    groups.append(group)
+
+    new_shards = []
+    for group in tqdm(groups):
+        if len(group) == 1:
+            new_shards.append(group[0])
+            continue
+        file_name = f"EmbeddingVectors_{group[0].first_term_id}_{group[-1].last_term_id}.parquet"
+        file_path = os.path.join(folder, file_name)
+        schema = pq.read_schema(os.path.join(folder, group[0].file))
+        buffered = []
+        buffered_rows = 0
+        with pq.ParquetWriter(file_path + ".tmp", schema) as writer:
+            for shard in group:
+                table = pq.read_table(os.path.join(folder, shard.file))
+                buffered.append(table)
+                buffered_rows += table.num_rows
+                # Each write ends in a row group of its own, so only whole row groups are written, and the remaining
+                # rows stay in the buffer until the end of the file:
+                if buffered_rows >= row_group_size:
+                    table = pa.concat_tables(buffered)
+                    full_rows = buffered_rows - buffered_rows % row_group_size
+                    with timer("parquet_write_seconds"):
+                        writer.write_table(table.slice(0, full_rows), row_group_size=row_group_size)
+                    increment("parquet_rows_written", full_rows)
+                    buffered = [table.slice(full_rows)]
+                    buffered_rows -= full_rows
+            if buffered_rows > 0:
+                with timer("parquet_write_seconds"):
+                    writer.write_table(pa.concat_tables(buffered), row_group_size=row_group_size)
+                increment("parquet_rows_written", buffered_rows)
+        os.replace(file_path + ".tmp", file_path)
+        increment("parquet_bytes_written", os.path.getsize(file_path))
+        new_shards.append(Shard(file=file_name,
+                                first_term_id=group[0].first_term_id,
+                                last_term_id=group[-1].last_term_id,
+                                row_count=sum(shard.row_count for shard in group),
+                                sha256=file_checksum(file_path)))
+    manifest.replace_shards(new_shards)
+
+    # Remove the old shards, and any files not in the manifest (e.g. left behind by a crash):
+    keep = set(manifest.file_names())
+    removed = 0
+    for file_name in os.listdir(folder):
+        if (file_name.endswith(".parquet") or file_name.endswith(".parquet.tmp")) and file_name not in keep:
+            os.remove(os.path.join(folder, file_name))
+            removed += 1
+    logging.info(f"Compacted {len(shards)} shards into {len(new_shards)} files, removed {removed} files")
+
+
+@instrument_stage("CompactEmbeddings")
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = Settings(config)
+    os.makedirs(settings.log_folder, exist_ok=True)
+    open_log(os.path.join(settings.log_folder, "logCompactEmbeddings.txt"))
+
+    logging.info("Starting compacting embedding vectors")
+    compact_folder(folder=settings.embeddings_folder,
+                   rows_per_file=settings.compact_rows_per_file,
+                   row_group_bytes=settings.compact_row_group_mb * 1024 * 1024)
+    logging.info("Finished compacting embedding vectors")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
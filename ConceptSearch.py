@@ -0,0 +1,615 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue, Empty
+from typing import List, Optional, Dict, Any, Tuple
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import yaml
+from dotenv import load_dotenv
+from pgvector.psycopg import register_vector
+from psycopg import sql
+from psycopg_pool import ConnectionPool
+
+from EmbeddingCache import normalize_text
+from GenAIApi import get_embedding_vectors
+from LexicalSearch import LexicalSearch
+from Logging import open_log
+from Metrics import instrument_stage, timer, increment
+from Quantization import truncate_vectors
+from Settings import Settings
+from UploadEmbeddingVectors import get_vector_type, get_concept_term_table
+
+load_dotenv()
+
+SEARCH_MODES = ["vector", "lexical_first", "hybrid"]
+
+# The constant of reciprocal rank fusion, which dampens the weight of the top ranks of each list:
+_RRF_K = 60
+
+
+class _QueryEmbeddingCache:
+    """
+    Thread-safe in-memory LRU cache of query embeddings.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._vectors: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._vectors.get(text)
+            if vector is None:
+                self.misses += 1
+            else:
+                self._vectors.move_to_end(text)
+                self.hits += 1
+            return vector
+
+    def put(self, text: str, vector: np.ndarray) -> None:
+        with self._lock:
+            self._vectors[text] = vector
+            self._vectors.move_to_end(text)
+            while len(self._vectors) > self.max_size:
+                self._vectors.popitem(last=False)
+
+
+class _FastPathStats:
+    """
+    Thread-safe counts of the queries answered by the lexical fast path, and of the time spent on the lexical and
+    vector paths, to estimate the time the fast path saves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.hits = 0
+        self.lexical_seconds = 0.0
+        self.vector_queries = 0
+        self.vector_seconds = 0.0
+
+    def record_lookup(self, queries: int, hits: int, seconds: float) -> None:
+        with self._lock:
+            self.queries += queries
+            self.hits += hits
+            self.lexical_seconds += seconds
+
+    def record_vector_search(self, queries: int, seconds: float) -> None:
+        with self._lock:
+            self.vector_queries += queries
+            self.vector_seconds += seconds
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            # Each hit saves the average time of a query on the vector path (embedding and search), at the cost of
+            # the lookups of all queries:
+            saved = None
+            if self.vector_queries > 0:
+                saved = self.hits * self.vector_seconds / self.vector_queries - self.lexical_seconds
+            return {"queries": self.queries,
+                    "hits": self.hits,
+                    "hit_rate": self.hits / self.queries if self.queries else None,
+                    "lexical_seconds": self.lexical_seconds,
+                    "vector_seconds_per_query": self.vector_seconds / self.vector_queries if self.vector_queries else None,
+                    "seconds_saved": saved}
+
+
+class ConceptSearch:
+    """
+    Searches the vector store for the concepts nearest to query strings. Connections come from a pool on which the
+    pgvector types are already registered, and each batch of queries is embedded in one call and searched in one SQL
+    round trip.
+
+    Args:
+        settings: The settings. The store type determines the vector type, and the record count table is joined if it
+                  exists. With binary quantization, the rerank_candidates nearest binary vectors (by Hamming
+                  distance) are re-ranked using the full-precision vectors. With search_mode 'lexical_first',
+                  queries with an exact match in the lexical index of the terms database are answered from there
+                  without embedding them, and with 'hybrid', the vector and BM25 candidates are fused.
+        pool_size: Maximum number of database connections.
+        cache_size: Maximum number of query embeddings kept in the LRU cache.
+        max_batch_size: Maximum number of queries combined into one batch by the background batcher.
+        batch_wait_ms: How long the background batcher waits for more queries before running a batch.
+    """
+
+    def __init__(self,
+                 settings: Settings,
+                 pool_size: int = 4,
+                 cache_size: int = 10000,
+                 max_batch_size: int = 64,
+                 batch_wait_ms: float = 5):
+        self.schema = os.getenv("VOCAB_SCHEMA")
+        self.table = os.getenv("VOCAB_VECTOR_TABLE")
+        self.vector_type = get_vector_type(settings)
+        self.binary = settings.store_type == settings.PGVECTOR_BINARY
+        self.rerank_candidates = settings.rerank_candidates
+        if settings.search_mode not in SEARCH_MODES:
+            raise ValueError(f"search_mode must be one of {SEARCH_MODES}")
+        self.search_mode = settings.search_mode
+        self.hybrid_candidates = settings.hybrid_candidates
+        self.lexical = None if settings.search_mode == "vector" else LexicalSearch(settings)
+        self.fast_path_stats = _FastPathStats()
+        self.request_dimensions = settings.dimensions
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self.cache = _QueryEmbeddingCache(cache_size)
+        self.pool = ConnectionPool(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", ""),
+                                   min_size=1,
+                                   max_size=pool_size,
+                                   configure=register_vector,
+                                   open=True)
+        with self.pool.connection() as conn:
+            exists = conn.execute("SELECT to_regclass(%s)",
+                                  (f"{self.schema}.{settings.record_count_table}",)).fetchone()[0] is not None
+            # The type modifier of a pgvector column is its number of dimensions:
+            self.dimensions = conn.execute(
+                "SELECT atttypmod FROM pg_attribute WHERE attrelid = %s::regclass AND attname = 'embedding_vector'",
+                (f'"{self.schema}"."{self.table}"',)).fetchone()[0]
+            # Only tables partitioned by domain have the domain of each vector:
+            self.has_domains = self._has_column(conn, "domain_id")
+            # A deduplicated table has a vector per unique text, mapped to concepts by the concept term table:
+            self.deduplicated = self._has_column(conn, "text_id")
+        self.record_count_table = settings.record_count_table if exists else None
+        if not exists:
+            logging.warning(f"Record count table {settings.record_count_table} not found, not returning record counts")
+        self._queue: Queue = Queue()
+        self._batcher: Optional[threading.Thread] = None
+        self._batcher_lock = threading.Lock()
+
+    def _has_column(self, conn, column: str) -> bool:
+        return conn.execute("SELECT COUNT(*) FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s",
+                            (f'"{self.schema}"."{self.table}"', column)).fetchone()[0] > 0
+
+    def close(self) -> None:
+        if self._batcher is not None:
+            self._queue.put(None)
+            self._batcher.join()
+        self.pool.close()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Embeds query strings, using the LRU cache. Texts missing from the cache are embedded in one call. Vectors
+        wider than the vectors in the store are truncated and L2-renormalized.
+        """
+        keys = [normalize_text(text) for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, vector in zip(keys, vectors) if vector is None))
+        if missing:
+            new_vectors = get_embedding_vectors(missing, dimensions=self.request_dimensions)["embeddings"]
+            new_vectors = truncate_vectors(new_vectors, self.dimensions).astype(np.float32)
+            for key, vector in zip(missing, new_vectors):
+                self.cache.put(key, vector)
+            lookup = dict(zip(missing, new_vectors))
+            vectors = [lookup[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        return np.vstack(vectors)
+
+    def _create_nearest_statement(self, k: int, dimensions: int, domain_id: Optional[str] = None) -> sql.Composed:
+        # The domain is a literal, so the planner can prune all other partitions, and only search the HNSW index of
+        # the partition of the domain:
+        domain_filter = sql.SQL("")
+        if domain_id is not None:
+            domain_filter = sql.SQL("WHERE domain_id = {domain_id}").format(domain_id=sql.Literal(domain_id))
+        key_columns = sql.SQL("text_id" if self.deduplicated else "concept_id, term_type")
+        if not self.binary:
+            return sql.SQL("""
+                SELECT {key_columns},
+                    embedding_vector <=> query.query_vector::{vector_type} AS distance
+                FROM {schema}.{table}
+                {domain_filter}
+                ORDER BY embedding_vector <=> query.query_vector::{vector_type}
+                LIMIT {k}
+                """).format(key_columns=key_columns,
+                            vector_type=sql.SQL(self.vector_type),
+                            schema=sql.Identifier(self.schema),
+                            table=sql.Identifier(self.table),
+                            domain_filter=domain_filter,
+                            k=sql.Literal(k))
+        # Two stages: find candidates using the HNSW index on the binary vectors, then re-rank by cosine distance:
+        return sql.SQL("""
+            SELECT {key_columns},
+                embedding_vector <=> query.query_vector::{vector_type} AS distance
+            FROM (
+                SELECT {key_columns},
+                    embedding_vector
+                FROM {schema}.{table}
+                {domain_filter}
+                ORDER BY binary_vector <~> query.query_bits::bit({dimensions})
+                LIMIT {candidates}
+            ) candidates
+            ORDER BY distance
+            LIMIT {k}
+            """).format(key_columns=key_columns,
+                        vector_type=sql.SQL(self.vector_type),
+                        schema=sql.Identifier(self.schema),
+                        table=sql.Identifier(self.table),
+                        domain_filter=domain_filter,
+                        dimensions=sql.Literal(dimensions),
+                        candidates=sql.Literal(max(k, self.rerank_candidates)),
+                        k=sql.Literal(k))
+
+    def _create_concept_hits_statement(self,
+                                       k: int,
+                                       dimensions: int,
+                                       domain_id: Optional[str] = None) -> sql.Composed:
+        nearest = self._create_nearest_statement(k, dimensions, domain_id)
+        if not self.deduplicated:
+            return nearest
+        # Collapses the k nearest texts to the concepts they are terms of. A concept reached through several texts is
+        # returned once, with its nearest text, so there can be fewer than k results:
+        return sql.SQL("""
+            SELECT concept_id,
+                term_type,
+                distance
+            FROM (
+                SELECT DISTINCT ON (concept_term.concept_id) concept_term.concept_id,
+                    concept_term.term_type,
+                    nearest_text.distance
+                FROM (
+                    {nearest}
+                ) nearest_text
+                INNER JOIN {schema}.{concept_term_table} concept_term
+                    ON concept_term.text_id = nearest_text.text_id
+                ORDER BY concept_term.concept_id, nearest_text.distance, concept_term.term_type
+            ) concept_hits
+            ORDER BY distance
+            LIMIT {k}
+            """).format(nearest=nearest,
+                        schema=sql.Identifier(self.schema),
+                        concept_term_table=sql.Identifier(get_concept_term_table(self.table)),
+                        k=sql.Literal(k))
+
+    def _get_record_count_sql(self, concept_id_column: str) -> Tuple[sql.Composable, sql.Composable]:
+        record_count = sql.SQL("NULL::FLOAT")
+        record_count_join = sql.SQL("")
+        if self.record_count_table is not None:
+            record_count = sql.SQL("concept_record_count.record_count")
+            record_count_join = sql.SQL(
+                "LEFT JOIN {schema}.{record_count_table} concept_record_count "
+                "ON concept_record_count.concept_id = {concept_id_column}").format(
+                schema=sql.Identifier(self.schema),
+                record_count_table=sql.Identifier(self.record_count_table),
+                concept_id_column=sql.SQL(concept_id_column))
+        return record_count, record_count_join
+
+    def _create_statement(self, k: int, dimensions: int, domain_id: Optional[str] = None) -> sql.Composed:
+        record_count, record_count_join = self._get_record_count_sql("nearest.concept_id")
+        return sql.SQL("""
+            SELECT query.query_index,
+                nearest.concept_id,
+                concept.concept_name,
+                nearest.term_type,
+                1 - nearest.distance AS similarity,
+                {record_count} AS record_count
+            FROM unnest(%s::INT[], %s::vector[], %s::TEXT[]) AS query(query_index, query_vector, query_bits)
+            CROSS JOIN LATERAL (
+                {nearest}
+            ) nearest
+            INNER JOIN {schema}.concept
+                ON concept.concept_id = nearest.concept_id
+            {record_count_join}
+            ORDER BY query.query_index, nearest.distance;
+            """).format(record_count=record_count,
+                        record_count_join=record_count_join,
+                        nearest=self._create_concept_hits_statement(k, dimensions, domain_id),
+                        schema=sql.Identifier(self.schema))
+
+    def _describe_concepts(self, concept_ids: List[int]) -> Dict[int, Tuple[str, Optional[float]]]:
+        """
+        Returns the name and record count of each concept, for results that did not come from the vector search.
+        """
+        if len(concept_ids) == 0:
+            return {}
+        record_count, record_count_join = self._get_record_count_sql("concept.concept_id")
+        statement = sql.SQL("""
+            SELECT concept.concept_id,
+                concept.concept_name,
+                {record_count} AS record_count
+            FROM {schema}.concept
+            {record_count_join}
+            WHERE concept.concept_id = ANY(%s::INT[]);
+            """).format(record_count=record_count,
+                        record_count_join=record_count_join,
+                        schema=sql.Identifier(self.schema))
+        with self.pool.connection() as conn:
+            rows = conn.execute(statement, (list(set(concept_ids)),)).fetchall()
+        return {concept_id: (concept_name, record_count) for concept_id, concept_name, record_count in rows}
+
+    def search(self,
+               texts: List[str],
+               k: int = 10,
+               ef_search: Optional[int] = None,
+               domain_id: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Finds the nearest concepts for a batch of query strings.
+
+        Args:
+            texts: The query strings.
+            k: Number of results per query.
+            ef_search: The HNSW ef_search to use for this request. Defaults to the server setting, or to
+                       rerank_candidates with binary quantization. Should be at least k (or rerank_candidates).
+            domain_id: Optional domain to restrict the results to. Requires a vector table partitioned by domain.
+
+        Returns:
+            For each query, a list of results with concept_id, concept_name, term_type, similarity, and record_count.
+            In lexical_first mode, each result also has a match: 'exact' or 'prefix' for results of the fast path,
+            where the similarity is 1 for exact matches and None for prefix matches, or 'vector'. In hybrid mode, each
+            result also has its rrf_score, and the similarity is None for results found by BM25 only.
+        """
+        if len(texts) == 0:
+            return []
+        if domain_id is not None and not self.has_domains:
+            raise ValueError("Searching within a domain requires a vector table partitioned by domain")
+        if self.search_mode == "lexical_first":
+            return self._search_lexical_first(texts, k, ef_search, domain_id)
+        if self.search_mode == "hybrid":
+            return self._search_hybrid(texts, k, ef_search, domain_id)
+        return self._search_vectors(texts, k, ef_search, domain_id)
+
+    def _search_lexical_first(self,
+                              texts: List[str],
+                              k: int,
+                              ef_search: Optional[int],
+                              domain_id: Optional[str]) -> List[List[Dict[str, Any]]]:
+        start_time = time.perf_counter()
+        lexical_hits = self.lexical.lookup(texts, k, domain_id)
+        # Only an exact match answers a query. Prefix matches are returned with it, but do not answer a query alone:
+        answered = [i for i, hits in enumerate(lexical_hits) if any(hit["match"] == "exact" for hit in hits)]
+        concepts = self._describe_concepts([hit["concept_id"] for i in answered for hit in lexical_hits[i]])
+        results: List[Optional[List[Dict[str, Any]]]] = [None] * len(texts)
+        for i in answered:
+            results[i] = [{"concept_id": hit["concept_id"],
+                           "concept_name": concepts.get(hit["concept_id"], (hit["term"], None))[0],
+                           "term_type": hit["term_type"],
+                           "similarity": 1.0 if hit["match"] == "exact" else None,
+                           "record_count": concepts.get(hit["concept_id"], (None, None))[1],
+                           "match": hit["match"]} for hit in lexical_hits[i]]
+        self.fast_path_stats.record_lookup(len(texts), len(answered), time.perf_counter() - start_time)
+        increment("lexical_fast_path_queries", len(texts))
+        increment("lexical_fast_path_hits", len(answered))
+        remaining = [i for i in range(len(texts)) if results[i] is None]
+        if remaining:
+            vector_results = self._search_vectors([texts[i] for i in remaining], k, ef_search, domain_id)
+            for i, query_results in zip(remaining, vector_results):
+                for result in query_results:
+                    result["match"] = "vector"
+                results[i] = query_results
+        return results
+
+    def _search_hybrid(self,
+                       texts: List[str],
+                       k: int,
+                       ef_search: Optional[int],
+                       domain_id: Optional[str]) -> List[List[Dict[str, Any]]]:
+        candidates = max(k, self.hybrid_candidates)
+        if ef_search is not None:
+            ef_search = max(ef_search, candidates)
+        vector_results = self._search_vectors(texts, candidates, ef_search, domain_id)
+        lexical_results = self.lexical.search(texts, candidates, domain_id)
+        # Reciprocal rank fusion: each concept scores 1 / (_RRF_K + rank) for its best rank in each list:
+        fused_results = []
+        lexical_only = []
+        for query_vector_results, query_lexical_results in zip(vector_results, lexical_results):
+            fused: Dict[int, Dict[str, Any]] = {}
+            rank = 0
+            for result in query_vector_results:
+                if result["concept_id"] in fused:
+                    continue
+                rank += 1
+                fused[result["concept_id"]] = dict(result, rrf_score=1 / (_RRF_K + rank))
+            for rank, hit in enumerate(query_lexical_results, start=1):
+                if hit["concept_id"] in fused:
+                    fused[hit["concept_id"]]["rrf_score"] += 1 / (_RRF_K + rank)
+                else:
+                    fused[hit["concept_id"]] = {"concept_id": hit["concept_id"],
+                                                "concept_name": hit["term"],
+                                                "term_type": hit["term_type"],
+                                                "similarity": None,
+                                                "record_count": None,
+                                                "rrf_score": 1 / (_RRF_K + rank)}
+            query_results = sorted(fused.values(), key=lambda result: -result["rrf_score"])[:k]
+            lexical_only.extend(result for result in query_results if result["similarity"] is None)
+            fused_results.append(query_results)
+        concepts = self._describe_concepts([result["concept_id"] for result in lexical_only])
+        for result in lexical_only:
+            if result["concept_id"] in concepts:
+                result["concept_name"], result["record_count"] = concepts[result["concept_id"]]
+        return fused_results
+
+    def _search_vectors(self,
+                        texts: List[str],
+                        k: int,
+                        ef_search: Optional[int],
+                        domain_id: Optional[str]) -> List[List[Dict[str, Any]]]:
+        start_time = time.perf_counter()
+        vectors = self.embed(texts)
+        bits = [None] * len(texts)
+        if self.binary:
+            bits = ["".join(map(str, signs)) for signs in (vectors > 0).astype(np.uint8)]
+            if ef_search is None:
+                ef_search = max(k, self.rerank_candidates)
+        results = [[] for _ in texts]
+        with timer("search_query_seconds"), self.pool.connection() as conn:
+            with conn.transaction():
+                if ef_search is not None:
+                    conn.execute(sql.SQL("SET LOCAL hnsw.ef_search = {ef_search}").format(
+                        ef_search=sql.Literal(int(ef_search))))
+                rows = conn.execute(self._create_statement(k, vectors.shape[1], domain_id),
+                                    (list(range(len(texts))), list(vectors), bits)).fetchall()
+        increment("search_queries", len(texts))
+        for query_index, concept_id, concept_name, term_type, similarity, record_count in rows:
+            results[query_index].append({
+                "concept_id": concept_id,
+                "concept_name": concept_name,
+                "term_type": term_type,
+                "similarity": similarity,
+                "record_count": record_count,
+            })
+        self.fast_path_stats.record_vector_search(len(texts), time.perf_counter() - start_time)
+        return results
+
+    def submit(self, text: str, k: int = 10, ef_search: Optional[int] = None, domain_id: Optional[str] = None) -> Future:
+        """
+        Queues a single query for the background batcher, which combines queries arriving at about the same time
+        (with the same k, ef_search, and domain) into one search.
+
+        Returns:
+            A future that resolves to the list of results for the query.
+        """
+        with self._batcher_lock:
+            if self._batcher is None:
+                self._batcher = threading.Thread(target=self._run_batcher, daemon=True)
+                self._batcher.start()
+        future = Future()
+        self._queue.put((text, k, ef_search, domain_id, future))
+        return future
+
+    def _run_batcher(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            try:
+                while len(batch) < self.max_batch_size:
+                    item = self._queue.get(timeout=self.batch_wait)
+                    if item is None:
+                        self._queue.put(None)
+                        break
+                    batch.append(item)
+            except Empty:
+                pass
+            groups: Dict[Tuple[int, Optional[int], Optional[str]], List] = {}
+            for text, k, ef_search, domain_id, future in batch:
+                groups.setdefault((k, ef_search, domain_id), []).append((text, future))
+            for (k, ef_search, domain_id), group in groups.items():
+                try:
+                    results = self.search([text for text, _ in group], k=k, ef_search=ef_search, domain_id=domain_id)
+                    for (_, future), result in zip(group, results):
+                        future.set_result(result)
+                except Exception as e:
+                    for _, future in group:
+                        future.set_exception(e)
+
+
+def _create_handler(search: ConceptSearch):
+
+    class SearchHandler(BaseHTTPRequestHandler):
+        """
+        GET /search?q=text&q=text2&k=10&ef_search=40&domain=Condition, or POST /search with a JSON body such as
+        {"queries": ["text"], "k": 10, "ef_search": 40, "domain": "Condition"}.
+        """
+
+        def _respond(self, status: int, body: Any) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _search(self, queries: List[str], k: int, ef_search: Optional[int], domain_id: Optional[str]) -> None:
+            if domain_id is not None and not search.has_domains:
+                self._respond(400, {"error": "The vector table is not partitioned by domain"})
+                return
+            futures = [search.submit(query, k=k, ef_search=ef_search, domain_id=domain_id) for query in queries]
+            try:
+                results = [{"query": query, "results": future.result()} for query, future in zip(queries, futures)]
+            except Exception as e:
+                logging.error(f"Search failed: {e}")
+                self._respond(500, {"error": str(e)})
+                return
+            self._respond(200, results)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/search":
+                self._respond(404, {"error": "Not found"})
+                return
+            parameters = parse_qs(url.query)
+            ef_search = parameters.get("ef_search")
+            self._search(queries=parameters.get("q", []),
+                         k=int(parameters.get("k", [10])[0]),
+                         ef_search=int(ef_search[0]) if ef_search else None,
+                         domain_id=parameters.get("domain", [None])[0])
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/search":
+                self._respond(404, {"error": "Not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                queries = body["queries"]
+            except (ValueError, KeyError):
+                self._respond(400, {"error": "Body must be JSON with a 'queries' list"})
+                return
+            self._search(queries=queries,
+                         k=int(body.get("k", 10)),
+                         ef_search=body.get("ef_search"),
+                         domain_id=body.get("domain"))
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return SearchHandler
+
+
+@instrument_stage("ConceptSearch")
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = Settings(config)
+    os.makedirs(settings.log_folder, exist_ok=True)
+    open_log(os.path.join(settings.log_folder, "logConceptSearch.txt"))
+
+    search = ConceptSearch(settings,
+                           pool_size=settings.search_pool_size,
+                           cache_size=settings.search_cache_size,
+                           max_batch_size=settings.search_max_batch_size,
+                           batch_wait_ms=settings.search_batch_wait_ms)
+    server = ThreadingHTTPServer(("127.0.0.1", settings.search_port), _create_handler(search))
+    logging.info(f"Serving concept search on http://127.0.0.1:{server.server_address[1]}/search")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        search.close()
+        logging.info(f"Query embedding cache hits: {search.cache.hits}, misses: {search.cache.misses}")
+        if search.search_mode == "lexical_first":
+            log_fast_path_stats(search)
+
+
+def log_fast_path_stats(search: ConceptSearch) -> None:
+    """
+    Logs the hit rate of the lexical fast path, and the estimated time it saved, and records the latter as the
+    lexical_seconds_saved counter.
+    """
+    stats = search.fast_path_stats.summary()
+    if stats["queries"] == 0:
+        return
+    message = f"Lexical fast path answered {stats['hits']} of {stats['queries']} queries ({100 * stats['hit_rate']:.1f}%)"
+    if stats["seconds_saved"] is not None:
+        increment("lexical_seconds_saved", stats["seconds_saved"])
+        message += (f", saving an estimated {stats['seconds_saved']:.2f} seconds (vector path "
+                    f"{1000 * stats['vector_seconds_per_query']:.1f} ms per query, lexical lookups "
+                    f"{stats['lexical_seconds']:.2f} seconds in total)")
+    logging.info(message)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
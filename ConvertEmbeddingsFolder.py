@@ -0,0 +1,36 @@
+import os
+import sys
+from typing import List
+
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from EmbeddingFiles import list_embedding_files, convert_file, get_format_version, FORMAT_VERSION, VECTOR_DTYPES
+
+
+def main(args: List[str]):
+    source_folder = args[0]
+    target_folder = args[1]
+    vector_dtype = args[2] if len(args) > 2 else "float32"
+    if vector_dtype not in VECTOR_DTYPES:
+        raise ValueError(f"vector_dtype must be one of {list(VECTOR_DTYPES.keys())}")
+    if os.path.abspath(source_folder) == os.path.abspath(target_folder):
+        raise ValueError("Source and target folder must be different")
+    os.makedirs(target_folder, exist_ok=True)
+
+    total_count = 0
+    for file_name in tqdm(list_embedding_files(source_folder)):
+        source_path = os.path.join(source_folder, file_name)
+        target_path = os.path.join(target_folder, file_name)
+        if os.path.isfile(target_path) and get_format_version(pq.read_schema(target_path)) == FORMAT_VERSION:
+            continue
+        total_count += convert_file(source_path, target_path, vector_dtype)
+    print(f"Converted {total_count} vectors to format version {FORMAT_VERSION}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        raise Exception("Must provide source folder, target folder, and optionally the vector type (float32 or "
+                        "float16) as arguments")
+    else:
+        main(sys.argv[1:])
@@ -1,6 +1,7 @@
 import logging
 import os
 import sys
+import time
 from typing import List
 
 import psycopg
@@ -9,12 +10,52 @@ from psycopg import sql
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
 
+from AncestorRollup import get_ancestor_matrix, read_count_files, count_column_names
+from BinaryCopy import COPY_SIGNATURE, COPY_TRAILER, encode_rows
 from Logging import open_log
+from Metrics import instrument_stage
 from Settings import Settings
 
 load_dotenv()
 
 
+def create_table_locally(settings: Settings, file_names: List[str]):
+    """
+    Rolls up the counts to the ancestors using the local copy of the concept_ancestor table, and replaces the record
+    count table with the result in a single transaction.
+    """
+    schema = os.getenv("VOCAB_SCHEMA")
+    matrix = get_ancestor_matrix(settings.ancestor_cache_path, schema, settings.refresh_ancestor_cache)
+    concept_ids, counts = read_count_files(file_names)
+    start_time = time.time()
+    ancestor_ids, totals = matrix.roll_up(concept_ids, counts)
+    logging.info(f"Rolled up {len(concept_ids)} concept counts to {len(ancestor_ids)} concepts in "
+                 f"{time.time() - start_time:.1f} seconds")
+
+    column_names = count_column_names(file_names)
+    columns = [("int4", ancestor_ids)]
+    if len(column_names) > 1:
+        columns.append(("float8", totals.sum(axis=1)))
+        column_names = ["record_count"] + column_names
+    columns.extend(("float8", totals[:, j]) for j in range(totals.shape[1]))
+    table = sql.Identifier(schema, settings.record_count_table)
+    with psycopg.connect(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", "")) as conn:
+        conn.execute(sql.SQL("DROP TABLE IF EXISTS {table}").format(table=table))
+        conn.execute(sql.SQL("CREATE TABLE {table} (concept_id INT, {columns})").format(
+            table=table,
+            columns=sql.SQL(", ").join(sql.SQL("{column} FLOAT").format(column=sql.Identifier(name))
+                                       for name in column_names)))
+        with conn.cursor().copy(sql.SQL("COPY {table} FROM STDIN WITH (FORMAT BINARY)").format(table=table)) as copy:
+            copy.write(COPY_SIGNATURE)
+            copy.write(encode_rows(columns))
+            copy.write(COPY_TRAILER)
+        logging.info("Creating index")
+        conn.execute(sql.SQL("CREATE INDEX IF NOT EXISTS idx_concept_count_concept_id ON {table} (concept_id)").format(
+            table=table))
+    logging.info(f"Uploaded {len(ancestor_ids)} concept record counts")
+
+
+@instrument_stage("CreateConceptRecordCountTable")
 def main(args: List[str]):
     with open(args[0]) as file:
         config = yaml.safe_load(file)
@@ -22,6 +63,14 @@ def main(args: List[str]):
     os.makedirs(settings.log_folder, exist_ok=True)
     open_log(os.path.join(settings.log_folder, "logCreateConceptRecordCountTable.txt"))
 
+    file_names = settings.record_count_files or ["ConceptRecordCounts.csv"]
+    if settings.ancestor_cache_path:
+        create_table_locally(settings, file_names)
+        logging.info("Finished creating concept_record_count table")
+        return
+    if len(file_names) > 1:
+        raise Exception("Rolling up several count files requires ancestor_cache_path to be set")
+
     engine = create_engine(os.getenv("VOCAB_CONNECTION_STRING"))
     conn = engine.raw_connection()
     cursor = conn.cursor()
@@ -29,7 +78,7 @@ def main(args: List[str]):
     logging.info("Uploading observed concept counts to temp table")
     statement = sql.SQL("CREATE TEMP TABLE obs_concept_counts (concept_id INT PRIMARY KEY, record_count FLOAT);")
     cursor.execute(statement)
-    with open('ConceptRecordCounts.csv', 'r') as file:
+    with open(file_names[0], 'r') as file:
         with cursor.copy("COPY obs_concept_counts FROM STDIN WITH CSV HEADER") as copy:
             for line in file:
                 copy.write(line)
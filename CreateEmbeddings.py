@@ -1,94 +1,295 @@
+import hashlib
 import logging
 import os
 import sys
-from typing import List
+import time
+from typing import List, Optional, Dict, Iterator, Any
 
-import pyarrow as pa
-import pyarrow.parquet as pq
 import yaml
 from dotenv import load_dotenv
+import pyarrow as pa
 from numpy import ndarray
-from sqlalchemy import create_engine, select, MetaData, Table,  and_, case, cast, String
+from sqlalchemy import create_engine, select, MetaData, Table,  and_, case, cast, String, func, inspect, literal_column
 from sqlalchemy.engine import Engine
 
-from GenAIApi import get_embedding_vectors
+from EmbeddingBatchJobs import BatchEmbedder, get_batch_jobs_folder, has_unfinished_batch_jobs
+from EmbeddingCache import EmbeddingCache, get_cached_embedding_vectors
+from EmbeddingFiles import write_embedding_file, CONCEPT_COLUMNS
+from EmbeddingManifest import EmbeddingManifest
+from GenAIApi import get_embedding_vectors, get_embedding_model, BatchLimits, EmbeddingRequestStats
 from Settings import Settings
 from Logging import open_log
+from Metrics import instrument_stage, timer, increment
+from TermDeduplication import create_unique_terms, create_unique_terms_query
 
 load_dotenv()
 
 
-def create_query(engine: Engine, settings: Settings) -> select:
+def create_query(engine: Engine,
+                 settings: Settings,
+                 delta_only: bool = False,
+                 after_term_id: Optional[int] = None,
+                 last_term_id: Optional[int] = None) -> select:
     metadata = MetaData()
     terms = Table("terms", metadata, autoload_with=engine)
+    # The SQLite rowid is a stable term ID, used to record and resume progress:
+    term_id = literal_column("terms.rowid")
 
     query = select(
+        term_id.label("term_id"),
         terms.c.concept_id,
         terms.c.concept_name.label('term'),
         cast(
             case(
             (terms.c.source.in_(["synonym", "mapped synonym"]), "Synonym"),
             else_="Name"
-        ), String).label("term_type")
+        ), String).label("term_type"),
+        # Terms databases downloaded by older versions do not have the concept columns:
+        *[terms.c[name] for name in CONCEPT_COLUMNS if name in terms.c]
     )
     if not settings.include_synonyms:
         query = query.where(and_(terms.c.source != "synonym", terms.c.source != "mapped synonym"))
     if not settings.include_mapped_terms:
         query = query.where(and_(terms.c.source != "mapped", terms.c.source != "mapped synonym"))
-    return query
+    if delta_only:
+        # All terms of concepts that changed in the last incremental refresh. Unchanged terms of these concepts are
+        # included because the vector store replaces concepts as a whole:
+        delta_concepts = Table("delta_concepts", metadata, autoload_with=engine)
+        query = query.where(terms.c.concept_id.in_(select(delta_concepts.c.concept_id)))
+    if after_term_id is not None:
+        query = query.where(term_id > after_term_id)
+    if last_term_id is not None:
+        query = query.where(term_id <= last_term_id)
+    return query.order_by(term_id)
+
+
+def get_query_fingerprint(engine: Engine,
+                          query: select,
+                          dimensions: Optional[int] = None,
+                          deduplicated: bool = False) -> str:
+    """
+    Identifies the terms a query selects: the query itself, and the size of the terms table it reads from. When
+    vectors are requested with a specific number of dimensions, or for the unique texts of the terms, this is included
+    too.
+    """
+    sql = str(query.compile(engine, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as connection:
+        size = connection.execute(select(func.count(), func.max(literal_column("rowid"))).select_from(
+            Table("terms", MetaData(), autoload_with=engine))).one()
+    identity = f"{sql}|{size[0]}|{size[1]}"
+    if dimensions is not None:
+        identity += f"|{dimensions}"
+    if deduplicated:
+        identity += "|deduplicated"
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+def count_rows(engine: Engine, query: select) -> int:
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(query.subquery())).scalar()
 
 def store_in_parquet(concept_ids: List[int],
                      term_types: List[str],
                      embeddings: ndarray,
-                     file_name: str) -> None:
-    concept_id_array = pa.array(concept_ids)
-    term_type_array = pa.array(term_types)
-    embedding_arrays = [pa.array(embeddings[:, i]) for i in range(embeddings.shape[1])]
-
-    table = pa.Table.from_arrays(
-        arrays=[concept_id_array, term_type_array] + embedding_arrays,
-        names=["concept_id", "term_type"] + [f"embedding_{i}" for i in range(embeddings.shape[1])]
-    )
-    pq.write_table(table, file_name)
+                     file_name: str,
+                     vector_dtype: str = "float32",
+                     concept_columns: Optional[Dict[str, List[Optional[str]]]] = None) -> None:
+    columns = {"concept_id": concept_ids, "term_type": term_types}
+    if concept_columns:
+        # Typed explicitly, as a batch can have only NULL values (e.g. the standard_concept of mapped concepts):
+        columns.update({name: pa.array(values, type=pa.string()) for name, values in concept_columns.items()})
+    write_embedding_file(file_name=file_name,
+                         columns=columns,
+                         vectors=embeddings,
+                         vector_dtype=vector_dtype)
+
+
+def get_concept_columns(query: select) -> List[str]:
+    """
+    Returns the concept columns (domain_id, vocabulary_id, standard_concept) selected by the terms query.
+    """
+    return [name for name in CONCEPT_COLUMNS if name in query.selected_columns]
+
 
+def get_embedding_dtype(settings: Settings) -> str:
+    """
+    Vectors stored as float16 are cast to float16 as soon as they are decoded. Other types need the float32 vectors.
+    """
+    return "float16" if settings.parquet_vector_dtype == "float16" else "float32"
 
+
+@instrument_stage("CreateEmbeddings")
 def main(args: List[str]):
     with open(args[0]) as file:
         config = yaml.safe_load(file)
     settings = Settings(config)
     os.makedirs(settings.log_folder, exist_ok=True)
-    os.makedirs(settings.embeddings_folder, exist_ok=True)
     open_log(os.path.join(settings.log_folder, "logCreateEmbeddings.txt"))
 
     logging.info("Starting to create embedding vectors")
     engine = create_engine(f"sqlite:///{settings.terms_db_path}")
-    query = create_query(engine=engine, settings=settings)
+    delta_only = settings.incremental_refresh and inspect(engine).has_table("delta_concepts")
+    query = create_query(engine=engine, settings=settings, delta_only=delta_only)
+    concept_columns = get_concept_columns(query)
+    if delta_only:
+        embeddings_folder = settings.delta_embeddings_folder
+        full_count = count_rows(engine, create_query(engine=engine, settings=settings))
+        delta_count = count_rows(engine, query)
+        logging.info(f"Incremental refresh: embedding {delta_count} of {full_count} terms")
+    else:
+        embeddings_folder = settings.embeddings_folder
+    os.makedirs(embeddings_folder, exist_ok=True)
+    start_time = time.time()
+    fingerprint = get_query_fingerprint(engine, query, settings.dimensions, settings.deduplicate_terms)
+    if settings.deduplicate_terms:
+        if delta_only:
+            raise ValueError("deduplicate_terms cannot be combined with incremental_refresh")
+        term_count, text_count = create_unique_terms(engine, query)
+        increment("dedup_terms", term_count)
+        increment("dedup_unique_texts", text_count)
+        query = create_unique_terms_query(engine)
+
+    # Resume after the last shard recorded in the manifest:
+    manifest = EmbeddingManifest(embeddings_folder)
+    manifest.open(fingerprint)
+    last_term_id = manifest.last_term_id()
+    if last_term_id is not None:
+        logging.info(f"Resuming after term ID {last_term_id}, {manifest.row_count()} terms already embedded")
+        if settings.deduplicate_terms:
+            query = create_unique_terms_query(engine, after_text_id=last_term_id)
+        else:
+            query = create_query(engine=engine, settings=settings, delta_only=delta_only, after_term_id=last_term_id)
+
+    def write_shard(chunk: List[Any], vectors: ndarray) -> None:
+        first_term_id = chunk[0].term_id
+        last_term_id = chunk[-1].term_id
+        file_name = f"EmbeddingVectors_{first_term_id}_{last_term_id}.parquet"
+        file_path = os.path.join(embeddings_folder, file_name)
+        # Write to a temporary file first, so a crash never leaves a partial shard under the final name:
+        if settings.deduplicate_terms:
+            # The concepts of each text are in the concept_terms table of the terms database:
+            write_embedding_file(file_name=file_path + ".tmp",
+                                 columns={"text_id": [row.term_id for row in chunk]},
+                                 vectors=vectors,
+                                 vector_dtype=settings.parquet_vector_dtype)
+        else:
+            store_in_parquet(concept_ids=[row.concept_id for row in chunk],
+                             term_types=[row.term_type for row in chunk],
+                             embeddings=vectors,
+                             file_name=file_path + ".tmp",
+                             vector_dtype=settings.parquet_vector_dtype,
+                             concept_columns={name: [row._mapping[name] for row in chunk] for name in concept_columns})
+        os.replace(file_path + ".tmp", file_path)
+        manifest.add_shard(file_name, first_term_id, last_term_id, len(chunk))
+
+    jobs_folder = get_batch_jobs_folder(settings, embeddings_folder)
+    if settings.embedding_batch_mode:
+        if settings.embedding_cache_path:
+            raise ValueError("embedding_batch_mode cannot be combined with embedding_cache_path")
+
+        def read_chunks(after_term_id: Optional[int], last_term_id: Optional[int]) -> Iterator[List[Any]]:
+            if settings.deduplicate_terms:
+                range_query = create_unique_terms_query(engine, after_text_id=after_term_id, last_text_id=last_term_id)
+            else:
+                range_query = create_query(engine=engine,
+                                           settings=settings,
+                                           delta_only=delta_only,
+                                           after_term_id=after_term_id,
+                                           last_term_id=last_term_id)
+            with engine.connect() as connection:
+                result_proxy = connection.execute(range_query)
+                while True:
+                    with timer("terms_db_fetch_seconds"):
+                        chunk = result_proxy.fetchmany(settings.embedding_batch_size)
+                    if not chunk:
+                        break
+                    increment("terms_db_rows_fetched", len(chunk))
+                    yield chunk
 
-    total_count = 0
+        embedder = BatchEmbedder(settings=settings,
+                                 folder=jobs_folder,
+                                 manifest=manifest,
+                                 read_chunks=read_chunks,
+                                 write_shard=write_shard)
+        embedder.run()
+        logging.info(f"Finished creating embedding vectors in batch mode: {embedder.row_count} created, total "
+                     f"{manifest.row_count()}")
+        logging.info(f"Total cost: {embedder.total_cost}")
+        return
+    if has_unfinished_batch_jobs(jobs_folder):
+        raise ValueError(f"{jobs_folder} has unfinished batch jobs. Set embedding_batch_mode to finish them first")
+
+    cache = None
+    if settings.embedding_cache_path:
+        model, provider = get_embedding_model()
+        cache = EmbeddingCache(path=settings.embedding_cache_path,
+                               provider=provider,
+                               model=model,
+                               dimensions=settings.dimensions,
+                               max_size_mb=settings.embedding_cache_max_mb)
+
+    # Shared by all calls, so adaptive batch limits and request statistics carry over from one call to the next:
+    batch_limits = BatchLimits(max_items=settings.embedding_max_batch_items,
+                               max_tokens=settings.embedding_max_batch_tokens,
+                               adaptive=settings.embedding_adaptive_batching,
+                               target_latency=settings.embedding_target_latency)
+    request_stats = EmbeddingRequestStats()
+
+    total_count = manifest.row_count()
     total_cost = 0
+    # Chunks are embedded together, so their requests can be in flight concurrently:
+    pending = []
+
+    def embed_pending() -> float:
+        texts = [row.term[:settings.max_text_characters] for chunk in pending for row in chunk]
+        embed_args = dict(max_workers=settings.embedding_concurrency,
+                          requests_per_minute=settings.requests_per_minute,
+                          tokens_per_minute=settings.tokens_per_minute,
+                          max_retries=settings.embedding_max_retries,
+                          dimensions=settings.dimensions,
+                          batch_limits=batch_limits,
+                          stats=request_stats,
+                          vector_dtype=get_embedding_dtype(settings),
+                          encoding_format=settings.embedding_encoding_format)
+        if cache is None:
+            embeddings = get_embedding_vectors(texts, **embed_args)
+        else:
+            embeddings = get_cached_embedding_vectors(texts, cache, get_embedding_vectors, **embed_args)
+        offset = 0
+        for chunk in pending:
+            write_shard(chunk, embeddings["embeddings"][offset:offset + len(chunk)])
+            offset += len(chunk)
+        pending.clear()
+        if settings.embedding_stats_path:
+            request_stats.write(settings.embedding_stats_path)
+        return embeddings["usage"]["total_cost_usd"]
+
     with engine.connect() as connection:
         result_proxy = connection.execute(query)
         while True:
-            chunk = result_proxy.fetchmany(settings.embedding_batch_size)
+            with timer("terms_db_fetch_seconds"):
+                chunk = result_proxy.fetchmany(settings.embedding_batch_size)
             if not chunk:
                 break
-            file_name = f"EmbeddingVectors{total_count + 1}_{total_count + len(chunk)}.parquet"
-            file_name = os.path.join(settings.embeddings_folder, file_name)
-            if not os.path.isfile(file_name):
-                texts = [row.term for row in chunk]
-                concept_ids = [row.concept_id for row in chunk]
-                term_types = [row.term_type for row in chunk]
-                texts = [t[:settings.max_text_characters] for t in texts]
-                embeddings = get_embedding_vectors(texts)
-                total_cost = total_cost + embeddings["usage"]["total_cost_usd"]
-                store_in_parquet(concept_ids=concept_ids,
-                                 term_types=term_types,
-                                 embeddings=embeddings["embeddings"],
-                                 file_name=file_name)
+            increment("terms_db_rows_fetched", len(chunk))
+            pending.append(chunk)
+            if len(pending) >= settings.embedding_concurrency:
+                total_cost = total_cost + embed_pending()
             total_count += len(chunk)
             logging.info(f"Created {len(chunk)} embedding vectors, total: {total_count}")
+        if pending:
+            total_cost = total_cost + embed_pending()
+    if cache is not None:
+        cache.log_statistics()
+        cache.close()
     logging.info("Finished creating embedding vectors")
+    request_stats.log_summary()
     logging.info(f"Total cost: {total_cost}")
+    if delta_only and delta_count > 0:
+        seconds = time.time() - start_time
+        saved = seconds / delta_count * (full_count - delta_count)
+        logging.info(f"Incremental refresh took {seconds:.0f} seconds, saving an estimated {saved:.0f} seconds "
+                     f"compared to embedding all {full_count} terms")
 
 
 if __name__ == "__main__":
@@ -1,19 +1,33 @@
 import logging
 import os
+import shutil
+import sqlite3
+import queue
 import sys
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterator, Tuple, Optional, Any
 
+import psycopg
 import yaml
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, select, cast, String, union_all, MetaData, Table, Column, Integer, or_, func
+from psycopg import sql
+from sqlalchemy import create_engine, select, cast, String, union_all, MetaData, Table, Column, Integer, or_, func, text, inspect
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import aliased
 
+from LexicalSearch import create_lexical_index, LEXICAL_TOKENIZERS
 from Logging import open_log
+from Metrics import instrument_stage, timer, increment, observe
 from Settings import Settings
 
 load_dotenv()
 
+# The columns of the terms table. The domain, vocabulary, and standard_concept flag are those of the concept the term
+# belongs to:
+TERM_COLUMNS = ["concept_id", "concept_name", "source", "domain_id", "vocabulary_id", "standard_concept"]
+
 
 def create_query(engine: Engine,
                  settings: Settings) -> select:
@@ -40,7 +54,10 @@ def create_query(engine: Engine,
     query1 = select(
         concept.c.concept_id,
         concept.c.concept_name,
-        cast('name', String).label('source')
+        cast('name', String).label('source'),
+        concept.c.domain_id,
+        concept.c.vocabulary_id,
+        concept.c.standard_concept
     ).where(
         concept.c.standard_concept.in_(standard_concepts)
     )
@@ -64,9 +81,13 @@ def create_query(engine: Engine,
     query2 = select(
         concept_synonym.c.concept_id,
         concept_synonym.c.concept_synonym_name.label('concept_name'),
-        cast('synonym', String).label('source')
+        cast('synonym', String).label('source'),
+        standard_concept_ids.c.domain_id,
+        standard_concept_ids.c.vocabulary_id,
+        standard_concept_ids.c.standard_concept
+    ).join(
+        standard_concept_ids, concept_synonym.c.concept_id == standard_concept_ids.c.concept_id
     ).where(
-        concept_synonym.c.concept_id.in_(select(standard_concept_ids.c.concept_id)),
         concept_synonym.c.language_concept_id == 4180186  # Only include English synonyms
     )
 
@@ -84,19 +105,30 @@ def create_query(engine: Engine,
     query3 = select(
         concept.c.concept_id,
         concept.c.concept_name,
-        cast('mapped', String).label('source')
+        cast('mapped', String).label('source'),
+        concept.c.domain_id,
+        concept.c.vocabulary_id,
+        concept.c.standard_concept
     ).where(
         concept.c.concept_id.in_(select(mapped_concept_ids.c.concept_id)),
     ).group_by(
         concept.c.concept_id,
-        concept.c.concept_name
+        concept.c.concept_name,
+        concept.c.domain_id,
+        concept.c.vocabulary_id,
+        concept.c.standard_concept
     )
 
     # Get synonyms for mapped concepts
     query4 = select(
         concept_synonym.c.concept_id,
         concept_synonym.c.concept_synonym_name.label('concept_name'),
-        cast('mapped synonym', String).label('source')
+        cast('mapped synonym', String).label('source'),
+        concept.c.domain_id,
+        concept.c.vocabulary_id,
+        concept.c.standard_concept
+    ).join(
+        concept, concept_synonym.c.concept_id == concept.c.concept_id
     ).where(
         concept_synonym.c.concept_id.in_(select(mapped_concept_ids.c.concept_id)),
         concept_synonym.c.language_concept_id == 4180186  # Only include English synonyms
@@ -106,6 +138,357 @@ def create_query(engine: Engine,
     return final_query
 
 
+def _get_standard_concept_filter(settings: Settings) -> Tuple[sql.Composable, sql.Composable]:
+    """
+    Returns the join and the conditions selecting the standard concepts of create_query from the concept table.
+    """
+    schema = sql.Identifier(os.getenv("VOCAB_SCHEMA"))
+    standard_concepts = ['S']
+    if settings.include_classification_concepts:
+        standard_concepts.append('C')
+    conditions = [sql.SQL("concept.standard_concept = ANY({standard_concepts})").format(
+        standard_concepts=sql.Literal(standard_concepts))]
+    if settings.domain_ids:
+        conditions.append(sql.SQL("concept.domain_id = ANY({domain_ids})").format(
+            domain_ids=sql.Literal(settings.domain_ids)))
+    if settings.classification_vocabularies:
+        conditions.append(sql.SQL("(concept.standard_concept = 'S' OR concept.vocabulary_id = ANY({vocabularies}))").format(
+            vocabularies=sql.Literal(settings.classification_vocabularies)))
+    join = sql.SQL("")
+    if settings.restrict_to_used_concepts:
+        join = sql.SQL("INNER JOIN {schema}.concept_record_count ON concept.concept_id = concept_record_count.concept_id").format(
+            schema=schema)
+    return join, sql.SQL(" AND ").join(conditions)
+
+
+def _get_range_condition(column: str, id_range: Tuple[Optional[int], Optional[int]]) -> sql.Composable:
+    lower, upper = id_range
+    conditions = [sql.SQL("TRUE")]
+    if lower is not None:
+        conditions.append(sql.SQL("{column} >= {lower}").format(column=sql.SQL(column), lower=sql.Literal(lower)))
+    if upper is not None:
+        conditions.append(sql.SQL("{column} < {upper}").format(column=sql.SQL(column), upper=sql.Literal(upper)))
+    return sql.SQL(" AND ").join(conditions)
+
+
+def create_temp_tables(conn: psycopg.Connection, settings: Settings) -> None:
+    """
+    Materializes the IDs of the selected standard concepts, and of the concepts that map to them, in indexed temporary
+    tables, so the extraction query does not evaluate these subqueries more than once. Selects the same concepts as
+    create_query.
+    """
+    schema = sql.Identifier(os.getenv("VOCAB_SCHEMA"))
+    join, conditions = _get_standard_concept_filter(settings)
+    statements = [
+        sql.SQL("CREATE TEMPORARY TABLE standard_concept_ids AS "
+                "SELECT concept.concept_id, concept.concept_name, concept.domain_id, concept.vocabulary_id, "
+                "concept.standard_concept FROM {schema}.concept {join} WHERE {conditions}").format(
+            schema=schema,
+            join=join,
+            conditions=conditions),
+        sql.SQL("CREATE INDEX ON standard_concept_ids (concept_id)"),
+        sql.SQL("ANALYZE standard_concept_ids"),
+        sql.SQL("CREATE TEMPORARY TABLE mapped_concept_ids AS "
+                "SELECT DISTINCT concept_relationship.concept_id_1 AS concept_id "
+                "FROM {schema}.concept_relationship "
+                "INNER JOIN standard_concept_ids ON concept_relationship.concept_id_2 = standard_concept_ids.concept_id "
+                "WHERE concept_relationship.relationship_id = 'Maps to'").format(schema=schema),
+        sql.SQL("CREATE UNIQUE INDEX ON mapped_concept_ids (concept_id)"),
+        sql.SQL("ANALYZE mapped_concept_ids"),
+    ]
+    for statement in statements:
+        conn.execute(statement)
+
+
+def create_shard_temp_table(conn: psycopg.Connection,
+                            settings: Settings,
+                            source: str,
+                            id_range: Tuple[Optional[int], Optional[int]]) -> None:
+    """
+    Like create_temp_tables, but only creates the temporary table the branch of the terms query for the given source
+    reads, with only the concept IDs in the range [lower, upper). The concepts mapping to a standard concept are
+    selected by joining the concept table directly, so a shard never materializes all standard concepts.
+    """
+    schema = sql.Identifier(os.getenv("VOCAB_SCHEMA"))
+    join, conditions = _get_standard_concept_filter(settings)
+    if source in ("name", "synonym"):
+        statements = [
+            sql.SQL("CREATE TEMPORARY TABLE standard_concept_ids AS "
+                    "SELECT concept.concept_id, concept.concept_name, concept.domain_id, concept.vocabulary_id, "
+                    "concept.standard_concept FROM {schema}.concept {join} WHERE {conditions} AND {range}").format(
+                schema=schema,
+                join=join,
+                conditions=conditions,
+                range=_get_range_condition("concept.concept_id", id_range)),
+            sql.SQL("CREATE INDEX ON standard_concept_ids (concept_id)"),
+            sql.SQL("ANALYZE standard_concept_ids"),
+        ]
+    else:
+        statements = [
+            sql.SQL("CREATE TEMPORARY TABLE mapped_concept_ids AS "
+                    "SELECT DISTINCT concept_relationship.concept_id_1 AS concept_id "
+                    "FROM {schema}.concept_relationship "
+                    "INNER JOIN {schema}.concept ON concept_relationship.concept_id_2 = concept.concept_id {join} "
+                    "WHERE concept_relationship.relationship_id = 'Maps to' AND {conditions} AND {range}").format(
+                schema=schema,
+                join=join,
+                conditions=conditions,
+                range=_get_range_condition("concept_relationship.concept_id_1", id_range)),
+            sql.SQL("CREATE UNIQUE INDEX ON mapped_concept_ids (concept_id)"),
+            sql.SQL("ANALYZE mapped_concept_ids"),
+        ]
+    for statement in statements:
+        conn.execute(statement)
+
+
+# The branches of the terms query, by source, reading the concept IDs from the temporary tables:
+_BRANCH_QUERIES = {
+    "name":
+        "SELECT concept_id, concept_name, 'name' AS source, domain_id, vocabulary_id, standard_concept "
+        "FROM standard_concept_ids",
+    "synonym":
+        "SELECT concept_synonym.concept_id, concept_synonym.concept_synonym_name, 'synonym', "
+        "standard_concept_ids.domain_id, standard_concept_ids.vocabulary_id, standard_concept_ids.standard_concept "
+        "FROM {schema}.concept_synonym "
+        "INNER JOIN standard_concept_ids ON concept_synonym.concept_id = standard_concept_ids.concept_id "
+        "WHERE concept_synonym.language_concept_id = 4180186",
+    "mapped":
+        "SELECT concept.concept_id, concept.concept_name, 'mapped', "
+        "concept.domain_id, concept.vocabulary_id, concept.standard_concept "
+        "FROM {schema}.concept "
+        "INNER JOIN mapped_concept_ids ON concept.concept_id = mapped_concept_ids.concept_id",
+    "mapped synonym":
+        "SELECT concept_synonym.concept_id, concept_synonym.concept_synonym_name, 'mapped synonym', "
+        "concept.domain_id, concept.vocabulary_id, concept.standard_concept "
+        "FROM {schema}.concept_synonym "
+        "INNER JOIN mapped_concept_ids ON concept_synonym.concept_id = mapped_concept_ids.concept_id "
+        "INNER JOIN {schema}.concept ON concept_synonym.concept_id = concept.concept_id "
+        "WHERE concept_synonym.language_concept_id = 4180186",
+}
+
+
+def create_copy_statement(sources: Optional[List[str]] = None) -> sql.Composed:
+    """
+    The terms query of create_query, reading the concept IDs from the temporary tables created by create_temp_tables.
+    Only includes the branches of the given sources, if specified.
+    """
+    if sources is None:
+        sources = list(_BRANCH_QUERIES.keys())
+    query = " UNION ALL ".join(_BRANCH_QUERIES[source] for source in sources)
+    return sql.SQL(f"COPY ({query}) TO STDOUT (FORMAT BINARY)").format(
+        schema=sql.Identifier(os.getenv("VOCAB_SCHEMA")))
+
+
+def stream_terms(settings: Settings, batch_size: int) -> Iterator[List[Tuple[int, str, str, str, str, str]]]:
+    """
+    Streams the (concept_id, concept_name, source, domain_id, vocabulary_id, standard_concept) rows of the terms from
+    the vocabulary database using COPY, in batches of at most batch_size rows.
+    """
+    with psycopg.connect(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", "")) as source:
+        with timer("db_temp_tables_seconds"):
+            create_temp_tables(source, settings)
+        with source.cursor().copy(create_copy_statement()) as copy:
+            copy.set_types(["int4", "text", "text", "text", "text", "text"])
+            rows = []
+            # Only the time spent fetching is measured, not the time the consumer spends between batches:
+            start_time = time.perf_counter()
+            for row in copy.rows():
+                rows.append(row)
+                if len(rows) == batch_size:
+                    observe("db_fetch_seconds", time.perf_counter() - start_time)
+                    increment("db_rows_fetched", len(rows))
+                    yield rows
+                    rows = []
+                    start_time = time.perf_counter()
+            if rows:
+                observe("db_fetch_seconds", time.perf_counter() - start_time)
+                increment("db_rows_fetched", len(rows))
+                yield rows
+
+
+def open_terms_database(terms_db_path: str, new_database: bool) -> sqlite3.Connection:
+    """
+    Opens the SQLite database for bulk loading. The journal is turned off only when the database is new, so a failed
+    load never damages existing tables.
+    """
+    connection = sqlite3.connect(terms_db_path)
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA temp_store = MEMORY")
+    connection.execute("PRAGMA cache_size = -262144")
+    if new_database:
+        connection.execute("PRAGMA journal_mode = OFF")
+    return connection
+
+
+def download_terms_fast(settings: Settings, terms_table_name: str, new_database: bool) -> int:
+    """
+    Downloads the terms by streaming the result of a COPY statement into SQLite. The terms table must exist, and is
+    loaded in a single transaction.
+
+    Returns:
+        The number of terms downloaded.
+    """
+    target = open_terms_database(settings.terms_db_path, new_database)
+    insert_statement = (f"INSERT INTO {terms_table_name} ({', '.join(TERM_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(TERM_COLUMNS))})")
+    total_inserted = 0
+    next_log = 1000000
+    try:
+        target.execute("BEGIN")
+        for rows in stream_terms(settings, settings.download_batch_size):
+            with timer("terms_db_insert_seconds"):
+                target.executemany(insert_statement, rows)
+            increment("terms_db_rows_inserted", len(rows))
+            total_inserted += len(rows)
+            if total_inserted >= next_log:
+                logging.info(f"Total inserted: {total_inserted}")
+                next_log += 1000000
+        target.commit()
+    finally:
+        target.close()
+    logging.info(f"Inserted {total_inserted} rows")
+    return total_inserted
+
+
+def get_concept_id_ranges(settings: Settings, shards: int) -> List[Tuple[Optional[int], Optional[int]]]:
+    """
+    Splits the concept IDs into at most the given number of [lower, upper) ranges holding about the same number of
+    concepts, using quantiles of the concept IDs in the concept table. The first and last range are open-ended.
+    """
+    if shards <= 1:
+        return [(None, None)]
+    fractions = [i / shards for i in range(1, shards)]
+    with psycopg.connect(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", "")) as source:
+        boundaries = source.execute(
+            sql.SQL("SELECT percentile_disc({fractions}::float8[]) WITHIN GROUP (ORDER BY concept_id) "
+                    "FROM {schema}.concept").format(fractions=sql.Literal(fractions),
+                                                    schema=sql.Identifier(os.getenv("VOCAB_SCHEMA")))
+        ).fetchone()[0]
+    boundaries = sorted(set(boundary for boundary in boundaries or [] if boundary is not None))
+    lowers = [None] + boundaries
+    uppers = boundaries + [None]
+    return list(zip(lowers, uppers))
+
+
+def _extract_shard(settings: Settings,
+                   shard: Tuple[str, Tuple[Optional[int], Optional[int]]],
+                   shard_index: int,
+                   results: queue.Queue,
+                   cancel: threading.Event) -> None:
+    """
+    Streams the terms of one shard into the results queue as ("rows", shard_index, rows) messages, followed by
+    ("done", shard_index, None), or ("failed", shard_index, exception) if the extraction fails.
+    """
+
+    def put(message: Tuple[str, int, Any]) -> None:
+        # The queue is bounded, so stop waiting when the writer gave up:
+        while not cancel.is_set():
+            try:
+                results.put(message, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise Exception("Extraction cancelled")
+
+    source_name, id_range = shard
+    try:
+        with timer("extraction_shard_seconds"):
+            with psycopg.connect(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", "")) as source:
+                with timer("db_temp_tables_seconds"):
+                    create_shard_temp_table(source, settings, source_name, id_range)
+                with source.cursor().copy(create_copy_statement([source_name])) as copy:
+                    copy.set_types(["int4", "text", "text", "text", "text", "text"])
+                    rows = []
+                    start_time = time.perf_counter()
+                    for row in copy.rows():
+                        rows.append(row)
+                        if len(rows) == settings.download_batch_size:
+                            observe("db_fetch_seconds", time.perf_counter() - start_time)
+                            increment("db_rows_fetched", len(rows))
+                            put(("rows", shard_index, rows))
+                            rows = []
+                            start_time = time.perf_counter()
+                    if rows:
+                        observe("db_fetch_seconds", time.perf_counter() - start_time)
+                        increment("db_rows_fetched", len(rows))
+                        put(("rows", shard_index, rows))
+        put(("done", shard_index, None))
+    except Exception as e:
+        if not cancel.is_set():
+            put(("failed", shard_index, e))
+
+
+def download_terms_sharded(settings: Settings, terms_table_name: str, new_database: bool) -> int:
+    """
+    Downloads the terms like download_terms_fast, but splits the extraction into shards by branch of the terms query
+    (names, synonyms, mapped, and mapped synonyms) and by concept ID range, each streamed over its own connection by a
+    pool of extraction_shards threads. This thread is the single writer, inserting the rows into SQLite in a single
+    transaction as they arrive. The rows of a shard that fails are deleted, and the shard alone is retried up to
+    extraction_max_retries times.
+
+    Returns:
+        The number of terms downloaded.
+    """
+    ranges = get_concept_id_ranges(settings, settings.extraction_shards)
+    shards = [(source_name, id_range) for source_name in _BRANCH_QUERIES.keys() for id_range in ranges]
+    logging.info(f"Extracting terms in {len(shards)} shards ({len(ranges)} concept ID ranges per branch) using "
+                 f"{settings.extraction_shards} connections")
+    target = open_terms_database(settings.terms_db_path, new_database)
+    insert_statement = (f"INSERT INTO {terms_table_name} ({', '.join(TERM_COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(TERM_COLUMNS))})")
+    results = queue.Queue(maxsize=4 * settings.extraction_shards)
+    cancel = threading.Event()
+    attempts = [1] * len(shards)
+    inserted = [0] * len(shards)
+    remaining = len(shards)
+    total_inserted = 0
+    next_log = 1000000
+    try:
+        with ThreadPoolExecutor(max_workers=settings.extraction_shards) as executor:
+            try:
+                for shard_index, shard in enumerate(shards):
+                    executor.submit(_extract_shard, settings, shard, shard_index, results, cancel)
+                target.execute("BEGIN")
+                while remaining > 0:
+                    message, shard_index, payload = results.get()
+                    if message == "rows":
+                        with timer("terms_db_insert_seconds"):
+                            target.executemany(insert_statement, payload)
+                        increment("terms_db_rows_inserted", len(payload))
+                        inserted[shard_index] += len(payload)
+                        total_inserted += len(payload)
+                        if total_inserted >= next_log:
+                            logging.info(f"Total inserted: {total_inserted}")
+                            next_log += 1000000
+                    elif message == "done":
+                        remaining -= 1
+                    else:
+                        source_name, (lower, upper) = shards[shard_index]
+                        if attempts[shard_index] > settings.extraction_max_retries:
+                            raise Exception(f"Extracting the {source_name} terms with concept IDs in [{lower}, "
+                                            f"{upper}) failed after {attempts[shard_index]} attempts") from payload
+                        logging.warning(f"Extracting the {source_name} terms with concept IDs in [{lower}, {upper}) "
+                                        f"failed (attempt {attempts[shard_index]}): {payload}. Retrying")
+                        # All rows of the failed attempt were put in the queue before the failure, so are inserted:
+                        target.execute(
+                            f"DELETE FROM {terms_table_name} WHERE source = ? AND concept_id >= ? AND concept_id < ?",
+                            (source_name,
+                             -2 ** 31 if lower is None else lower,
+                             2 ** 31 if upper is None else upper))
+                        total_inserted -= inserted[shard_index]
+                        inserted[shard_index] = 0
+                        attempts[shard_index] += 1
+                        increment("extraction_shard_retries")
+                        executor.submit(_extract_shard, settings, shards[shard_index], shard_index, results, cancel)
+                target.commit()
+            finally:
+                cancel.set()
+    finally:
+        target.close()
+    logging.info(f"Inserted {total_inserted} rows")
+    return total_inserted
+
+
 def log_counts(target_engine: Engine, terms_table: Table):
     query = select(
         terms_table.c.source,
@@ -120,6 +503,62 @@ def log_counts(target_engine: Engine, terms_table: Table):
     logging.info("Finished logging counts")
 
 
+def create_term_indexes(target_engine: Engine):
+    """
+    Indexes the terms table. This is done after the download, as building an index at once is faster than
+    maintaining it while inserting.
+    """
+    with target_engine.begin() as connection:
+        # The index name moves with the table when it is renamed, so remove it from the previous snapshot:
+        connection.execute(text("DROP INDEX IF EXISTS idx_terms_concept_id"))
+        connection.execute(text("CREATE INDEX idx_terms_concept_id ON terms (concept_id)"))
+
+
+def create_delta(target_engine: Engine):
+    """
+    Compares the new terms with the previous snapshot, and stores the added and removed rows in the terms_added and
+    terms_removed tables, and the IDs of all concepts with added or removed terms in the delta_concepts table.
+    """
+    # A concept that moved to another domain must be re-embedded too, so its vectors move to the right partition. A
+    # previous snapshot downloaded before the terms had a domain can only be compared on the terms themselves:
+    columns = TERM_COLUMNS
+    if "domain_id" not in [column["name"] for column in inspect(target_engine).get_columns("terms_previous")]:
+        columns = TERM_COLUMNS[:3]
+    columns = ", ".join(columns)
+    statements = [
+        "DROP TABLE IF EXISTS terms_added",
+        "DROP TABLE IF EXISTS terms_removed",
+        "DROP TABLE IF EXISTS delta_concepts",
+        "CREATE TABLE terms_added AS "
+        f"SELECT {columns} FROM terms "
+        f"EXCEPT SELECT {columns} FROM terms_previous",
+        "CREATE TABLE terms_removed AS "
+        f"SELECT {columns} FROM terms_previous "
+        f"EXCEPT SELECT {columns} FROM terms",
+        "CREATE TABLE delta_concepts AS "
+        "SELECT concept_id FROM terms_added UNION SELECT concept_id FROM terms_removed",
+    ]
+    with target_engine.begin() as connection:
+        for statement in statements:
+            connection.execute(text(statement))
+        added = connection.execute(text("SELECT COUNT(*) FROM terms_added")).scalar()
+        removed = connection.execute(text("SELECT COUNT(*) FROM terms_removed")).scalar()
+        # A renamed term is a term that was removed and added for the same concept and source:
+        renamed = connection.execute(text(
+            "SELECT COUNT(*) FROM (SELECT DISTINCT a.concept_id, a.source FROM terms_added a "
+            "INNER JOIN terms_removed r ON a.concept_id = r.concept_id AND a.source = r.source)"
+        )).scalar()
+        concepts = connection.execute(text("SELECT COUNT(*) FROM delta_concepts")).scalar()
+        total = connection.execute(text("SELECT COUNT(*) FROM terms")).scalar()
+        affected = connection.execute(text(
+            "SELECT COUNT(*) FROM terms WHERE concept_id IN (SELECT concept_id FROM delta_concepts)"
+        )).scalar()
+    logging.info(f"Delta: {added} terms added, {removed} terms removed, {renamed} concept terms renamed")
+    share = 100.0 * affected / total if total > 0 else 0.0
+    logging.info(f"Delta: {concepts} concepts changed, {affected} of {total} terms ({share:.1f}%) must be re-embedded")
+
+
+@instrument_stage("DownloadTerms")
 def main(args: List[str]):
     with open(args[0]) as file:
         config = yaml.safe_load(file)
@@ -129,37 +568,77 @@ def main(args: List[str]):
     open_log(os.path.join(settings.log_folder, "logDownloadTerms.txt"))
 
     logging.info("Starting downloading vocabularies")
-    source_engine = create_engine(os.getenv("VOCAB_CONNECTION_STRING"))
-    query = create_query(engine=source_engine,
-                         settings=settings)
+    if settings.lexical_index is not None and settings.lexical_index not in LEXICAL_TOKENIZERS:
+        raise ValueError(f"lexical_index must be one of {list(LEXICAL_TOKENIZERS.keys())}")
 
     # Check if SQLite file already exists
+    incremental = False
     if os.path.exists(settings.terms_db_path):
-        raise FileExistsError(f"SQLite database file already exists at {settings.terms_db_path}")
+        if not settings.incremental_refresh:
+            raise FileExistsError(f"SQLite database file already exists at {settings.terms_db_path}")
+        incremental = True
 
     target_engine = create_engine(f"sqlite:///{settings.terms_db_path}")
+    # When refreshing, download into a new table, so the current terms stay intact if the download fails:
+    terms_table_name = "terms_new" if incremental else "terms"
     metadata = MetaData()
-    terms_table = Table('terms', metadata,
+    terms_table = Table(terms_table_name, metadata,
                         Column('concept_id', Integer),
                         Column('concept_name', String),
-                        Column('source', String))
+                        Column('source', String),
+                        Column('domain_id', String),
+                        Column('vocabulary_id', String),
+                        Column('standard_concept', String))
+    if incremental:
+        terms_table.drop(bind=target_engine, checkfirst=True)
     metadata.create_all(bind=target_engine, tables=[terms_table])
 
-    with source_engine.connect() as source_connection, target_engine.connect() as target_connection:
-        terms_result_set = source_connection.execution_options(stream_results=True).execute(query)
-        total_inserted = 0
-        while True:
-            chunk = terms_result_set.fetchmany(settings.download_batch_size)
-            if not chunk:
-                break
-            rows = [row._mapping for row in chunk]
-            with target_connection.begin() as transaction:
-                target_connection.execute(terms_table.insert(), rows)
-                transaction.commit()
-            total_inserted += len(rows)
-            logging.info(f"Inserted {len(rows)} rows, total inserted: {total_inserted}")
+    if settings.fast_extraction and settings.extraction_shards > 1:
+        download_terms_sharded(settings=settings,
+                               terms_table_name=terms_table_name,
+                               new_database=not incremental)
+    elif settings.fast_extraction:
+        download_terms_fast(settings=settings,
+                            terms_table_name=terms_table_name,
+                            new_database=not incremental)
+    else:
+        source_engine = create_engine(os.getenv("VOCAB_CONNECTION_STRING"))
+        query = create_query(engine=source_engine,
+                             settings=settings)
+        with source_engine.connect() as source_connection, target_engine.connect() as target_connection:
+            terms_result_set = source_connection.execution_options(stream_results=True).execute(query)
+            total_inserted = 0
+            while True:
+                with timer("db_fetch_seconds"):
+                    chunk = terms_result_set.fetchmany(settings.download_batch_size)
+                if not chunk:
+                    break
+                increment("db_rows_fetched", len(chunk))
+                rows = [row._mapping for row in chunk]
+                with timer("terms_db_insert_seconds"):
+                    with target_connection.begin() as transaction:
+                        target_connection.execute(terms_table.insert(), rows)
+                        transaction.commit()
+                increment("terms_db_rows_inserted", len(rows))
+                total_inserted += len(rows)
+                logging.info(f"Inserted {len(rows)} rows, total inserted: {total_inserted}")
     logging.info("Finished downloading vocabularies")
     log_counts(target_engine, terms_table)
+    if incremental:
+        # Keep the current terms as the previous snapshot to compare against:
+        with target_engine.begin() as connection:
+            connection.execute(text("DROP TABLE IF EXISTS terms_previous"))
+            connection.execute(text("ALTER TABLE terms RENAME TO terms_previous"))
+            connection.execute(text("ALTER TABLE terms_new RENAME TO terms"))
+    create_term_indexes(target_engine)
+    if settings.lexical_index is not None:
+        create_lexical_index(settings.terms_db_path, settings.lexical_index)
+    if incremental:
+        create_delta(target_engine)
+        # Vectors of an earlier delta no longer apply:
+        if settings.delta_embeddings_folder and os.path.isdir(settings.delta_embeddings_folder):
+            logging.info(f"Removing previous delta embeddings in {settings.delta_embeddings_folder}")
+            shutil.rmtree(settings.delta_embeddings_folder)
 
 
 if __name__ == "__main__":
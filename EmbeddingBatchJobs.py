@@ -0,0 +1,312 @@
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, asdict
+from typing import List, Optional, Callable, Iterator, Dict, Tuple, Any
+
+import numpy as np
+
+from EmbeddingManifest import EmbeddingManifest
+from GenAIApi import (get_embedding_model, create_embedding_batch_request, submit_embedding_batch,
+                      get_embedding_batch, read_embedding_batch_results, split_batch_requests)
+from Metrics import increment, observe
+from Settings import Settings
+
+# In batch mode, CreateEmbeddings writes the terms to embed to JSON-lines job files, submits them to the Batch API,
+# and writes the results to the embeddings folder as each job completes. The jobs are recorded in a state file in the
+# jobs folder, so a run can be stopped at any time and restarted without submitting a job twice. Each shard of terms
+# is split into requests identified by the custom ID '<first term ID>-<last term ID>-<offset>', so results are matched
+# to the terms by ID no matter in which order they come back.
+
+STATE_FILE_NAME = "BatchJobs.json"
+BATCH_JOBS_SUBFOLDER = "BatchJobs"
+
+_TERMINAL_STATUSES = ["completed", "failed", "expired", "cancelled"]
+
+# Job statuses:
+_WRITTEN = "written"
+_SUBMITTED = "submitted"
+_PROCESSED = "processed"
+_FAILED = "failed"
+
+
+@dataclass
+class BatchJob:
+    file: str
+    # The [first term ID, last term ID, row count] of each shard in the job:
+    shards: List[List[int]]
+    attempt: int = 0
+    batch_id: Optional[str] = None
+    submitted_at: Optional[float] = None
+    status: str = _WRITTEN
+
+
+def get_batch_jobs_folder(settings: Settings, embeddings_folder: str) -> str:
+    """
+    The jobs folder is batch_jobs_folder, or a subfolder of the embeddings folder.
+    """
+    if settings.batch_jobs_folder:
+        return settings.batch_jobs_folder
+    return os.path.join(embeddings_folder, BATCH_JOBS_SUBFOLDER)
+
+
+def has_unfinished_batch_jobs(folder: str) -> bool:
+    """
+    Returns True if a batch-mode run in the jobs folder has not finished yet. Its shards are not necessarily
+    consecutive, so it must be finished in batch mode.
+    """
+    state = BatchJobState(folder)
+    return any(job.status != _PROCESSED for job in state.jobs)
+
+
+class BatchJobState:
+    """
+    The batch jobs of an embeddings folder, persisted as a JSON file that is replaced atomically after each change.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.path = os.path.join(folder, STATE_FILE_NAME)
+        self.fingerprint: Optional[str] = None
+        self.last_term_id: Optional[int] = None
+        self.next_job_index = 1
+        self.jobs: List[BatchJob] = []
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as file:
+                state = json.load(file)
+            self.fingerprint = state["fingerprint"]
+            self.last_term_id = state["last_term_id"]
+            self.next_job_index = state["next_job_index"]
+            self.jobs = [BatchJob(**job) for job in state["jobs"]]
+
+    def open(self, fingerprint: str) -> None:
+        """
+        Starts a new state, or continues the existing one if it was created from the same query. Jobs written for
+        another query are discarded.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        if self.fingerprint != fingerprint:
+            if self.jobs:
+                logging.warning(f"Discarding {len(self.jobs)} batch jobs in {self.folder} created from another query")
+            for job in self.jobs:
+                self.remove_file(job)
+            self.fingerprint = fingerprint
+            self.last_term_id = None
+            self.next_job_index = 1
+            self.jobs = []
+            self.save()
+
+    def save(self) -> None:
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"fingerprint": self.fingerprint,
+                       "last_term_id": self.last_term_id,
+                       "next_job_index": self.next_job_index,
+                       "jobs": [asdict(job) for job in self.jobs]}, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    def new_file_name(self) -> str:
+        file_name = f"BatchJob_{self.next_job_index:05d}.jsonl"
+        self.next_job_index += 1
+        return file_name
+
+    def remove_file(self, job: BatchJob) -> None:
+        file_path = os.path.join(self.folder, job.file)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+class BatchEmbedder:
+    """
+    Creates the embedding vectors of the terms using Batch API jobs.
+
+    Args:
+        settings: The settings. Jobs are limited by batch_max_requests, batch_max_inputs, and batch_max_file_mb.
+        folder: The folder to keep the job files and state in.
+        manifest: The manifest of the embeddings folder, opened with the fingerprint of the query.
+        read_chunks: Reads the terms after a term ID (None for all), up to and including a last term ID (None for
+                     all), in chunks of embedding_batch_size rows.
+        write_shard: Writes the embedding vectors of a chunk of terms as a shard, and records it in the manifest.
+    """
+
+    def __init__(self,
+                 settings: Settings,
+                 folder: str,
+                 manifest: EmbeddingManifest,
+                 read_chunks: Callable[[Optional[int], Optional[int]], Iterator[List[Any]]],
+                 write_shard: Callable[[List[Any], np.ndarray], None]):
+        self.settings = settings
+        self.manifest = manifest
+        self.read_chunks = read_chunks
+        self.write_shard = write_shard
+        self.state = BatchJobState(folder)
+        self.state.open(manifest.fingerprint)
+        self.model, _ = get_embedding_model()
+        self.row_count = 0
+        self.total_cost = 0.0
+
+    def _write_jobs(self, chunks: Iterator[List[Any]], attempt: int, record_progress: bool) -> int:
+        """
+        Writes the chunks of terms to job files, starting a new job when the next shard would exceed a limit.
+
+        Returns:
+            The number of job files written.
+        """
+        settings = self.settings
+        max_bytes = settings.batch_max_file_mb * 1024 * 1024
+        job_count = 0
+        file = None
+        file_name = None
+        shards, requests, inputs, size = [], 0, 0, 0
+
+        def finish_job() -> None:
+            file.close()
+            file_path = os.path.join(self.state.folder, file_name)
+            os.replace(file_path + ".tmp", file_path)
+            self.state.jobs.append(BatchJob(file=file_name, shards=shards, attempt=attempt))
+            if record_progress:
+                self.state.last_term_id = shards[-1][1]
+            self.state.save()
+            increment("embedding_batch_jobs_written")
+
+        for chunk in chunks:
+            texts = [row.term[:settings.max_text_characters] for row in chunk]
+            first_term_id = chunk[0].term_id
+            last_term_id = chunk[-1].term_id
+            lines = []
+            for start, end in split_batch_requests(texts,
+                                                   settings.embedding_max_batch_items,
+                                                   settings.embedding_max_batch_tokens):
+                request = create_embedding_batch_request(custom_id=f"{first_term_id}-{last_term_id}-{start}",
+                                                         texts=texts[start:end],
+                                                         model=self.model,
+                                                         dimensions=settings.dimensions,
+                                                         encoding_format=settings.embedding_encoding_format)
+                lines.append((json.dumps(request) + "\n").encode("utf-8"))
+            chunk_size = sum(len(line) for line in lines)
+            if shards and (requests + len(lines) > settings.batch_max_requests or
+                           inputs + len(texts) > settings.batch_max_inputs or
+                           size + chunk_size > max_bytes):
+                finish_job()
+                job_count += 1
+                shards, requests, inputs, size = [], 0, 0, 0
+            if not shards:
+                file_name = self.state.new_file_name()
+                # Written to a temporary file first, so a crash never leaves a partial job under the final name:
+                file = open(os.path.join(self.state.folder, file_name + ".tmp"), "wb")
+            file.writelines(lines)
+            shards.append([first_term_id, last_term_id, len(chunk)])
+            requests += len(lines)
+            inputs += len(texts)
+            size += chunk_size
+        if shards:
+            finish_job()
+            job_count += 1
+        return job_count
+
+    def _read_shards(self, shards: List[List[int]]) -> Iterator[List[Any]]:
+        for first_term_id, last_term_id, _ in shards:
+            # Term IDs are integers, so the terms after first_term_id - 1 start at first_term_id:
+            yield [row for chunk in self.read_chunks(first_term_id - 1, last_term_id) for row in chunk]
+
+    def _submit(self, job: BatchJob) -> None:
+        job.batch_id = submit_embedding_batch(os.path.join(self.state.folder, job.file))
+        job.submitted_at = time.time()
+        job.status = _SUBMITTED
+        self.state.save()
+        logging.info(f"Submitted {job.file} as batch {job.batch_id}, with {len(job.shards)} shards")
+
+    def _process(self, job: BatchJob, batch: Dict[str, Any]) -> None:
+        """
+        Streams the results of a finished job, writing each shard as soon as all its vectors have arrived. Shards
+        with failed or missing requests are written to a retry job.
+        """
+        written = {(shard.first_term_id, shard.last_term_id) for shard in self.manifest.shards}
+        remaining = {(first, last): rows for first, last, rows in job.shards if (first, last) not in written}
+        received: Dict[Tuple[int, int], Dict[int, np.ndarray]] = {}
+        error_count = 0
+        for file_id in [batch["output_file_id"], batch["error_file_id"]]:
+            if file_id is None:
+                continue
+            for custom_id, vectors, cost, error in read_embedding_batch_results(file_id, self.settings.dimensions):
+                first_term_id, last_term_id, offset = (int(part) for part in custom_id.split("-"))
+                key = (first_term_id, last_term_id)
+                if key not in remaining:
+                    continue
+                if vectors is None:
+                    if error_count == 0:
+                        logging.warning(f"Request {custom_id} of batch {job.batch_id} failed: {error}")
+                    error_count += 1
+                    continue
+                self.total_cost += cost
+                parts = received.setdefault(key, {})
+                parts[offset] = vectors
+                if sum(len(part) for part in parts.values()) == remaining[key]:
+                    chunk = next(self._read_shards([[first_term_id, last_term_id, remaining[key]]]))
+                    if len(chunk) != remaining[key]:
+                        raise Exception(f"Expected {remaining[key]} terms from {first_term_id} to {last_term_id}, "
+                                        f"found {len(chunk)}. Has the terms database changed?")
+                    self.write_shard(chunk, np.concatenate([parts[offset] for offset in sorted(parts)]))
+                    self.row_count += len(chunk)
+                    del received[key]
+                    del remaining[key]
+        observe("embedding_batch_job_seconds", time.time() - job.submitted_at)
+        increment("embedding_batch_jobs_completed")
+        logging.info(f"Batch {job.batch_id} ({job.file}) {batch['status']}: {len(job.shards) - len(remaining)} of "
+                     f"{len(job.shards)} shards written, {error_count} failed requests")
+        failed = [[first, last, rows] for (first, last), rows in remaining.items()]
+        if failed and job.attempt < self.settings.embedding_max_retries:
+            increment("embedding_batch_shards_retried", len(failed))
+            logging.info(f"Retrying {len(failed)} shards of {job.file}")
+            self._write_jobs(self._read_shards(failed), attempt=job.attempt + 1, record_progress=False)
+            failed = []
+        job.shards = failed
+        job.status = _FAILED if failed else _PROCESSED
+        self.state.remove_file(job)
+        self.state.save()
+
+    def run(self) -> None:
+        """
+        Writes the jobs for the terms not in a job yet, then submits the jobs, keeping at most batch_max_jobs_in_flight
+        in flight, and processes them as they finish. Shards that failed in a previous run are retried.
+        """
+        settings = self.settings
+        for job in self.state.jobs:
+            if job.status == _FAILED:
+                logging.info(f"Retrying {len(job.shards)} shards of {job.file} that failed in a previous run")
+                self._write_jobs(self._read_shards(job.shards), attempt=0, record_progress=False)
+                job.status = _PROCESSED
+                self.state.save()
+        after_term_id = self.state.last_term_id
+        if after_term_id is None:
+            after_term_id = self.manifest.last_term_id()
+        job_count = self._write_jobs(self.read_chunks(after_term_id, None), attempt=0, record_progress=True)
+        logging.info(f"Wrote {job_count} new batch jobs to {self.state.folder}")
+
+        while True:
+            unfinished = [job for job in self.state.jobs if job.status in [_WRITTEN, _SUBMITTED]]
+            if not unfinished:
+                break
+            in_flight = sum(1 for job in unfinished if job.status == _SUBMITTED)
+            for job in unfinished:
+                if job.status == _WRITTEN and in_flight < settings.batch_max_jobs_in_flight:
+                    self._submit(job)
+                    in_flight += 1
+            finished = False
+            for job in unfinished:
+                if job.status != _SUBMITTED:
+                    continue
+                batch = get_embedding_batch(job.batch_id)
+                if batch["status"] in _TERMINAL_STATUSES:
+                    self._process(job, batch)
+                    finished = True
+            if not finished:
+                time.sleep(settings.batch_poll_seconds)
+
+        failed = [shard for job in self.state.jobs if job.status == _FAILED for shard in job.shards]
+        if failed:
+            raise Exception(f"{len(failed)} shards could not be embedded after {settings.embedding_max_retries} "
+                            f"retries. Rerun to retry them")
@@ -0,0 +1,190 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import unicodedata
+from typing import List, Optional, Dict, Any, Callable
+
+import numpy as np
+
+# SQLite limits the number of host parameters in a single statement:
+_LOOKUP_BATCH_SIZE = 500
+
+# Approximate per-entry storage overhead (key, timestamp, B-tree) on top of the vector itself:
+_ENTRY_OVERHEAD_BYTES = 64
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes a text for cache lookups: Unicode NFC, with leading, trailing and repeated whitespace removed. Case is
+    preserved, because embedding models are case-sensitive.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class EmbeddingCache:
+    """
+    A persistent, content-addressed cache of embedding vectors in a local SQLite database.
+
+    Entries are keyed by a hash of (provider, model, dimensions, normalized text), so the cache can be shared across
+    runs and vocabulary releases, and is never confused by a change of model. When the cache grows beyond its size
+    limit, the least recently used entries are evicted.
+    """
+
+    def __init__(self,
+                 path: str,
+                 provider: str,
+                 model: str,
+                 dimensions: Optional[int] = None,
+                 max_size_mb: Optional[int] = None):
+        self.provider = provider
+        self.model = model
+        self.dimensions = dimensions
+        self.max_size_bytes = None if max_size_mb is None else max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache (key BLOB PRIMARY KEY, vector BLOB, last_used INTEGER) "
+            "WITHOUT ROWID"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used "
+                                 "ON embedding_cache (last_used)")
+        self._connection.commit()
+        self._entry_count = self._connection.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+    def _key(self, normalized_text: str) -> bytes:
+        identity = "\0".join([self.provider, self.model, str(self.dimensions), normalized_text])
+        return hashlib.sha256(identity.encode("utf-8")).digest()
+
+    def lookup(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Looks up the vectors of a list of texts in bulk.
+
+        Args:
+            texts: List of texts to look up.
+
+        Returns:
+            A list aligned with the texts, holding the cached float32 vector, or None if the text is not cached.
+        """
+        keys = [self._key(normalize_text(text)) for text in texts]
+        found: Dict[bytes, np.ndarray] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), _LOOKUP_BATCH_SIZE):
+            batch = unique_keys[i:i + _LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._connection.execute(
+                f"SELECT key, vector FROM embedding_cache WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        if found:
+            now = int(time.time())
+            found_keys = list(found.keys())
+            for i in range(0, len(found_keys), _LOOKUP_BATCH_SIZE):
+                batch = found_keys[i:i + _LOOKUP_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                self._connection.execute(
+                    f"UPDATE embedding_cache SET last_used = ? WHERE key IN ({placeholders})", [now] + batch
+                )
+            self._connection.commit()
+        results = [found.get(key) for key in keys]
+        hits = sum(1 for result in results if result is not None)
+        self.hits += hits
+        self.misses += len(results) - hits
+        return results
+
+    def store(self, texts: List[str], vectors: np.ndarray) -> None:
+        """
+        Stores the vectors of a list of texts in bulk, evicting the least recently used entries if the cache
+        exceeds its size limit.
+        """
+        if len(texts) == 0:
+            return
+        now = int(time.time())
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        rows = [(self._key(normalize_text(text)), vectors[i].tobytes(), now) for i, text in enumerate(texts)]
+        cursor = self._connection.executemany(
+            "INSERT OR IGNORE INTO embedding_cache (key, vector, last_used) VALUES (?, ?, ?)", rows
+        )
+        self._entry_count += max(cursor.rowcount, 0)
+        self._connection.commit()
+        self._evict(vectors.shape[1] * 4)
+
+    def _evict(self, vector_bytes: int) -> None:
+        if self.max_size_bytes is None:
+            return
+        max_entries = self.max_size_bytes // (vector_bytes + _ENTRY_OVERHEAD_BYTES)
+        if self._entry_count <= max_entries:
+            return
+        # Evict down to 90% of the limit, so we do not have to evict again on every store:
+        to_remove = self._entry_count - int(max_entries * 0.9)
+        self._connection.execute(
+            "DELETE FROM embedding_cache WHERE key IN "
+            "(SELECT key FROM embedding_cache ORDER BY last_used LIMIT ?)", (to_remove,)
+        )
+        self._connection.commit()
+        self._entry_count -= to_remove
+        self.evictions += to_remove
+
+    def log_statistics(self) -> None:
+        total = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / total if total > 0 else 0.0
+        logging.info(f"Embedding cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+                     f"{self.evictions} evictions, {self._entry_count} entries")
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def get_cached_embedding_vectors(texts: List[str],
+                                 cache: EmbeddingCache,
+                                 embed_function: Callable[..., Dict[str, Any]],
+                                 **kwargs) -> Dict[str, Any]:
+    """
+    Generates embedding vectors for a list of texts, only sending texts to the API that are not in the cache.
+    Identical texts within the list are embedded only once.
+
+    Args:
+        texts: List of texts to generate embeddings for.
+        cache: The embedding cache.
+        embed_function: The function used to embed the cache misses, typically GenAIApi.get_embedding_vectors.
+        **kwargs: Additional arguments passed to the embed function.
+
+    Returns:
+        The same dictionary as GenAIApi.get_embedding_vectors, with the number of cache hits added to the usage.
+    """
+    cached = cache.lookup(texts)
+    missing: Dict[str, List[int]] = {}
+    for i, vector in enumerate(cached):
+        if vector is None:
+            missing.setdefault(normalize_text(texts[i]), []).append(i)
+    usage = {"input_tokens": 0, "output_tokens": 0, "reasoning_tokens": 0, "total_cost_usd": 0.0}
+    dtype = kwargs.get("vector_dtype", np.float32)
+    # The cache key does not include the precision, so the misses are embedded and cached as float32, and only the
+    # returned matrix is cast to the requested type:
+    embed_kwargs = dict(kwargs)
+    if "vector_dtype" in embed_kwargs:
+        embed_kwargs["vector_dtype"] = "float32"
+    if missing:
+        missing_texts = [texts[indices[0]] for indices in missing.values()]
+        result = embed_function(missing_texts, **embed_kwargs)
+        usage = result["usage"]
+        embedded = result["embeddings"]
+        cache.store(missing_texts, embedded)
+        for j, indices in enumerate(missing.values()):
+            for i in indices:
+                cached[i] = embedded[j]
+    embeddings = np.empty((len(texts), len(cached[0]) if texts else 0), dtype=dtype)
+    for i, vector in enumerate(cached):
+        embeddings[i] = vector
+    usage = dict(usage)
+    usage["cache_hits"] = len(texts) - sum(len(indices) for indices in missing.values())
+    return {"embeddings": embeddings, "usage": usage}
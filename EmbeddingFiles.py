@@ -0,0 +1,173 @@
+import os
+from typing import List, Dict, Any, Iterator, Tuple, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from EmbeddingManifest import EmbeddingManifest
+from Metrics import increment, timer
+from Quantization import quantize_int8, dequantize_int8
+
+# Version of the embedding Parquet layout, recorded in the file metadata:
+#   1: one float column per dimension ('embedding_0', 'embedding_1', ...). Files without a version are version 1.
+#   2: a single FixedSizeList<float32|float16|int8> column named 'embedding'. int8 vectors are scalar quantized, with
+#      the scale of each vector in the 'embedding_scale' column.
+FORMAT_VERSION_KEY = b"vocab_vector_format_version"
+FORMAT_VERSION = 2
+EMBEDDING_COLUMN = "embedding"
+EMBEDDING_SCALE_COLUMN = "embedding_scale"
+LEGACY_EMBEDDING_PREFIX = "embedding_"
+# Optional string attribute columns with the domain, vocabulary, and standard_concept flag of the concept of each
+# vector, used to partition the vector table by domain:
+CONCEPT_COLUMNS = ["domain_id", "vocabulary_id", "standard_concept"]
+
+VECTOR_DTYPES = {
+    "float32": (np.float32, pa.float32()),
+    "float16": (np.float16, pa.float16()),
+    "int8": (np.int8, pa.int8()),
+}
+
+
+def list_embedding_files(folder: str) -> List[str]:
+    """
+    Returns the names of the Parquet files in an embeddings folder. If the folder has a manifest, only the shards
+    recorded in the manifest are returned, in term ID order.
+    """
+    manifest = EmbeddingManifest(folder)
+    if manifest.exists():
+        return manifest.file_names()
+    return sorted([f for f in os.listdir(folder) if f.endswith(".parquet")])
+
+
+def get_format_version(schema: pa.Schema) -> int:
+    metadata = schema.metadata or {}
+    if FORMAT_VERSION_KEY in metadata:
+        return int(metadata[FORMAT_VERSION_KEY])
+    return 1
+
+
+def _legacy_embedding_columns(schema: pa.Schema) -> List[str]:
+    return [name for name in schema.names if name.startswith(LEGACY_EMBEDDING_PREFIX)]
+
+
+def get_vector_size(file_path: str) -> int:
+    """
+    Gets the number of dimensions of the vectors in an embedding Parquet file, in either layout.
+    """
+    schema = pq.read_schema(file_path)
+    if get_format_version(schema) >= 2:
+        return schema.field(EMBEDDING_COLUMN).type.list_size
+    return len(_legacy_embedding_columns(schema))
+
+
+def to_vector_array(vectors: np.ndarray, vector_dtype: str = "float32") -> pa.FixedSizeListArray:
+    """
+    Wraps a (rows x dimensions) matrix in a FixedSizeList array without copying when the matrix is already
+    contiguous and of the requested type. For int8, the matrix must already be quantized.
+    """
+    if vector_dtype not in VECTOR_DTYPES:
+        raise ValueError(f"vector_dtype must be one of {list(VECTOR_DTYPES.keys())}")
+    np_type, pa_type = VECTOR_DTYPES[vector_dtype]
+    vectors = np.ascontiguousarray(vectors, dtype=np_type)
+    values = pa.array(vectors.reshape(-1), type=pa_type)
+    return pa.FixedSizeListArray.from_arrays(values, vectors.shape[1])
+
+
+def write_embedding_file(file_name: str,
+                         columns: Dict[str, Any],
+                         vectors: np.ndarray,
+                         vector_dtype: str = "float32",
+                         row_group_size: Optional[int] = None) -> None:
+    """
+    Writes vectors and their attributes to a Parquet file using the current (version 2) layout.
+
+    Args:
+        file_name: Path of the Parquet file to write.
+        columns: The attribute columns (e.g. concept_id and term_type), as lists or arrays aligned with the vectors.
+        vectors: A (rows x dimensions) matrix of embedding vectors.
+        vector_dtype: Type used to store the vectors: 'float32', 'float16', or 'int8' (scalar quantized).
+        row_group_size: Maximum number of rows per row group. Defaults to the pyarrow default.
+    """
+    arrays = [pa.array(values) for values in columns.values()]
+    names = list(columns.keys())
+    if vector_dtype == "int8":
+        vectors, scales = quantize_int8(vectors)
+        arrays.append(pa.array(scales))
+        names.append(EMBEDDING_SCALE_COLUMN)
+    table = pa.Table.from_arrays(arrays=arrays + [to_vector_array(vectors, vector_dtype)],
+                                 names=names + [EMBEDDING_COLUMN])
+    table = table.replace_schema_metadata({FORMAT_VERSION_KEY: str(FORMAT_VERSION).encode()})
+    with timer("parquet_write_seconds"):
+        pq.write_table(table, file_name, row_group_size=row_group_size)
+    increment("parquet_rows_written", table.num_rows)
+    increment("parquet_bytes_written", os.path.getsize(file_name))
+
+
+def vectors_to_numpy(vector_column: Any) -> np.ndarray:
+    """
+    Converts a FixedSizeList column to a (rows x dimensions) NumPy matrix. This does not copy when the column
+    consists of a single chunk without nulls, which is the case when reading a single row group.
+    """
+    if isinstance(vector_column, pa.ChunkedArray):
+        if vector_column.num_chunks == 1:
+            vector_column = vector_column.chunk(0)
+        else:
+            vector_column = vector_column.combine_chunks()
+    dimensions = vector_column.type.list_size
+    return vector_column.flatten().to_numpy(zero_copy_only=False).reshape(-1, dimensions)
+
+
+def _split_table(table: pa.Table) -> Tuple[pa.Table, np.ndarray]:
+    if get_format_version(table.schema) >= 2:
+        vectors = vectors_to_numpy(table.column(EMBEDDING_COLUMN))
+        attributes = table.drop_columns([EMBEDDING_COLUMN])
+        if EMBEDDING_SCALE_COLUMN in table.column_names:
+            vectors = dequantize_int8(vectors, table.column(EMBEDDING_SCALE_COLUMN).to_numpy())
+            attributes = attributes.drop_columns([EMBEDDING_SCALE_COLUMN])
+    else:
+        embedding_columns = _legacy_embedding_columns(table.schema)
+        vectors = np.column_stack([table.column(name).to_numpy() for name in embedding_columns])
+        attributes = table.drop_columns(embedding_columns)
+    return attributes.replace_schema_metadata(None), vectors
+
+
+def read_embedding_batches(file_path: str) -> Iterator[Tuple[pa.Table, np.ndarray]]:
+    """
+    Reads an embedding Parquet file in either layout, one row group at a time.
+
+    Yields:
+        A tuple of a table with the attribute columns (e.g. concept_id and term_type), and a (rows x dimensions)
+        NumPy matrix of the vectors.
+    """
+    parquet_file = pq.ParquetFile(file_path)
+    for row_group_idx in range(parquet_file.num_row_groups):
+        row_group = parquet_file.read_row_group(row_group_idx)
+        # read_row_group drops the schema metadata, so restore it to detect the layout:
+        row_group = row_group.replace_schema_metadata(parquet_file.schema_arrow.metadata)
+        yield _split_table(row_group)
+
+
+def read_embedding_file(file_path: str) -> Tuple[pa.Table, np.ndarray]:
+    """
+    Reads an entire embedding Parquet file in either layout.
+
+    Returns:
+        A tuple of a table with the attribute columns, and a (rows x dimensions) NumPy matrix of the vectors.
+    """
+    return _split_table(pq.read_table(file_path))
+
+
+def convert_file(source_path: str, target_path: str, vector_dtype: str = "float32") -> int:
+    """
+    Converts an embedding Parquet file in any layout to the current layout.
+
+    Returns:
+        The number of rows converted.
+    """
+    attributes, vectors = read_embedding_file(source_path)
+    write_embedding_file(file_name=target_path,
+                         columns={name: attributes.column(name) for name in attributes.column_names},
+                         vectors=vectors,
+                         vector_dtype=vector_dtype)
+    return attributes.num_rows
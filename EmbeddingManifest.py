@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, asdict
+from typing import List, Optional
+
+MANIFEST_FILE_NAME = "manifest.jsonl"
+
+
+@dataclass
+class Shard:
+    file: str
+    first_term_id: int
+    last_term_id: int
+    row_count: int
+    sha256: str
+
+
+def file_checksum(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class EmbeddingManifest:
+    """
+    Records the Parquet shards in an embeddings folder: the range of term IDs each shard covers, its row count and
+    checksum. The manifest is a JSON-lines file that is appended to after each shard is completely written, so a
+    crashed run can resume after the last recorded term ID. The first line holds the fingerprint of the query the
+    shards were created from, so a resumed run with different settings is detected instead of silently mixing terms.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILE_NAME)
+        self.fingerprint: Optional[str] = None
+        self.shards: List[Shard] = []
+        self._truncated = False
+        if os.path.isfile(self.path):
+            self._read()
+
+    def _read(self) -> None:
+        with open(self.path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # An incomplete last line from a crash. The shard it describes will be recreated:
+                    self._truncated = True
+                    break
+                if record.get("type") == "header":
+                    self.fingerprint = record["fingerprint"]
+                else:
+                    self.shards.append(Shard(**{k: v for k, v in record.items() if k != "type"}))
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def open(self, fingerprint: str) -> None:
+        """
+        Starts a new manifest, or checks that an existing manifest was created from the same query.
+        """
+        if self.exists():
+            if self.fingerprint != fingerprint:
+                raise Exception(f"The shards in {self.folder} were created with different settings or from a "
+                                f"different terms database. Please use an empty embeddings folder.")
+            if self._truncated:
+                self._rewrite()
+            return
+        if any(f.endswith(".parquet") for f in os.listdir(self.folder)):
+            raise Exception(f"{self.folder} contains Parquet files but no manifest. Please use an empty "
+                            f"embeddings folder.")
+        self.fingerprint = fingerprint
+        self._rewrite()
+
+    def last_term_id(self) -> Optional[int]:
+        if len(self.shards) == 0:
+            return None
+        return max(shard.last_term_id for shard in self.shards)
+
+    def row_count(self) -> int:
+        return sum(shard.row_count for shard in self.shards)
+
+    def add_shard(self, file_name: str, first_term_id: int, last_term_id: int, row_count: int) -> Shard:
+        """
+        Records a shard that has been completely written to the folder.
+        """
+        shard = Shard(file=file_name,
+                      first_term_id=first_term_id,
+                      last_term_id=last_term_id,
+                      row_count=row_count,
+                      sha256=file_checksum(os.path.join(self.folder, file_name)))
+        with open(self.path, "a") as file:
+            file.write(json.dumps({"type": "shard", **asdict(shard)}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.shards.append(shard)
+        return shard
+
+    def replace_shards(self, shards: List[Shard]) -> None:
+        """
+        Replaces all recorded shards, for example after compaction. The manifest file is replaced atomically.
+        """
+        self.shards = list(shards)
+        self._rewrite()
+
+    def _rewrite(self) -> None:
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(json.dumps({"type": "header", "fingerprint": self.fingerprint}) + "\n")
+            for shard in self.shards:
+                file.write(json.dumps({"type": "shard", **asdict(shard)}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+    def file_names(self) -> List[str]:
+        return [shard.file for shard in sorted(self.shards, key=lambda shard: shard.first_term_id)]
+
+    def verify(self) -> List[str]:
+        """
+        Checks that all shards exist and match their checksums.
+
+        Returns:
+            A list of problems found. The list is empty if all shards are valid.
+        """
+        problems = []
+        for shard in self.shards:
+            file_path = os.path.join(self.folder, shard.file)
+            if not os.path.isfile(file_path):
+                problems.append(f"Missing shard {shard.file}")
+            elif file_checksum(file_path) != shard.sha256:
+                problems.append(f"Checksum mismatch for shard {shard.file}")
+        return problems
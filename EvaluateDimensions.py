@@ -0,0 +1,92 @@
+import logging
+import os
+import sys
+from typing import List
+
+import numpy as np
+import pyarrow.parquet as pq
+import yaml
+
+from EmbeddingFiles import list_embedding_files, read_embedding_batches
+from Logging import open_log
+from Metrics import instrument_stage
+from Quantization import truncate_vectors
+from Settings import Settings
+
+_DEFAULT_DIMENSIONS = [64, 128, 256, 512, 768, 1024, 1536, 2048, 3072]
+
+
+def sample_vectors(folder: str, sample_size: int, seed: int = 0) -> np.ndarray:
+    """
+    Reads a uniform random sample of the vectors in an embeddings folder.
+    """
+    file_paths = [os.path.join(folder, file_name) for file_name in list_embedding_files(folder)]
+    row_count = sum(pq.ParquetFile(file_path).metadata.num_rows for file_path in file_paths)
+    rng = np.random.default_rng(seed)
+    selected = np.sort(rng.choice(row_count, size=min(sample_size, row_count), replace=False))
+    sample = []
+    offset = 0
+    for file_path in file_paths:
+        for _, vectors in read_embedding_batches(file_path):
+            rows = selected[(selected >= offset) & (selected < offset + len(vectors))] - offset
+            if len(rows) > 0:
+                sample.append(np.asarray(vectors[rows], dtype=np.float32))
+            offset += len(vectors)
+    return np.vstack(sample)
+
+
+def _nearest(queries: np.ndarray, corpus: np.ndarray, query_rows: np.ndarray, k: int) -> np.ndarray:
+    # The queries are part of the corpus, so exclude each query itself:
+    scores = queries @ corpus.T
+    scores[np.arange(len(query_rows)), query_rows] = -np.inf
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def evaluate(folder: str,
+             dimensions: List[int],
+             query_count: int = 1000,
+             corpus_size: int = 50000,
+             k: int = 10,
+             query_batch_size: int = 100) -> None:
+    """
+    Compares the top-k neighbours of a sample of terms using the vectors truncated to each number of dimensions with
+    those using the full vectors, and logs the overlap.
+    """
+    corpus = sample_vectors(folder, corpus_size)
+    full_dimensions = corpus.shape[1]
+    corpus /= np.maximum(np.linalg.norm(corpus, axis=1, keepdims=True), 1e-12)
+    query_rows = np.random.default_rng(1).choice(len(corpus), size=min(query_count, len(corpus)), replace=False)
+    logging.info(f"Comparing the {k} nearest neighbours of {len(query_rows)} terms among {len(corpus)} terms to "
+                 f"those using all {full_dimensions} dimensions")
+
+    truth = np.vstack([_nearest(corpus[query_rows[i:i + query_batch_size]], corpus,
+                                query_rows[i:i + query_batch_size], k)
+                       for i in range(0, len(query_rows), query_batch_size)])
+    for d in sorted(d for d in dimensions if d < full_dimensions):
+        truncated = truncate_vectors(corpus, d)
+        nearest = np.vstack([_nearest(truncated[query_rows[i:i + query_batch_size]], truncated,
+                                      query_rows[i:i + query_batch_size], k)
+                             for i in range(0, len(query_rows), query_batch_size)])
+        overlap = np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(nearest, truth)])
+        logging.info(f"{d} dimensions: top-{k} overlap {overlap:.3f}, vector {4 * d + 8} bytes, halfvec "
+                     f"{2 * d + 8} bytes per term")
+
+
+@instrument_stage("EvaluateDimensions")
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = Settings(config)
+    os.makedirs(settings.log_folder, exist_ok=True)
+    open_log(os.path.join(settings.log_folder, "logEvaluateDimensions.txt"))
+
+    evaluate(folder=settings.embeddings_folder,
+             dimensions=settings.evaluation_dimensions or _DEFAULT_DIMENSIONS,
+             query_count=int(args[1]) if len(args) > 1 else 1000)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        raise Exception("Must provide path to yaml file, and optionally the number of terms to sample, as arguments")
+    else:
+        main(sys.argv[1:])
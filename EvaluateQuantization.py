@@ -0,0 +1,88 @@
+import logging
+import os
+import sys
+import time
+from typing import List
+
+import numpy as np
+import yaml
+
+from Logging import open_log
+from Metrics import instrument_stage
+from Quantization import QUANTIZATIONS
+from Settings import Settings
+from VectorSearch import (LocalVectorIndex, quantize_local_index, VECTORS_FILE, INT8_VECTORS_FILE, INT8_SCALES_FILE,
+                          BINARY_VECTORS_FILE)
+
+
+def _recall(results: List[List[dict]], truth: List[List[dict]]) -> float:
+    hits = 0
+    total = 0
+    for result, expected in zip(results, truth):
+        expected_keys = {(hit["concept_id"], hit["term_type"]) for hit in expected}
+        hits += len(expected_keys.intersection((hit["concept_id"], hit["term_type"]) for hit in result))
+        total += len(expected_keys)
+    return hits / total
+
+
+def _file_size(index_folder: str, file_names: List[str]) -> int:
+    return sum(os.path.getsize(os.path.join(index_folder, file_name)) for file_name in file_names)
+
+
+def evaluate(settings: Settings, query_count: int = 1000, k: int = 10, seed: int = 0) -> None:
+    """
+    Compares the quantization modes on the local index: the size of the matrix that is scanned per query, the time
+    to build it, the search time, and the recall@k relative to exact search on the full vectors, with and without
+    re-ranking. The queries are index vectors with added noise, so they are near, but not equal to, a term.
+    """
+    index_folder = settings.local_index_folder
+    full_index = LocalVectorIndex(index_folder)
+    n, dimensions = full_index.vectors.shape
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(full_index.vectors[np.sort(rng.choice(n, size=min(query_count, n), replace=False))],
+                         dtype=np.float32)
+    queries += rng.normal(scale=0.5 / np.sqrt(dimensions), size=queries.shape).astype(np.float32)
+
+    search_args = {"k": k, "block_size": settings.local_search_block_size, "threads": settings.local_search_threads}
+    start_time = time.time()
+    truth = full_index.search(queries, **search_args)
+    full_seconds = time.time() - start_time
+    logging.info(f"Evaluating on {n} vectors of {dimensions} dimensions, using {len(queries)} queries, k = {k}")
+    logging.info(f"full ({full_index.vectors.dtype}): scanned {_file_size(index_folder, [VECTORS_FILE]) / 2**20:.1f} "
+                 f"MB, search {full_seconds:.2f} s, recall 1.000")
+
+    files = {"int8": [INT8_VECTORS_FILE, INT8_SCALES_FILE], "binary": [BINARY_VECTORS_FILE]}
+    for quantization in QUANTIZATIONS:
+        start_time = time.time()
+        quantize_local_index(index_folder, quantization)
+        build_seconds = time.time() - start_time
+        index = LocalVectorIndex(index_folder, quantization=quantization)
+        size = _file_size(index_folder, files[quantization]) / 2**20
+        for rerank_candidates in [k, settings.rerank_candidates]:
+            start_time = time.time()
+            results = index.search(queries, rerank_candidates=rerank_candidates, **search_args)
+            seconds = time.time() - start_time
+            logging.info(f"{quantization} (re-ranking {rerank_candidates} candidates): scanned {size:.1f} MB, build "
+                         f"{build_seconds:.2f} s, search {seconds:.2f} s, recall {_recall(results, truth):.3f}")
+
+    # Storage per vector in pgvector, excluding the row and index overhead:
+    logging.info(f"pgvector storage per vector: vector {4 * dimensions + 8} bytes, halfvec {2 * dimensions + 8} "
+                 f"bytes, bit {(dimensions + 7) // 8 + 8} bytes")
+
+
+@instrument_stage("EvaluateQuantization")
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = Settings(config)
+    os.makedirs(settings.log_folder, exist_ok=True)
+    open_log(os.path.join(settings.log_folder, "logEvaluateQuantization.txt"))
+
+    evaluate(settings, query_count=int(args[1]) if len(args) > 1 else 1000)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        raise Exception("Must provide path to yaml file, and optionally the number of queries, as arguments")
+    else:
+        main(sys.argv[1:])
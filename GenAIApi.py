@@ -1,11 +1,20 @@
+import base64
 import json
+import logging
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
-from openai import OpenAI
-from typing import List, Optional, Dict, Any, Tuple
+from openai import OpenAI, RateLimitError, InternalServerError, APIConnectionError, APIStatusError, NOT_GIVEN
+from typing import List, Optional, Dict, Any, Tuple, Iterator
 from dotenv import load_dotenv
 
+from Metrics import increment, observe, timer
+from Quantization import truncate_vectors
+
 load_dotenv()
 
 _PRICING_TABLE = {
@@ -16,15 +25,25 @@ _PRICING_TABLE = {
     "local": {"input": 0.00, "output": 0.00},
 }
 
+# Rough number of characters per token for English text, used to budget tokens before a request is sent:
+_CHARACTERS_PER_TOKEN = 4
+
+# Requests sent through the Batch API cost half as much:
+_BATCH_PRICE_FACTOR = 0.5
+
+# Backoff (in seconds) when retrying rate-limited or failed requests:
+_BACKOFF_BASE = 1.0
+_BACKOFF_MAX = 60.0
 
 
 class _AIClientFactory:
 
     @staticmethod
-    def get_client(task_type: str = "llm") -> Tuple[Any, str, str]:
+    def get_client(task_type: str = "llm", max_retries: int = 2) -> Tuple[Any, str, str]:
         """
         Args:
         task_type: 'llm' or 'embedding'
+        max_retries: Number of retries performed by the client itself. Set to 0 when retrying in the caller.
 
         Returns:
             client: Configured AI client
@@ -48,18 +67,28 @@ class _AIClientFactory:
                 base_url=endpoint,
                 default_query={"api-version": os.getenv("AZURE_OPENAI_API_VERSION")},
                 default_headers={"api-key": api_key},
+                max_retries=max_retries,
             )
             return client, model_name, "azure"
         elif provider == "lm-studio":
             endpoint = os.getenv("LM_STUDIO_ENDPOINT")
-            client = OpenAI(base_url=endpoint, api_key="lm-studio")
+            client = OpenAI(base_url=endpoint, api_key="lm-studio", max_retries=max_retries)
             return client, model_name, "local"
 
         else:  # OpenAI Direct
-            client = OpenAI(api_key=api_key)
+            client = OpenAI(api_key=api_key, max_retries=max_retries)
             return client, model_name, "openai"
 
 
+def get_embedding_model() -> Tuple[str, str]:
+    """
+    Returns the name of the embedding model and the provider type ('openai', 'azure', or 'local') that
+    get_embedding_vectors will use.
+    """
+    _, model, provider = _AIClientFactory.get_client(task_type="embedding")
+    return model, provider
+
+
 def _calculate_cost(model_name: str, input_tok: int, output_tok: int, provider_type: str) -> float:
     if provider_type == "local":
         return 0.0
@@ -75,41 +104,432 @@ def _calculate_cost(model_name: str, input_tok: int, output_tok: int, provider_t
     )
 
 
-def get_embedding_vectors(texts: List[str]) -> Dict[str, Any]:
+class _RateLimiter:
+    """
+    Token-bucket throttle shared by all worker threads, enforcing a requests-per-minute and a tokens-per-minute
+    budget. The buckets hold 10 seconds worth of budget, because providers such as Azure evaluate their per-minute
+    quota over short windows.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        self._lock = threading.Lock()
+        self._budgets = {}
+        if requests_per_minute:
+            self._budgets["requests"] = requests_per_minute / 60.0
+        if tokens_per_minute:
+            self._budgets["tokens"] = tokens_per_minute / 60.0
+        self._capacity = {key: rate * 10.0 for key, rate in self._budgets.items()}
+        self._available = dict(self._capacity)
+        self._last_update = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+        for key, rate in self._budgets.items():
+            self._available[key] = min(self._capacity[key], self._available[key] + elapsed * rate)
+
+    def acquire(self, tokens: int) -> None:
+        """
+        Blocks until one request using the given number of tokens fits in the budgets.
+        """
+        if not self._budgets:
+            return
+        needed = {"requests": 1.0, "tokens": float(tokens)}
+        while True:
+            with self._lock:
+                self._refill()
+                wait = 0.0
+                for key, rate in self._budgets.items():
+                    # A single request larger than the bucket can never fit, so only wait for a full bucket:
+                    amount = min(needed[key], self._capacity[key])
+                    if self._available[key] < amount:
+                        wait = max(wait, (amount - self._available[key]) / rate)
+                if wait == 0.0:
+                    for key in self._budgets:
+                        self._available[key] -= min(needed[key], self._capacity[key])
+                    return
+            time.sleep(wait)
+
+
+def _estimate_tokens(texts: List[str]) -> int:
+    return sum(_estimate_text_tokens(text) for text in texts)
+
+
+def _estimate_text_tokens(text: str) -> int:
+    return len(text) // _CHARACTERS_PER_TOKEN + 1
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (RateLimitError, InternalServerError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def _backoff_delay(attempt: int, error: Exception) -> float:
+    # Respect the server's Retry-After header when present, otherwise use exponential backoff with full jitter:
+    if isinstance(error, APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after) + random.uniform(0, _BACKOFF_BASE)
+            except ValueError:
+                pass
+    return random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2 ** attempt))
+
+
+class BatchLimits:
+    """
+    The maximum number of texts and estimated tokens per embedding request. When adaptive, the limits follow an
+    additive-increase, multiplicative-decrease scheme: they are halved after a request fails with a server or
+    connection error, or is slower than the target latency, and grow by a tenth of the maximum after each other
+    request. Rate-limited (429) requests do not change the limits. Pass the same instance to consecutive calls of
+    get_embedding_vectors to keep what was learned.
+    """
+
+    def __init__(self,
+                 max_items: int = 100,
+                 max_tokens: Optional[int] = None,
+                 adaptive: bool = False,
+                 target_latency: Optional[float] = None):
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self._lock = threading.Lock()
+        self._scale = 1.0
+
+    def limits(self) -> Tuple[int, Optional[int]]:
+        """
+        Returns the current maximum number of texts and (if set) estimated tokens per request.
+        """
+        with self._lock:
+            scale = self._scale
+        items = max(1, int(self.max_items * scale))
+        tokens = None if self.max_tokens is None else max(1, int(self.max_tokens * scale))
+        return items, tokens
+
+    def record_success(self, latency: float) -> None:
+        if not self.adaptive:
+            return
+        with self._lock:
+            if self.target_latency is not None and latency > self.target_latency:
+                self._decrease()
+            else:
+                self._scale = min(1.0, self._scale + 0.1)
+
+    def record_failure(self) -> None:
+        if not self.adaptive:
+            return
+        with self._lock:
+            self._decrease()
+
+    def _decrease(self) -> None:
+        self._scale = max(1.0 / self.max_items, self._scale / 2)
+
+
+class EmbeddingRequestStats:
+    """
+    Collects the size, token use, latency, and cost of each embedding request, to tune the batch limits and
+    concurrency against the limits of a deployment. Can be shared by threads and consecutive calls.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: List[Dict[str, Any]] = []
+        self._written = 0
+
+    def add(self, request: Dict[str, Any]) -> None:
+        with self._lock:
+            self.requests.append(request)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = list(self.requests)
+        if not requests:
+            return {"requests": 0}
+        latencies = np.array([request["latency"] for request in requests])
+        tokens = np.array([request["prompt_tokens"] for request in requests])
+        estimated = sum(request["estimated_tokens"] for request in requests)
+        return {
+            "requests": len(requests),
+            "texts": sum(request["texts"] for request in requests),
+            "retries": sum(request["retries"] for request in requests),
+            "prompt_tokens": int(tokens.sum()),
+            "mean_texts_per_request": sum(request["texts"] for request in requests) / len(requests),
+            "mean_tokens_per_request": float(tokens.mean()),
+            "max_tokens_per_request": int(tokens.max()),
+            "estimated_to_actual_tokens": estimated / max(1, int(tokens.sum())),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "latency_max": float(latencies.max()),
+            "total_cost_usd": sum(request["cost_usd"] for request in requests),
+        }
+
+    def log_summary(self) -> None:
+        summary = self.summary()
+        if summary["requests"] == 0:
+            return
+        logging.info(f"Embedding requests: {summary['requests']} requests ({summary['retries']} retries), "
+                     f"{summary['mean_texts_per_request']:.1f} texts and {summary['mean_tokens_per_request']:.0f} "
+                     f"tokens per request (max {summary['max_tokens_per_request']}), latency p50 "
+                     f"{summary['latency_p50']:.2f} s, p95 {summary['latency_p95']:.2f} s, max "
+                     f"{summary['latency_max']:.2f} s, estimated / actual tokens "
+                     f"{summary['estimated_to_actual_tokens']:.2f}, cost {summary['total_cost_usd']:.4f} USD")
+
+    def write(self, path: str) -> None:
+        """
+        Appends the statistics of the requests that were not written before to a JSON-lines file.
+        """
+        with self._lock:
+            requests = self.requests[self._written:]
+            self._written = len(self.requests)
+        with open(path, "a") as file:
+            for request in requests:
+                file.write(json.dumps(request) + "\n")
+
+
+def _pack_batches(token_counts: List[int], max_items: int, max_tokens: Optional[int]) -> List[List[int]]:
+    """
+    Packs texts into batches of at most max_items texts and max_tokens estimated tokens, taking the texts shortest
+    first so that batches of short texts fill up to max_items and long texts are grouped together. A text that is
+    larger than max_tokens on its own gets a batch of its own.
+
+    Returns:
+        The indices of the texts in each batch.
+    """
+    order = sorted(range(len(token_counts)), key=lambda i: token_counts[i])
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i in order:
+        if batch and (len(batch) >= max_items or
+                      (max_tokens is not None and batch_tokens + token_counts[i] > max_tokens)):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += token_counts[i]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def split_batch_requests(texts: List[str], max_items: int, max_tokens: Optional[int]) -> List[Tuple[int, int]]:
+    """
+    Splits texts into consecutive requests of at most max_items texts and max_tokens estimated tokens, keeping the
+    texts in order so a request is identified by its offset. A text that is larger than max_tokens on its own gets a
+    request of its own.
+
+    Returns:
+        The (start, end) indices of the texts of each request.
+    """
+    requests = []
+    start = 0
+    request_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = _estimate_text_tokens(text)
+        if i > start and (i - start >= max_items or (max_tokens is not None and request_tokens + tokens > max_tokens)):
+            requests.append((start, i))
+            start = i
+            request_tokens = 0
+        request_tokens += tokens
+    if start < len(texts):
+        requests.append((start, len(texts)))
+    return requests
+
+
+def _decode_embeddings(data: List[Any]) -> np.ndarray:
+    """
+    Decodes the embeddings of a response into a (texts x dimensions) float32 matrix. Base64 embeddings are
+    little-endian float32 buffers, and are copied straight into the matrix. Providers that ignore the encoding format
+    return lists of floats instead.
+    """
+    vectors = None
+    for i, item in enumerate(data):
+        # Items of batch job results are parsed from JSON, so are dictionaries:
+        embedding = item["embedding"] if isinstance(item, dict) else item.embedding
+        if isinstance(embedding, str):
+            vector = np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+        else:
+            vector = embedding
+        if vectors is None:
+            vectors = np.empty((len(data), len(vector)), dtype=np.float32)
+        vectors[i] = vector
+    return vectors
+
+
+def _create_embeddings(client: Any,
+                       model: str,
+                       provider: str,
+                       batch: List[str],
+                       rate_limiter: _RateLimiter,
+                       max_retries: int,
+                       dimensions: Optional[int] = None,
+                       batch_limits: Optional[BatchLimits] = None,
+                       stats: Optional[EmbeddingRequestStats] = None,
+                       encoding_format: str = "base64") -> Tuple[np.ndarray, int]:
+    estimated_tokens = _estimate_tokens(batch)
+    attempt = 0
+    while True:
+        with timer("embedding_throttle_seconds"):
+            rate_limiter.acquire(estimated_tokens)
+        start_time = time.time()
+        try:
+            response = client.embeddings.create(input=batch,
+                                                model=model,
+                                                dimensions=NOT_GIVEN if dimensions is None else dimensions,
+                                                encoding_format=encoding_format)
+            break
+        except Exception as e:
+            increment("embedding_request_failures")
+            # Rate limiting is handled by the backoff, and smaller batches would only mean more requests:
+            if batch_limits is not None and not isinstance(e, RateLimitError):
+                batch_limits.record_failure()
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            delay = _backoff_delay(attempt, e)
+            logging.warning(f"Embedding request failed ({type(e).__name__}), retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+            attempt += 1
+            increment("embedding_request_retries")
+    latency = time.time() - start_time
+    observe("embedding_request_seconds", latency)
+    if batch_limits is not None:
+        batch_limits.record_success(latency)
+    data = sorted(response.data, key=lambda x: x.index)
+    np_vectors = _decode_embeddings(data)
+    if dimensions is not None:
+        # Some providers (e.g. local models) ignore the dimensions parameter:
+        np_vectors = truncate_vectors(np_vectors, dimensions)
+    prompt_tokens = response.usage.prompt_tokens
+    cost = _calculate_cost(model, prompt_tokens, 0, provider)
+    increment("embedding_requests")
+    increment("embedding_texts", len(batch))
+    increment("embedding_prompt_tokens", prompt_tokens)
+    increment("embedding_cost_usd", cost)
+    if stats is not None:
+        stats.add({"time": start_time,
+                   "texts": len(batch),
+                   "estimated_tokens": estimated_tokens,
+                   "prompt_tokens": prompt_tokens,
+                   "latency": latency,
+                   "retries": attempt,
+                   "cost_usd": cost})
+    return np_vectors, prompt_tokens
+
+
+def get_embedding_vectors(texts: List[str],
+                          max_workers: int = 1,
+                          requests_per_minute: Optional[int] = None,
+                          tokens_per_minute: Optional[int] = None,
+                          max_retries: int = 5,
+                          dimensions: Optional[int] = None,
+                          batch_limits: Optional[BatchLimits] = None,
+                          stats: Optional[EmbeddingRequestStats] = None,
+                          vector_dtype: str = "float32",
+                          encoding_format: str = "base64") -> Dict[str, Any]:
     """
     Generates embedding vectors for a list of texts using the embedding-specific config.
 
     Args:
         texts: List of texts to generate embeddings for.
+        max_workers: Maximum number of embedding requests in flight at the same time.
+        requests_per_minute: Optional requests-per-minute budget to throttle against.
+        tokens_per_minute: Optional tokens-per-minute budget to throttle against.
+        max_retries: Maximum number of retries of a request after a 429 or 5xx response.
+        dimensions: Optional number of dimensions to request. Vectors returned wider than this are truncated and
+                    L2-renormalized.
+        batch_limits: The maximum number of texts and estimated tokens per request. Defaults to 100 texts.
+        stats: Optional collector of the statistics of each request.
+        vector_dtype: Type of the returned vectors: 'float32', or 'float16' to halve their memory.
+        encoding_format: Encoding of the vectors in the responses. 'base64' is decoded straight into float32 arrays,
+                         'float' can be used for providers that do not support base64.
 
     Returns:
         A dictionary containing:
-            - "embeddings": A numpy array of embedding vectors.
+            - "embeddings": A numpy array of embedding vectors, in the same order as the texts.
             - "usage": A dictionary with token usage and cost details.
     """
 
-    client, model, provider = _AIClientFactory.get_client(task_type="embedding")
+    client, model, provider = _AIClientFactory.get_client(task_type="embedding", max_retries=0)
+    rate_limiter = _RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+    if batch_limits is None:
+        batch_limits = BatchLimits()
+
+    token_counts = [_estimate_text_tokens(text) for text in texts]
+    if batch_limits.max_tokens is not None:
+        too_long = sum(1 for count in token_counts if count > batch_limits.max_tokens)
+        if too_long > 0:
+            logging.warning(f"{too_long} texts are estimated to exceed {batch_limits.max_tokens} tokens, and are "
+                            f"sent in requests of their own")
+    # Texts are taken shortest first. Each worker packs its next batch using the limits at that moment, so adaptive
+    # limits take effect immediately:
+    order = sorted(range(len(texts)), key=lambda i: token_counts[i])
+    cursor = [0]
+    cursor_lock = threading.Lock()
+    verbose = len(texts) > batch_limits.max_items
+    results = []
+    # Set when a worker fails, so the other workers stop taking batches whose vectors would be thrown away:
+    failed = threading.Event()
+
+    def next_batch() -> List[int]:
+        with cursor_lock:
+            if failed.is_set():
+                return []
+            max_items, max_tokens = batch_limits.limits()
+            remaining = [token_counts[i] for i in order[cursor[0]:cursor[0] + max_items]]
+            size = len(_pack_batches(remaining, max_items, max_tokens)[0]) if remaining else 0
+            # The remaining texts are sorted, so the first packed batch is a prefix:
+            batch = order[cursor[0]:cursor[0] + size]
+            cursor[0] += size
+            if verbose and batch:
+                print(f"Getting embedding vectors for {len(batch)} texts ({cursor[0]} of {len(texts)})")
+            return batch
 
-    batch_size = 100
-    verbose = len(texts) > batch_size
-    batch_results = []
-    total_tokens = 0
-    for i in range(0, len(texts), batch_size):
-        # if i != 9400:
-        #     continue
-        batch = texts[i : i + batch_size]
-        if verbose:
-            print(f"Getting embedding vectors for batch {i + 1} - {i + len(batch)} ({len(texts)} total)")
-        response = client.embeddings.create(input=batch, model=model)
-        data = sorted(response.data, key=lambda x: x.index)
-        np_vectors = np.array([item.embedding for item in data])
-        batch_results.append(np_vectors)
-        usage = response.usage
-        total_tokens = total_tokens + usage.prompt_tokens
+    def embed_batches() -> None:
+        while True:
+            batch = next_batch()
+            if not batch:
+                return
+            try:
+                vectors, tokens = _create_embeddings(client=client,
+                                                     model=model,
+                                                     provider=provider,
+                                                     batch=[texts[i] for i in batch],
+                                                     rate_limiter=rate_limiter,
+                                                     max_retries=max_retries,
+                                                     dimensions=dimensions,
+                                                     batch_limits=batch_limits,
+                                                     stats=stats,
+                                                     encoding_format=encoding_format)
+            except Exception:
+                failed.set()
+                raise
+            with cursor_lock:
+                results.append((batch, vectors, tokens))
+
+    workers = max(1, min(max_workers, len(texts)))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(embed_batches) for _ in range(workers)]
+            for future in as_completed(futures):
+                future.result()
+    else:
+        embed_batches()
+    total_tokens = sum(tokens for _, _, tokens in results)
     total_cost = _calculate_cost(model, total_tokens, 0, provider)
 
+    # Put the vectors back in the order of the texts, casting one batch at a time:
+    if results:
+        embeddings = np.empty((len(texts), results[0][1].shape[1]), dtype=vector_dtype)
+        for batch, vectors, _ in results:
+            embeddings[batch] = vectors
+    else:
+        embeddings = np.empty((0, 0), dtype=vector_dtype)
+
     return {
-        "embeddings": np.concatenate(batch_results, axis=0),
+        "embeddings": embeddings,
         "usage": {
             "input_tokens": total_tokens,
             "output_tokens": 0,
@@ -120,6 +540,82 @@ def get_embedding_vectors(texts: List[str]) -> Dict[str, Any]:
     }
 
 
+def create_embedding_batch_request(custom_id: str,
+                                   texts: List[str],
+                                   model: str,
+                                   dimensions: Optional[int] = None,
+                                   encoding_format: str = "base64") -> Dict[str, Any]:
+    """
+    Creates one line of a Batch API job file: an embeddings request for the texts, identified by the custom ID.
+    """
+    body = {"model": model, "input": texts, "encoding_format": encoding_format}
+    if dimensions is not None:
+        body["dimensions"] = dimensions
+    return {"custom_id": custom_id, "method": "POST", "url": "/v1/embeddings", "body": body}
+
+
+def submit_embedding_batch(file_path: str) -> str:
+    """
+    Uploads a JSON-lines job file of embeddings requests, and creates a Batch API job for it.
+
+    Returns:
+        The ID of the batch job.
+    """
+    client, _, _ = _AIClientFactory.get_client(task_type="embedding")
+    with open(file_path, "rb") as file:
+        uploaded = client.files.create(file=file, purpose="batch")
+    batch = client.batches.create(input_file_id=uploaded.id, endpoint="/v1/embeddings", completion_window="24h")
+    increment("embedding_batch_jobs_submitted")
+    return batch.id
+
+
+def get_embedding_batch(batch_id: str) -> Dict[str, Any]:
+    """
+    Returns the status of a Batch API job ('validating', 'in_progress', 'finalizing', 'completed', 'failed', 'expired',
+    'cancelling', or 'cancelled'), and the IDs of its output and error files once it has them.
+    """
+    client, _, _ = _AIClientFactory.get_client(task_type="embedding")
+    batch = client.batches.retrieve(batch_id)
+    return {"status": batch.status,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+            "request_counts": batch.request_counts.model_dump() if batch.request_counts is not None else None}
+
+
+def read_embedding_batch_results(file_id: str,
+                                 dimensions: Optional[int] = None
+                                 ) -> Iterator[Tuple[str, Optional[np.ndarray], float, str]]:
+    """
+    Streams the results in an output or error file of a Batch API job, one line at a time.
+
+    Returns:
+        An iterator of (custom_id, vectors, cost, error) tuples, where vectors is a (texts x dimensions) float32
+        matrix in the order of the texts of the request, or None if the request failed, in which case error describes
+        why. The cost is in USD, at the Batch API price.
+    """
+    client, model, provider = _AIClientFactory.get_client(task_type="embedding")
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            record = json.loads(line)
+            result = record.get("response")
+            if record.get("error") or result is None or result.get("status_code") != 200:
+                error = record.get("error") or (result or {}).get("body", {}).get("error") or result
+                increment("embedding_batch_requests_failed")
+                yield record["custom_id"], None, 0.0, str(error)
+                continue
+            body = result["body"]
+            vectors = _decode_embeddings(sorted(body["data"], key=lambda item: item["index"]))
+            if dimensions is not None:
+                vectors = truncate_vectors(vectors, dimensions)
+            prompt_tokens = body["usage"]["prompt_tokens"]
+            cost = _calculate_cost(model, prompt_tokens, 0, provider) * _BATCH_PRICE_FACTOR
+            increment("embedding_texts", len(body["data"]))
+            increment("embedding_prompt_tokens", prompt_tokens)
+            increment("embedding_cost_usd", cost)
+            yield record["custom_id"], vectors, cost, ""
+
 
 if __name__ == "__main__":
     texts = ["Acute Myocardial Infarction", "Liver Failure"]
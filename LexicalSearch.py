@@ -0,0 +1,190 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+from EmbeddingCache import normalize_text
+from Metrics import timer
+from Settings import Settings
+
+# An FTS5 index over the concept_name column of the terms table, stored in the terms database next to it. The index
+# is an external content table, so it does not store a second copy of the terms:
+FTS_TABLE = "terms_fts"
+
+# The FTS5 tokenizers that can be selected with lexical_index. 'porter' matches words, including other inflections of
+# the same word, and 'trigram' matches any substring of at least three characters:
+LEXICAL_TOKENIZERS = {
+    "porter": "porter unicode61 remove_diacritics 2",
+    "trigram": "trigram",
+}
+
+# Maximum number of FTS matches examined for exact and prefix hits, shortest terms first:
+_LOOKUP_CANDIDATES = 1000
+
+
+def create_lexical_index(terms_db_path: str, tokenizer: str) -> int:
+    """
+    (Re)creates the FTS5 index over the terms table. This must be done after the terms table is (re)created, as the
+    index refers to the terms by rowid.
+
+    Returns:
+        The number of terms indexed.
+    """
+    if tokenizer not in LEXICAL_TOKENIZERS:
+        raise ValueError(f"lexical_index must be one of {list(LEXICAL_TOKENIZERS.keys())}")
+    start_time = time.time()
+    connection = sqlite3.connect(terms_db_path)
+    try:
+        connection.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+        connection.execute(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(concept_name, content='terms', "
+                           f"content_rowid='rowid', tokenize='{LEXICAL_TOKENIZERS[tokenizer]}')")
+        connection.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES('rebuild')")
+        connection.commit()
+        count = connection.execute("SELECT COUNT(*) FROM terms").fetchone()[0]
+    finally:
+        connection.close()
+    logging.info(f"Created {tokenizer} lexical index over {count} terms in {time.time() - start_time:.1f} seconds")
+    return count
+
+
+def _quote(text: str) -> str:
+    # An FTS5 string, in which a double quote is escaped by doubling it:
+    return '"' + text.replace('"', '""') + '"'
+
+
+class LexicalSearch:
+    """
+    Searches the FTS5 index over the terms database created by DownloadTerms with lexical_index. Selects the same
+    terms as CreateEmbeddings, so it finds the same concepts and term types as the vector store. Each thread gets its
+    own read-only connection.
+
+    Args:
+        settings: The settings. The terms database is read from terms_db_path.
+    """
+
+    def __init__(self, settings: Settings):
+        self.terms_db_path = settings.terms_db_path
+        if not os.path.exists(self.terms_db_path):
+            raise FileNotFoundError(f"Terms database not found at {self.terms_db_path}")
+        sources = ["name"]
+        if settings.include_synonyms:
+            sources.append("synonym")
+        if settings.include_mapped_terms:
+            sources.append("mapped")
+        if settings.include_synonyms and settings.include_mapped_terms:
+            sources.append("mapped synonym")
+        self.sources = sources
+        self._local = threading.local()
+        definition = self._connect().execute("SELECT sql FROM sqlite_master WHERE name = ?", (FTS_TABLE,)).fetchone()
+        if definition is None:
+            raise ValueError("The terms database has no lexical index. Set lexical_index and rerun DownloadTerms")
+        self.trigram = "tokenize='trigram'" in definition[0]
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.terms_db_path}?mode=ro", uri=True)
+            self._local.connection = connection
+        return connection
+
+    def _match(self, match: str, limit: int, order_by: str, domain_id: Optional[str]) -> List[tuple]:
+        # bm25 is lower for better matches, so it is negated to get a score where higher is better:
+        statement = (f"SELECT terms.concept_id, terms.concept_name, terms.source, -bm25({FTS_TABLE}) "
+                     f"FROM {FTS_TABLE} "
+                     f"INNER JOIN terms ON terms.rowid = {FTS_TABLE}.rowid "
+                     f"WHERE {FTS_TABLE} MATCH ? AND terms.source IN ({', '.join('?' * len(self.sources))})")
+        parameters = [match] + self.sources
+        if domain_id is not None:
+            statement += " AND terms.domain_id = ?"
+            parameters.append(domain_id)
+        statement += f" ORDER BY {order_by} LIMIT ?"
+        parameters.append(limit)
+        try:
+            return self._connect().execute(statement, parameters).fetchall()
+        except sqlite3.OperationalError as e:
+            # For example a query without any searchable token:
+            logging.debug(f"Lexical query {match} failed: {e}")
+            return []
+
+    @staticmethod
+    def _get_term_type(source: str) -> str:
+        # As assigned by CreateEmbeddings:
+        return "Synonym" if source in ("synonym", "mapped synonym") else "Name"
+
+    def lookup(self, texts: List[str], k: int = 10, domain_id: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Finds the terms equal to each query string, and the terms starting with it, comparing the texts normalized as
+        for the embedding cache, ignoring case. Does not embed anything.
+
+        Returns:
+            For each query, at most k hits with concept_id, term, term_type, and match ('exact' or 'prefix'), exact
+            hits first and then the shortest prefix hits. A concept is returned once, with its best term.
+        """
+        results = []
+        with timer("lexical_lookup_seconds"):
+            for text in texts:
+                query = normalize_text(text).lower()
+                if self.trigram:
+                    # A trigram phrase matches the terms containing the text, so also the terms starting with it:
+                    match = _quote(query)
+                else:
+                    match = _quote(query) + " *"
+                rows = self._match(match, _LOOKUP_CANDIDATES, "length(terms.concept_name)", domain_id)
+                exact, prefix = [], []
+                for concept_id, term, source, _ in rows:
+                    normalized = normalize_text(term).lower()
+                    if normalized == query:
+                        exact.append((concept_id, term, source, "exact"))
+                    elif normalized.startswith(query):
+                        prefix.append((concept_id, term, source, "prefix"))
+                hits = []
+                seen = set()
+                for concept_id, term, source, match_type in exact + prefix:
+                    if concept_id in seen:
+                        continue
+                    seen.add(concept_id)
+                    hits.append({"concept_id": concept_id,
+                                 "term": term,
+                                 "term_type": self._get_term_type(source),
+                                 "match": match_type})
+                    if len(hits) == k:
+                        break
+                results.append(hits)
+        return results
+
+    def search(self, texts: List[str], k: int = 10, domain_id: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Ranks the terms matching any word of each query string (or any trigram-sized substring with the trigram
+        tokenizer) by BM25. Does not embed anything.
+
+        Returns:
+            For each query, at most k hits with concept_id, term, term_type, and score (the BM25 score, higher is
+            better). A concept is returned once, with its best term.
+        """
+        results = []
+        with timer("lexical_search_seconds"):
+            for text in texts:
+                tokens = re.findall(r"\w+", normalize_text(text).lower())
+                if self.trigram:
+                    tokens = [token for token in tokens if len(token) >= 3]
+                hits = []
+                if tokens:
+                    match = " OR ".join(_quote(token) for token in dict.fromkeys(tokens))
+                    # More rows than k, as a concept can have several matching terms:
+                    rows = self._match(match, 4 * k, f"bm25({FTS_TABLE})", domain_id)
+                    seen = set()
+                    for concept_id, term, source, score in rows:
+                        if concept_id in seen:
+                            continue
+                        seen.add(concept_id)
+                        hits.append({"concept_id": concept_id,
+                                     "term": term,
+                                     "term_type": self._get_term_type(source),
+                                     "score": score})
+                        if len(hits) == k:
+                            break
+                results.append(hits)
+        return results
@@ -0,0 +1,281 @@
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Callable, List, Iterator
+
+import yaml
+
+from Settings import Settings
+
+# A process-wide registry of counters and latency histograms, written as JSON lines and as a Prometheus textfile to the
+# log folder. Library code records metrics unconditionally, which is cheap; they are only written by scripts whose
+# main function is wrapped in instrument_stage.
+
+_PROMETHEUS_PREFIX = "vocab_vector_"
+
+# Upper bounds in seconds of the latency histogram buckets, like the Prometheus client defaults, plus a few longer
+# buckets for slow API calls and index builds:
+_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+PROFILE_MODES = ["cprofile", "sampling"]
+_SAMPLE_INTERVAL = 0.01
+
+
+class _Histogram:
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimates a quantile from the buckets, by linear interpolation within the bucket it falls in.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(_BUCKETS, self.bucket_counts):
+            if count > 0 and cumulative + count >= rank:
+                return round(min(lower + (bound - lower) * (rank - cumulative) / count, self.max), 6)
+            cumulative += count
+            lower = bound
+        return round(self.max, 6)
+
+    def summary(self) -> Dict[str, Any]:
+        return {"count": self.count,
+                "sum": round(self.sum, 6),
+                "mean": round(self.sum / self.count, 6) if self.count else None,
+                "p50": self.quantile(0.5),
+                "p95": self.quantile(0.95),
+                "p99": self.quantile(0.99),
+                "max": round(self.max, 6)}
+
+
+class _Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, _Histogram] = {}
+        self.stage: Optional[str] = None
+        self.folder: Optional[str] = None
+        self.start_time = time.time()
+
+    def reset(self, stage: str, folder: str) -> None:
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.stage = stage
+            self.folder = folder
+            self.start_time = time.time()
+
+    def increment(self, name: str, value: float) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = _Histogram()
+            self.histograms[name].observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"time": round(time.time(), 3),
+                    "stage": self.stage,
+                    "elapsed_seconds": round(time.time() - self.start_time, 3),
+                    "counters": dict(self.counters),
+                    "histograms": {name: histogram.summary() for name, histogram in self.histograms.items()}}
+
+    def prometheus_text(self) -> str:
+        labels = f'{{stage="{self.stage}"}}'
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {_PROMETHEUS_PREFIX}{name}_total counter")
+                lines.append(f"{_PROMETHEUS_PREFIX}{name}_total{labels} {value}")
+            for name, histogram in sorted(self.histograms.items()):
+                metric = _PROMETHEUS_PREFIX + name
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(_BUCKETS, histogram.bucket_counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{stage="{self.stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{stage="{self.stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric}_sum{labels} {histogram.sum}")
+                lines.append(f"{metric}_count{labels} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+_registry = _Registry()
+
+
+def increment(name: str, value: float = 1) -> None:
+    """
+    Adds a value to a counter, such as the number of rows fetched or the cost of the embedding requests.
+    """
+    _registry.increment(name, value)
+
+
+def observe(name: str, seconds: float) -> None:
+    """
+    Records a duration in the latency histogram with the given name.
+    """
+    _registry.observe(name, seconds)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    """
+    Records the duration of the block in the latency histogram with the given name, also when the block raises.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registry.observe(name, time.perf_counter() - start_time)
+
+
+def get_snapshot() -> Dict[str, Any]:
+    return _registry.snapshot()
+
+
+def write_metrics(final: bool = False) -> None:
+    """
+    Appends a snapshot of all metrics to metrics<stage>.jsonl in the log folder, and replaces the Prometheus textfile
+    metrics<stage>.prom.
+    """
+    if _registry.folder is None:
+        return
+    snapshot = _registry.snapshot()
+    snapshot["final"] = final
+    base_path = os.path.join(_registry.folder, f"metrics{_registry.stage}")
+    with open(base_path + ".jsonl", "a", encoding="utf-8") as file:
+        file.write(json.dumps(snapshot) + "\n")
+    # Written under a temporary name first, so a collector never reads a partial file:
+    with open(base_path + ".prom.tmp", "w", encoding="utf-8") as file:
+        file.write(_registry.prometheus_text())
+    os.replace(base_path + ".prom.tmp", base_path + ".prom")
+
+
+def _write_periodically(interval: float, stop: threading.Event) -> None:
+    while not stop.wait(interval):
+        try:
+            write_metrics()
+        except OSError as e:
+            logging.warning(f"Unable to write metrics: {e}")
+
+
+class _SamplingProfiler:
+    """
+    Samples the stacks of all threads at a fixed interval, and writes them in the collapsed stack format read by
+    flame graph tools (e.g. speedscope or flamegraph.pl). Unlike cProfile, this includes worker threads.
+    """
+
+    def __init__(self, interval: float = _SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+def instrument_stage(stage: str) -> Callable:
+    """
+    Decorates the main function of a script taking the path of the settings yaml file as its first argument. Metrics
+    are written to the log folder every metrics_interval_seconds and when the script ends. When profile_mode is set,
+    the main function is profiled, and the profile written to the log folder: profile<stage>.prof and a summary in
+    profile<stage>.txt for 'cprofile', or profile<stage>.folded with collapsed stacks of all threads for 'sampling'.
+    """
+
+    def decorator(main: Callable[[List[str]], Any]) -> Callable[[List[str]], Any]:
+
+        @functools.wraps(main)
+        def wrapper(args: List[str]) -> Any:
+            with open(args[0]) as file:
+                settings = Settings(yaml.safe_load(file))
+            if settings.profile_mode is not None and settings.profile_mode not in PROFILE_MODES:
+                raise ValueError(f"profile_mode must be one of {PROFILE_MODES}")
+            os.makedirs(settings.log_folder, exist_ok=True)
+            # Several stages can run in one process (see VocabVec.py), so each starts with empty metrics:
+            _registry.reset(stage, settings.log_folder)
+            stop = threading.Event()
+            if settings.metrics_interval_seconds:
+                threading.Thread(target=_write_periodically,
+                                 args=(settings.metrics_interval_seconds, stop),
+                                 daemon=True).start()
+            profile_path = os.path.join(settings.log_folder, f"profile{stage}")
+            profiler = None
+            if settings.profile_mode == "cprofile":
+                profiler = cProfile.Profile()
+                profiler.enable()
+            elif settings.profile_mode == "sampling":
+                profiler = _SamplingProfiler()
+                profiler.start()
+            try:
+                return main(args)
+            finally:
+                if isinstance(profiler, cProfile.Profile):
+                    profiler.disable()
+                    profiler.dump_stats(profile_path + ".prof")
+                    summary = io.StringIO()
+                    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(50)
+                    with open(profile_path + ".txt", "w", encoding="utf-8") as file:
+                        file.write(summary.getvalue())
+                elif profiler is not None:
+                    profiler.stop()
+                    profiler.write(profile_path + ".folded")
+                stop.set()
+                write_metrics(final=True)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,384 @@
+import argparse
+import base64
+import email.parser
+import email.policy
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import numpy as np
+
+
+class MockEmbeddingServer:
+    """
+    A local OpenAI-compatible embeddings endpoint for testing the embedding pipeline without a paid API.
+
+    Vectors are derived deterministically from the text, so the same text always gets the same vector. Latency and
+    failures (429 and 5xx responses) can be injected to exercise throttling and retries, and requests-per-minute and
+    tokens-per-minute limits can be enforced like a real provider, answering requests over the limit with 429. Point
+    the scripts at it by setting GENAI_PROVIDER=lm-studio and LM_STUDIO_ENDPOINT=http://localhost:<port>/v1.
+
+    With a batch_folder, the server also has the Files and Batches endpoints of the Batch API. Uploaded files and
+    batch jobs are kept in the folder, so jobs survive a restart of the server. A job completes batch_latency seconds
+    after it is created, and the failure rate applies to each of its requests, which get an error line in the error
+    file instead of a result.
+    """
+
+    def __init__(self,
+                 port: int = 0,
+                 dimensions: int = 256,
+                 latency: float = 0.0,
+                 failure_rate: float = 0.0,
+                 server_error_rate: float = 0.0,
+                 requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None,
+                 batch_folder: Optional[str] = None,
+                 batch_latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.server_error_rate = server_error_rate
+        self.request_count = 0
+        self.failure_count = 0
+        self.rate_limited_count = 0
+        self._lock = threading.Lock()
+        # Limits are enforced as buckets holding 10 seconds worth of budget, like Azure OpenAI:
+        self._limits = {}
+        if requests_per_minute:
+            self._limits["requests"] = requests_per_minute / 60.0
+        if tokens_per_minute:
+            self._limits["tokens"] = tokens_per_minute / 60.0
+        self._available = {key: rate * 10.0 for key, rate in self._limits.items()}
+        self._last_refill = time.monotonic()
+        self.batch_folder = batch_folder
+        self.batch_latency = batch_latency
+        if batch_folder is not None:
+            os.makedirs(batch_folder, exist_ok=True)
+        self._stopped = threading.Event()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._create_handler())
+        self._thread: Optional[threading.Thread] = None
+        self._batch_thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self) -> "MockEmbeddingServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        if self.batch_folder is not None:
+            self._batch_thread = threading.Thread(target=self._process_batches, daemon=True)
+            self._batch_thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+        if self._batch_thread is not None:
+            self._batch_thread.join()
+
+    def _read_record(self, record_id: str) -> Optional[dict]:
+        path = os.path.join(self.batch_folder, f"{record_id}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            return json.load(file)
+
+    def _write_record(self, record: dict) -> None:
+        path = os.path.join(self.batch_folder, f"{record['id']}.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(record, file)
+        os.replace(path + ".tmp", path)
+
+    def _create_file(self, file_name: str, content: bytes, purpose: str) -> dict:
+        file_id = f"file-{hashlib.sha256(os.urandom(16)).hexdigest()[:24]}"
+        with open(os.path.join(self.batch_folder, file_id + ".content"), "wb") as file:
+            file.write(content)
+        record = {"id": file_id,
+                  "object": "file",
+                  "bytes": len(content),
+                  "created_at": int(time.time()),
+                  "filename": file_name,
+                  "purpose": purpose,
+                  "status": "processed"}
+        self._write_record(record)
+        return record
+
+    def _run_batch(self, batch: dict) -> None:
+        outputs, errors = [], []
+        with open(os.path.join(self.batch_folder, batch["input_file_id"] + ".content"), "rb") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                body = request["body"]
+                if random.random() < self.failure_rate + self.server_error_rate:
+                    with self._lock:
+                        self.failure_count += 1
+                    errors.append({"id": f"batch_req_{len(outputs) + len(errors)}",
+                                   "custom_id": request["custom_id"],
+                                   "response": {"status_code": 500,
+                                                "body": {"error": {"message": "Internal server error",
+                                                                   "type": "server_error"}}},
+                                   "error": None})
+                    continue
+                texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+                dimensions = body.get("dimensions") or self.dimensions
+                data = []
+                for index, text in enumerate(texts):
+                    vector = self.embed(text, dimensions)
+                    if body.get("encoding_format", "float") == "base64":
+                        embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+                    else:
+                        embedding = vector.tolist()
+                    data.append({"object": "embedding", "index": index, "embedding": embedding})
+                tokens = sum(len(text) // 4 + 1 for text in texts)
+                outputs.append({"id": f"batch_req_{len(outputs) + len(errors)}",
+                                "custom_id": request["custom_id"],
+                                "response": {"status_code": 200,
+                                             "body": {"object": "list",
+                                                      "data": data,
+                                                      "model": body.get("model", "mock"),
+                                                      "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}},
+                                "error": None})
+        for key, lines in (("output_file_id", outputs), ("error_file_id", errors)):
+            if lines:
+                content = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+                batch[key] = self._create_file(f"{batch['id']}_{key}.jsonl", content, "batch_output")["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"] = {"total": len(outputs) + len(errors),
+                                   "completed": len(outputs),
+                                   "failed": len(errors)}
+
+    def _process_batches(self) -> None:
+        while not self._stopped.wait(0.1):
+            for file_name in sorted(os.listdir(self.batch_folder)):
+                if not (file_name.startswith("batch_") and file_name.endswith(".json")):
+                    continue
+                batch = self._read_record(file_name[:-len(".json")])
+                if batch["status"] not in ("validating", "in_progress"):
+                    continue
+                if time.time() < batch["created_at"] + self.batch_latency:
+                    if batch["status"] == "validating":
+                        batch["status"] = "in_progress"
+                        self._write_record(batch)
+                    continue
+                self._run_batch(batch)
+                self._write_record(batch)
+
+    def _take_budget(self, tokens: int) -> float:
+        """
+        Takes the budget for one request if available. Returns 0 if it was available, and otherwise the number of
+        seconds until it will be.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for key, rate in self._limits.items():
+                self._available[key] = min(rate * 10.0, self._available[key] + (now - self._last_refill) * rate)
+            self._last_refill = now
+            needed = {"requests": 1.0, "tokens": float(tokens)}
+            wait = 0.0
+            for key, rate in self._limits.items():
+                amount = min(needed[key], rate * 10.0)
+                if self._available[key] < amount:
+                    wait = max(wait, (amount - self._available[key]) / rate)
+            if wait == 0.0:
+                for key, rate in self._limits.items():
+                    self._available[key] -= min(needed[key], rate * 10.0)
+            else:
+                self.rate_limited_count += 1
+            return wait
+
+    def embed(self, text: str, dimensions: int) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def _create_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status: int, body: dict, headers: Optional[dict] = None) -> None:
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _read_body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def _get_batch_record(self, record_id: str) -> Optional[dict]:
+                record = mock._read_record(record_id) if mock.batch_folder is not None else None
+                if record is None:
+                    self._send_json(404, {"error": {"message": f"No such object: {record_id}"}})
+                return record
+
+            def do_GET(self):
+                parts = self.path.split("?")[0].rstrip("/").split("/")
+                if len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content":
+                    record = self._get_batch_record(parts[-2])
+                    if record is None:
+                        return
+                    with open(os.path.join(mock.batch_folder, record["id"] + ".content"), "rb") as file:
+                        payload = file.read()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                elif len(parts) >= 2 and parts[-2] in ("files", "batches"):
+                    record = self._get_batch_record(parts[-1])
+                    if record is not None:
+                        self._send_json(200, record)
+                else:
+                    self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            def _create_file(self) -> None:
+                # A multipart form, parsed as a MIME message:
+                header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+                message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + self._read_body())
+                fields = {}
+                file_name, content = "upload.jsonl", b""
+                for part in message.iter_parts():
+                    name = part.get_param("name", header="content-disposition")
+                    if part.get_filename() is not None:
+                        file_name, content = part.get_filename(), part.get_payload(decode=True)
+                    else:
+                        fields[name] = part.get_payload(decode=True).decode("utf-8")
+                self._send_json(200, mock._create_file(file_name, content, fields.get("purpose", "batch")))
+
+            def _create_batch(self) -> None:
+                request = json.loads(self._read_body())
+                if mock._read_record(request["input_file_id"]) is None:
+                    self._send_json(400, {"error": {"message": f"No such file: {request['input_file_id']}"}})
+                    return
+                batch = {"id": f"batch_{hashlib.sha256(os.urandom(16)).hexdigest()[:24]}",
+                         "object": "batch",
+                         "endpoint": request["endpoint"],
+                         "input_file_id": request["input_file_id"],
+                         "completion_window": request["completion_window"],
+                         "status": "validating",
+                         "output_file_id": None,
+                         "error_file_id": None,
+                         "created_at": int(time.time()),
+                         "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                         "metadata": request.get("metadata")}
+                mock._write_record(batch)
+                self._send_json(200, batch)
+
+            def do_POST(self):
+                path = self.path.split("?")[0].rstrip("/")
+                if mock.batch_folder is not None and path.endswith("/files"):
+                    self._create_file()
+                    return
+                if mock.batch_folder is not None and path.endswith("/batches"):
+                    self._create_batch()
+                    return
+                if not path.endswith("/embeddings"):
+                    self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                with mock._lock:
+                    mock.request_count += 1
+                if mock.latency > 0:
+                    time.sleep(mock.latency)
+                draw = random.random()
+                if draw < mock.failure_rate:
+                    with mock._lock:
+                        mock.failure_count += 1
+                    self._send_json(429,
+                                    {"error": {"message": "Rate limit exceeded", "type": "rate_limit_exceeded"}},
+                                    headers={"retry-after": "0"})
+                    return
+                if draw < mock.failure_rate + mock.server_error_rate:
+                    with mock._lock:
+                        mock.failure_count += 1
+                    self._send_json(500, {"error": {"message": "Internal server error", "type": "server_error"}})
+                    return
+                texts = request["input"]
+                if isinstance(texts, str):
+                    texts = [texts]
+                tokens = sum(len(text) // 4 + 1 for text in texts)
+                wait = mock._take_budget(tokens)
+                if wait > 0:
+                    self._send_json(429,
+                                    {"error": {"message": "Rate limit exceeded", "type": "rate_limit_exceeded"}},
+                                    headers={"retry-after": f"{wait:.2f}"})
+                    return
+                dimensions = request.get("dimensions") or mock.dimensions
+                encoding_format = request.get("encoding_format", "float")
+                data = []
+                for index, text in enumerate(texts):
+                    vector = mock.embed(text, dimensions)
+                    if encoding_format == "base64":
+                        embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+                    else:
+                        embedding = vector.tolist()
+                    data.append({"object": "embedding", "index": index, "embedding": embedding})
+                self._send_json(200, {
+                    "object": "list",
+                    "data": data,
+                    "model": request.get("model", "mock"),
+                    "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+                })
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local mock OpenAI-compatible embedding server.")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering a request.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests answered with 429.")
+    parser.add_argument("--server-error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with 500.")
+    parser.add_argument("--requests-per-minute", type=int, default=None,
+                        help="Requests per minute allowed before answering with 429.")
+    parser.add_argument("--tokens-per-minute", type=int, default=None,
+                        help="Tokens per minute allowed before answering with 429.")
+    parser.add_argument("--batch-folder", default=None,
+                        help="Folder to keep files and batch jobs in. Enables the Batch API endpoints.")
+    parser.add_argument("--batch-latency", type=float, default=0.0,
+                        help="Seconds after which a batch job completes.")
+    args = parser.parse_args()
+    server = MockEmbeddingServer(port=args.port,
+                                 dimensions=args.dimensions,
+                                 latency=args.latency,
+                                 failure_rate=args.failure_rate,
+                                 server_error_rate=args.server_error_rate,
+                                 requests_per_minute=args.requests_per_minute,
+                                 tokens_per_minute=args.tokens_per_minute,
+                                 batch_folder=args.batch_folder,
+                                 batch_latency=args.batch_latency)
+    print(f"Mock embedding server listening on {server.url}")
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
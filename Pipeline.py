@@ -0,0 +1,554 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from typing import List, Optional, Dict, Any
+
+import pyarrow as pa
+import yaml
+from dotenv import load_dotenv
+from psycopg import sql
+from sqlalchemy import create_engine, inspect
+
+from BinaryCopy import COPY_SIGNATURE, COPY_TRAILER
+from CreateEmbeddings import create_query, store_in_parquet, get_embedding_dtype, get_concept_columns
+from DownloadTerms import stream_terms, open_terms_database, create_term_indexes, TERM_COLUMNS
+from EmbeddingCache import EmbeddingCache, get_cached_embedding_vectors
+from EmbeddingFiles import read_embedding_batches, CONCEPT_COLUMNS
+from EmbeddingManifest import EmbeddingManifest
+from GenAIApi import get_embedding_vectors, get_embedding_model, BatchLimits, EmbeddingRequestStats
+from LexicalSearch import create_lexical_index
+from Logging import open_log
+from Metrics import instrument_stage, timer, increment
+from Quantization import truncate_vectors
+from Settings import Settings
+from UploadEmbeddingVectors import (get_connection, get_vector_type, create_table_in_pgvector, write_vectors,
+                                    finalize_table, get_partition_domains, create_copy_statement, get_copy_types)
+
+load_dotenv()
+
+# Runs the download, embedding, and upload steps as concurrent stages connected by bounded queues, so terms are
+# embedded as soon as they are downloaded and vectors are uploaded as soon as they are embedded. A full queue blocks
+# the stage feeding it, so a slow stage throttles the stages before it instead of letting batches pile up in memory.
+#
+#   extract --(term batches)--> embed --(vector batches)--> upload (upload_workers connections)
+#
+# Only with pipeline_persist enabled are the terms written to the SQLite database and the vectors to Parquet shards.
+# These are only used to resume after a crash, without embedding the same terms again. The terms are then downloaded
+# completely before they are embedded, as only a complete download has stable term IDs.
+
+_DONE = None
+
+
+class _Stopped(Exception):
+    pass
+
+
+class _StageStats:
+    """
+    Counts the rows a stage has processed, and the time its workers spent waiting for input and waiting for room in
+    the next queue. A stage that rarely waits is the bottleneck of the pipeline.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = 0
+        self.input_wait = 0.0
+        self.output_wait = 0.0
+        self._lock = threading.Lock()
+        self._started = {}
+        self._seconds = 0.0
+
+    def start(self) -> None:
+        with self._lock:
+            self._started[threading.get_ident()] = time.time()
+
+    def finish(self) -> None:
+        with self._lock:
+            self._seconds += time.time() - self._started.pop(threading.get_ident())
+
+    def add(self, rows: int = 0, input_wait: float = 0.0, output_wait: float = 0.0) -> None:
+        with self._lock:
+            self.rows += rows
+            self.input_wait += input_wait
+            self.output_wait += output_wait
+
+    def worker_seconds(self) -> float:
+        now = time.time()
+        with self._lock:
+            return self._seconds + sum(now - started for started in self._started.values())
+
+    def busy_fraction(self) -> float:
+        seconds = self.worker_seconds()
+        if seconds == 0:
+            return 0.0
+        return max(0.0, 1.0 - (self.input_wait + self.output_wait) / seconds)
+
+    def summary(self, elapsed: float) -> str:
+        seconds = max(self.worker_seconds(), 1e-9)
+        return (f"{self.name}: {self.rows} rows ({self.rows / max(elapsed, 1e-9):.1f} rows/sec), busy "
+                f"{100 * self.busy_fraction():.0f}%, waiting for input {100 * self.input_wait / seconds:.0f}%, "
+                f"waiting for next stage {100 * self.output_wait / seconds:.0f}%")
+
+
+def _put(target: queue.Queue, item: Any, stop: threading.Event, stats: _StageStats) -> None:
+    start_time = time.time()
+    try:
+        while True:
+            if stop.is_set():
+                raise _Stopped()
+            try:
+                target.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+    finally:
+        stats.add(output_wait=time.time() - start_time)
+
+
+def _get(source: queue.Queue, stop: threading.Event, stats: _StageStats, block: bool = True) -> Any:
+    """
+    Takes the next item from a queue. When block is false, raises queue.Empty if no item is available.
+    """
+    start_time = time.time()
+    try:
+        while True:
+            if stop.is_set():
+                raise _Stopped()
+            try:
+                return source.get(timeout=0.5) if block else source.get_nowait()
+            except queue.Empty:
+                if not block:
+                    raise
+    finally:
+        stats.add(input_wait=time.time() - start_time)
+
+
+def get_pipeline_fingerprint(settings: Settings) -> str:
+    """
+    Identifies the terms and vectors the pipeline creates, so shards persisted by a run with other settings are not
+    reused.
+    """
+    identity = {
+        "pipeline": 1,
+        "schema": os.getenv("VOCAB_SCHEMA"),
+        "domain_ids": settings.domain_ids,
+        "include_classification_concepts": settings.include_classification_concepts,
+        "classification_vocabularies": settings.classification_vocabularies,
+        "restrict_to_used_concepts": settings.restrict_to_used_concepts,
+        "include_synonyms": settings.include_synonyms,
+        "include_mapped_terms": settings.include_mapped_terms,
+        "max_text_characters": settings.max_text_characters,
+        "dimensions": settings.dimensions,
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _term_type(source: str) -> str:
+    return "Synonym" if source in ["synonym", "mapped synonym"] else "Name"
+
+
+def _include_source(settings: Settings, source: str) -> bool:
+    if not settings.include_synonyms and source in ["synonym", "mapped synonym"]:
+        return False
+    if not settings.include_mapped_terms and source in ["mapped", "mapped synonym"]:
+        return False
+    return True
+
+
+def _download_terms(settings: Settings) -> int:
+    """
+    Downloads the terms into the SQLite database, creating the terms table in the same transaction as the terms are
+    inserted, so the table only exists once the download is complete. This relies on the journal, so it is not turned
+    off.
+    """
+    target = open_terms_database(settings.terms_db_path, new_database=False)
+    total_count = 0
+    try:
+        target.execute("BEGIN")
+        target.execute("DROP TABLE IF EXISTS terms")
+        target.execute("CREATE TABLE terms (concept_id INTEGER, concept_name VARCHAR, source VARCHAR, "
+                       "domain_id VARCHAR, vocabulary_id VARCHAR, standard_concept VARCHAR)")
+        insert_statement = f"INSERT INTO terms ({', '.join(TERM_COLUMNS)}) VALUES ({', '.join('?' * len(TERM_COLUMNS))})"
+        for rows in stream_terms(settings, settings.download_batch_size):
+            with timer("terms_db_insert_seconds"):
+                target.executemany(insert_statement, rows)
+            increment("terms_db_rows_inserted", len(rows))
+            total_count += len(rows)
+        target.commit()
+    finally:
+        target.close()
+    create_term_indexes(create_engine(f"sqlite:///{settings.terms_db_path}"))
+    if settings.lexical_index is not None:
+        create_lexical_index(settings.terms_db_path, settings.lexical_index)
+    logging.info(f"Stored {total_count} terms in {settings.terms_db_path}")
+    return total_count
+
+
+def _extract(settings: Settings,
+             terms_queue: queue.Queue,
+             stop: threading.Event,
+             stats: _StageStats,
+             from_terms_database: bool,
+             after_term_id: Optional[int]) -> None:
+    """
+    Puts batches of (term_id, concept_id, term, term_type, concept_values) tuples on the terms queue, where
+    concept_values are the values of the concept columns (domain_id, vocabulary_id, standard_concept), or an empty
+    tuple for terms databases downloaded without them. Without persistence, the terms
+    are streamed from the vocabulary database, numbered in the order they arrive. With persistence, they are read from
+    the SQLite database, after downloading them there if needed, and the term IDs are their rowids.
+    """
+    if settings.pipeline_persist and not from_terms_database:
+        # Downloading is fast compared to embedding, and the download must be complete before its term IDs can be
+        # used to resume, so it is not overlapped with the other stages:
+        _download_terms(settings)
+        from_terms_database = True
+    if from_terms_database:
+        engine = create_engine(f"sqlite:///{settings.terms_db_path}")
+        query = create_query(engine=engine, settings=settings, after_term_id=after_term_id)
+        concept_columns = get_concept_columns(query)
+        with engine.connect() as connection:
+            result_proxy = connection.execute(query)
+            while True:
+                with timer("terms_db_fetch_seconds"):
+                    chunk = result_proxy.fetchmany(settings.embedding_batch_size)
+                if not chunk:
+                    break
+                increment("terms_db_rows_fetched", len(chunk))
+                batch = [(row.term_id,
+                          row.concept_id,
+                          row.term[:settings.max_text_characters],
+                          row.term_type,
+                          tuple(row._mapping[name] for name in concept_columns)) for row in chunk]
+                stats.add(rows=len(batch))
+                _put(terms_queue, batch, stop, stats)
+        return
+
+    term_id = 0
+    for rows in stream_terms(settings, settings.embedding_batch_size):
+        batch = []
+        for concept_id, concept_name, source, *concept_values in rows:
+            term_id += 1
+            if _include_source(settings, source):
+                batch.append((term_id,
+                              concept_id,
+                              concept_name[:settings.max_text_characters],
+                              _term_type(source),
+                              tuple(concept_values)))
+        if batch:
+            stats.add(rows=len(batch))
+            _put(terms_queue, batch, stop, stats)
+
+
+def _embed(settings: Settings,
+           terms_queue: queue.Queue,
+           vectors_queue: queue.Queue,
+           stop: threading.Event,
+           stats: _StageStats,
+           manifest: Optional[EmbeddingManifest]) -> float:
+    """
+    Embeds the term batches, up to embedding_concurrency batches at a time, and puts (attributes, vectors) tuples on
+    the vectors queue. Vectors persisted by an earlier run are put on the vectors queue first.
+
+    Returns:
+        The total cost of the embedding requests.
+    """
+    if manifest is not None and manifest.row_count() > 0:
+        logging.info(f"Uploading {manifest.row_count()} vectors persisted by an earlier run")
+        for file_name in manifest.file_names():
+            for attributes, vectors in read_embedding_batches(os.path.join(settings.embeddings_folder, file_name)):
+                _put(vectors_queue, (attributes, vectors), stop, stats)
+
+    # The cache holds a SQLite connection, so must be created in the thread using it:
+    cache = None
+    if settings.embedding_cache_path:
+        model, provider = get_embedding_model()
+        cache = EmbeddingCache(path=settings.embedding_cache_path,
+                               provider=provider,
+                               model=model,
+                               dimensions=settings.dimensions,
+                               max_size_mb=settings.embedding_cache_max_mb)
+    embed_args = dict(max_workers=settings.embedding_concurrency,
+                      requests_per_minute=settings.requests_per_minute,
+                      tokens_per_minute=settings.tokens_per_minute,
+                      max_retries=settings.embedding_max_retries,
+                      dimensions=settings.dimensions,
+                      batch_limits=BatchLimits(max_items=settings.embedding_max_batch_items,
+                                               max_tokens=settings.embedding_max_batch_tokens,
+                                               adaptive=settings.embedding_adaptive_batching,
+                                               target_latency=settings.embedding_target_latency),
+                      stats=EmbeddingRequestStats(),
+                      vector_dtype=get_embedding_dtype(settings),
+                      encoding_format=settings.embedding_encoding_format)
+    total_cost = 0.0
+    pending = []
+    done = False
+    try:
+        while not done:
+            # Wait for a first batch, then take whatever else is ready, so requests are never held back waiting for
+            # a full set of batches:
+            try:
+                item = _get(terms_queue, stop, stats, block=len(pending) == 0)
+                if item is _DONE:
+                    done = True
+                else:
+                    pending.append(item)
+                    if len(pending) < settings.embedding_concurrency:
+                        continue
+            except queue.Empty:
+                pass
+            if not pending:
+                continue
+            texts = [term for batch in pending for _, _, term, _, _ in batch]
+            if cache is None:
+                embeddings = get_embedding_vectors(texts, **embed_args)
+            else:
+                embeddings = get_cached_embedding_vectors(texts, cache, get_embedding_vectors, **embed_args)
+            total_cost += embeddings["usage"]["total_cost_usd"]
+            if settings.embedding_stats_path:
+                embed_args["stats"].write(settings.embedding_stats_path)
+            offset = 0
+            for batch in pending:
+                vectors = embeddings["embeddings"][offset:offset + len(batch)]
+                offset += len(batch)
+                concept_ids = [concept_id for _, concept_id, _, _, _ in batch]
+                term_types = [term_type for _, _, _, term_type, _ in batch]
+                concept_columns = {}
+                if batch[0][4]:
+                    concept_columns = {name: [concept_values[i] for _, _, _, _, concept_values in batch]
+                                       for i, name in enumerate(CONCEPT_COLUMNS)}
+                if manifest is not None:
+                    first_term_id = batch[0][0]
+                    last_term_id = batch[-1][0]
+                    file_name = f"EmbeddingVectors_{first_term_id}_{last_term_id}.parquet"
+                    file_path = os.path.join(settings.embeddings_folder, file_name)
+                    store_in_parquet(concept_ids=concept_ids,
+                                     term_types=term_types,
+                                     embeddings=vectors,
+                                     file_name=file_path + ".tmp",
+                                     vector_dtype=settings.parquet_vector_dtype,
+                                     concept_columns=concept_columns)
+                    os.replace(file_path + ".tmp", file_path)
+                    manifest.add_shard(file_name, first_term_id, last_term_id, len(batch))
+                attributes = pa.table({"concept_id": pa.array(concept_ids, type=pa.int32()),
+                                       "term_type": pa.array(term_types, type=pa.string()),
+                                       **{name: pa.array(values, type=pa.string())
+                                          for name, values in concept_columns.items()}})
+                stats.add(rows=len(batch))
+                _put(vectors_queue, (attributes, vectors), stop, stats)
+            pending = []
+    finally:
+        if cache is not None:
+            cache.log_statistics()
+            cache.close()
+        embed_args["stats"].log_summary()
+    return total_cost
+
+
+def _upload(settings: Settings,
+            vectors_queue: queue.Queue,
+            stop: threading.Event,
+            stats: _StageStats,
+            schema: str,
+            table: str,
+            table_state: Dict[str, Any]) -> None:
+    """
+    Copies the vector batches into the table using a single binary COPY, committed when the queue is done. The first
+    worker to receive a batch creates the table, using the dimensions of that batch.
+    """
+    item = _get(vectors_queue, stop, stats)
+    if item is _DONE:
+        return
+    vector_type = get_vector_type(settings)
+    binary = settings.store_type == settings.PGVECTOR_BINARY
+    conn = get_connection()
+    try:
+        with table_state["lock"]:
+            if not table_state["created"]:
+                dimensions = item[1].shape[1]
+                if settings.dimensions is not None:
+                    dimensions = min(dimensions, settings.dimensions)
+                create_table_in_pgvector(conn,
+                                         schema,
+                                         table,
+                                         vector_type,
+                                         dimensions,
+                                         unlogged=settings.use_staging_table and settings.unlogged_staging_table,
+                                         binary=binary,
+                                         partition_domains=get_partition_domains(conn, schema, settings))
+                conn.commit()
+                table_state["created"] = True
+        partitioned = settings.partition_by_domain
+        with conn.cursor().copy(create_copy_statement(schema, table, binary, partitioned)) as copy:
+            if settings.vectorized_copy:
+                copy.write(COPY_SIGNATURE)
+            else:
+                copy.set_types(get_copy_types(vector_type, binary, partitioned))
+            while item is not _DONE:
+                attributes, vectors = item
+                if settings.dimensions is not None:
+                    vectors = truncate_vectors(vectors, settings.dimensions)
+                write_vectors(copy, attributes, vectors, vector_type, settings.vectorized_copy, binary, partitioned)
+                stats.add(rows=attributes.num_rows)
+                item = _get(vectors_queue, stop, stats)
+            if settings.vectorized_copy:
+                copy.write(COPY_TRAILER)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run_pipeline(settings: Settings) -> Dict[str, Any]:
+    """
+    Downloads the terms, embeds them, and uploads the vectors to the vector store, with the three steps running
+    concurrently.
+
+    Returns:
+        A dictionary with the number of rows and rows per second of each stage, and the total cost.
+    """
+    if settings.incremental_refresh:
+        raise Exception("The pipeline always creates the full vector store. Please use the separate scripts for "
+                        "incremental refreshes")
+    if settings.deduplicate_terms:
+        raise Exception("The pipeline embeds terms as they are downloaded, so cannot deduplicate them. Please use "
+                        "the separate scripts with deduplicate_terms")
+    if settings.embedding_batch_mode:
+        raise Exception("The pipeline embeds terms as they are downloaded, so cannot use Batch API jobs. Please use "
+                        "the separate scripts with embedding_batch_mode")
+    if settings.upload_workers > 1 and not settings.use_staging_table:
+        raise Exception("Each upload worker commits separately, so upload_workers > 1 requires use_staging_table. "
+                        "Otherwise a failed run would leave part of the vectors in the vector table")
+    schema = os.getenv("VOCAB_SCHEMA")
+    table = os.getenv("VOCAB_VECTOR_TABLE")
+    target_table = f"{table}_staging" if settings.use_staging_table else table
+
+    manifest = None
+    from_terms_database = False
+    after_term_id = None
+    if settings.pipeline_persist:
+        os.makedirs(os.path.dirname(os.path.abspath(settings.terms_db_path)), exist_ok=True)
+        os.makedirs(settings.embeddings_folder, exist_ok=True)
+        from_terms_database = (os.path.exists(settings.terms_db_path) and
+                               inspect(create_engine(f"sqlite:///{settings.terms_db_path}")).has_table("terms"))
+        manifest = EmbeddingManifest(settings.embeddings_folder)
+        manifest.open(get_pipeline_fingerprint(settings))
+        if manifest.row_count() > 0 and not from_terms_database:
+            # The run creating these shards crashed before the download was complete, so their term IDs cannot be
+            # matched to the terms of a new download:
+            logging.warning(f"Discarding {manifest.row_count()} persisted vectors of an incomplete download")
+            for file_name in manifest.file_names():
+                os.remove(os.path.join(settings.embeddings_folder, file_name))
+            manifest.replace_shards([])
+        after_term_id = manifest.last_term_id()
+        if after_term_id is not None:
+            logging.info(f"Resuming after term ID {after_term_id}, {manifest.row_count()} terms already embedded")
+        if from_terms_database:
+            logging.info(f"Reading the terms downloaded earlier from {settings.terms_db_path}")
+
+    # The pipeline always creates the table from scratch:
+    conn = get_connection()
+    conn.execute(sql.SQL("DROP TABLE IF EXISTS {schema}.{table}").format(
+        schema=sql.Identifier(schema),
+        table=sql.Identifier(target_table)
+    ))
+    conn.commit()
+
+    terms_queue = queue.Queue(maxsize=settings.pipeline_queue_size)
+    vectors_queue = queue.Queue(maxsize=settings.pipeline_queue_size)
+    stop = threading.Event()
+    errors = []
+    results = {}
+    stats = {name: _StageStats(name) for name in ["extract", "embed", "upload"]}
+    table_state = {"lock": threading.Lock(), "created": False}
+    workers = max(1, settings.upload_workers)
+
+    def run_stage(name: str, function, *args, done_queue: Optional[queue.Queue] = None, done_count: int = 1):
+        stats[name].start()
+        try:
+            results[name] = function(*args)
+            if done_queue is not None:
+                for _ in range(done_count):
+                    _put(done_queue, _DONE, stop, stats[name])
+        except _Stopped:
+            pass
+        except Exception as e:
+            logging.exception(f"The {name} stage failed")
+            errors.append(e)
+            stop.set()
+        finally:
+            stats[name].finish()
+
+    threads = [
+        threading.Thread(target=run_stage,
+                         args=("extract", _extract, settings, terms_queue, stop, stats["extract"], from_terms_database,
+                               after_term_id),
+                         kwargs={"done_queue": terms_queue}),
+        threading.Thread(target=run_stage,
+                         args=("embed", _embed, settings, terms_queue, vectors_queue, stop, stats["embed"], manifest),
+                         kwargs={"done_queue": vectors_queue, "done_count": workers}),
+    ]
+    threads.extend(threading.Thread(target=run_stage,
+                                    args=("upload", _upload, settings, vectors_queue, stop, stats["upload"], schema,
+                                          target_table, table_state))
+                   for _ in range(workers))
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    next_report = start_time + settings.pipeline_report_seconds
+    while any(thread.is_alive() for thread in threads):
+        next(thread for thread in threads if thread.is_alive()).join(timeout=1.0)
+        if time.time() >= next_report:
+            elapsed = time.time() - start_time
+            logging.info(f"After {elapsed:.0f} seconds: terms queue {terms_queue.qsize()}/{settings.pipeline_queue_size}, "
+                         f"vectors queue {vectors_queue.qsize()}/{settings.pipeline_queue_size}")
+            for stage_stats in stats.values():
+                logging.info(f"- {stage_stats.summary(elapsed)}")
+            next_report += settings.pipeline_report_seconds
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    elapsed = time.time() - start_time
+
+    logging.info(f"Pipeline finished in {elapsed:.0f} seconds")
+    for stage_stats in stats.values():
+        logging.info(f"- {stage_stats.summary(elapsed)}")
+    bottleneck = max(stats.values(), key=lambda stage_stats: stage_stats.busy_fraction())
+    logging.info(f"Bottleneck: {bottleneck.name}")
+    logging.info(f"Total cost: {results.get('embed', 0.0)}")
+
+    if table_state["created"]:
+        finalize_table(conn, schema, target_table, table, get_vector_type(settings), settings)
+    else:
+        logging.warning("No terms found, so no table was created")
+    conn.close()
+    return {
+        "stages": {name: {"rows": stage_stats.rows, "rows_per_second": stage_stats.rows / elapsed}
+                   for name, stage_stats in stats.items()},
+        "bottleneck": bottleneck.name,
+        "total_cost": results.get("embed", 0.0),
+    }
+
+
+@instrument_stage("Pipeline")
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = Settings(config)
+    os.makedirs(settings.log_folder, exist_ok=True)
+    open_log(os.path.join(settings.log_folder, "logPipeline.txt"))
+
+    logging.info("Starting pipeline")
+    run_pipeline(settings)
+    logging.info("Finished pipeline")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,61 @@
+from typing import Tuple
+
+import numpy as np
+
+# Reduction of embedding vectors to compact representations:
+#   truncation: keeping the first dimensions of vectors from models trained with Matryoshka representation learning
+#               (such as text-embedding-3), followed by L2 renormalization.
+#   int8:       scalar quantization, with one scale per vector so that the largest absolute value maps to 127.
+#   binary:     one bit per dimension, set when the value is positive, packed 8 dimensions per byte (most significant
+#               bit first, which is also the layout of the PostgreSQL bit type).
+QUANTIZATIONS = ["int8", "binary"]
+
+
+def truncate_vectors(vectors: np.ndarray, dimensions: int) -> np.ndarray:
+    """
+    Keeps the first dimensions of a (rows x dimensions) matrix, and L2-renormalizes the rows. Vectors that are not
+    wider than the requested dimensions are returned unchanged.
+    """
+    if vectors.shape[1] <= dimensions:
+        return vectors
+    truncated = np.array(vectors[:, :dimensions], dtype=np.float32)
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    truncated /= norms
+    return truncated
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantizes a (rows x dimensions) matrix to int8.
+
+    Returns:
+        A tuple of the int8 codes and the float32 scale per row. The vectors are approximately codes * scale.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, np.newaxis]
+
+
+def quantize_binary(vectors: np.ndarray) -> np.ndarray:
+    """
+    Quantizes a (rows x dimensions) matrix to bits, returning a (rows x ceil(dimensions / 8)) uint8 matrix.
+    """
+    return np.packbits(np.asarray(vectors) > 0, axis=1)
+
+
+def binary_to_signs(bits: np.ndarray, dimensions: int) -> np.ndarray:
+    """
+    Expands packed bits to a float32 matrix of +1 and -1, so binary vectors can be scored with a matrix
+    multiplication. The dot product of two sign vectors equals dimensions - 2 * Hamming distance.
+    """
+    signs = np.unpackbits(bits, axis=1, count=dimensions).astype(np.float32)
+    signs *= 2
+    signs -= 1
+    return signs
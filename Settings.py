@@ -21,8 +21,86 @@ class Settings:
     record_count_table: str
     store_type: str
 
+    # Optional settings:
+    incremental_refresh: bool = False
+    deduplicate_terms: bool = False
+    fast_extraction: bool = False
+    extraction_shards: int = 1
+    extraction_max_retries: int = 2
+    lexical_index: Optional[str] = None
+    embedding_concurrency: int = 1
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    embedding_max_retries: int = 5
+    embedding_max_batch_items: int = 100
+    embedding_max_batch_tokens: Optional[int] = None
+    embedding_adaptive_batching: bool = False
+    embedding_target_latency: Optional[float] = None
+    embedding_stats_path: Optional[str] = None
+    embedding_encoding_format: str = "base64"
+    embedding_batch_mode: bool = False
+    batch_jobs_folder: Optional[str] = None
+    batch_max_requests: int = 50000
+    batch_max_inputs: int = 50000
+    batch_max_file_mb: int = 200
+    batch_max_jobs_in_flight: int = 4
+    batch_poll_seconds: float = 60
+    dimensions: Optional[int] = None
+    evaluation_dimensions: Optional[List[int]] = None
+    delta_embeddings_folder: Optional[str] = None
+    compact_rows_per_file: int = 1000000
+    compact_row_group_mb: int = 128
+    embedding_cache_path: Optional[str] = None
+    embedding_cache_max_mb: Optional[int] = None
+    parquet_vector_dtype: str = "float32"
+    vectorized_copy: bool = True
+    upload_workers: int = 1
+    use_staging_table: bool = False
+    unlogged_staging_table: bool = True
+    create_indexes: bool = False
+    partition_by_domain: bool = False
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 64
+    maintenance_work_mem: Optional[str] = None
+    max_parallel_maintenance_workers: Optional[int] = None
+    delta_batch_size: int = 10000
+    local_index_folder: Optional[str] = None
+    local_index_dtype: str = "float16"
+    local_search_batch_size: int = 1000
+    local_search_block_size: int = 65536
+    local_search_threads: int = 1
+    local_ivf_lists: Optional[int] = None
+    local_ivf_probes: int = 8
+    record_counts_path: Optional[str] = None
+    min_record_count: float = 0
+    record_count_weight: float = 0.0
+    search_port: int = 8080
+    search_pool_size: int = 4
+    search_cache_size: int = 10000
+    search_max_batch_size: int = 64
+    search_batch_wait_ms: float = 5
+    search_mode: str = "vector"
+    hybrid_candidates: int = 50
+    binary_full_vector_type: str = "halfvec"
+    rerank_candidates: int = 100
+    local_index_quantization: Optional[str] = None
+    pipeline_queue_size: int = 8
+    pipeline_persist: bool = False
+    pipeline_report_seconds: int = 60
+    record_count_files: Optional[List[str]] = None
+    ancestor_cache_path: Optional[str] = None
+    refresh_ancestor_cache: bool = False
+    metrics_interval_seconds: Optional[int] = 60
+    profile_mode: Optional[str] = None
+    tune_hnsw_m: Optional[List[int]] = None
+    tune_hnsw_ef_construction: Optional[List[int]] = None
+    tune_hnsw_ef_search: Optional[List[int]] = None
+    tune_clients: int = 8
+    tune_target_recall: float = 0.95
+
     PGVECTOR = "pgvector"
     PGVECTOR_HALFVEC = "pgvector_halfvec"
+    PGVECTOR_BINARY = "pgvector_binary"
 
     def __init__(self, config: Optional[Dict[str, Any]] = None):
         if config is None:
@@ -38,5 +116,6 @@ class Settings:
             setattr(self, key, value)
 
     def __post_init__(self):
-        if self.store_type not in [self.PGVECTOR, self.PGVECTOR_HALFVEC]:
-            raise ValueError(f"store_type must be '{self.PGVECTOR}' or '{self.PGVECTOR_HALFVEC}'")
\ No newline at end of file
+        if self.store_type not in [self.PGVECTOR, self.PGVECTOR_HALFVEC, self.PGVECTOR_BINARY]:
+            raise ValueError(f"store_type must be '{self.PGVECTOR}', '{self.PGVECTOR_HALFVEC}', or "
+                             f"'{self.PGVECTOR_BINARY}'")
\ No newline at end of file
@@ -0,0 +1,196 @@
+import csv
+import io
+import logging
+from typing import Dict, List, Iterator
+
+import numpy as np
+import psycopg
+from psycopg import sql
+
+# Words used to compose the synthetic concept names and synonyms:
+_WORDS = ("acute chronic primary secondary congenital malignant benign recurrent severe mild bilateral left right "
+          "upper lower anterior posterior disorder disease syndrome infection inflammation fracture lesion neoplasm "
+          "deficiency injury pain stenosis obstruction hemorrhage ulcer cyst edema fibrosis necrosis hypertrophy "
+          "heart lung liver kidney brain skin bone muscle joint artery vein nerve eye ear stomach colon bladder "
+          "blood serum plasma urine measurement level count ratio test procedure excision repair biopsy "
+          "transplant removal insertion examination screening therapy of with without due to").split()
+_DOMAINS = ["Condition", "Observation", "Measurement", "Procedure", "Drug"]
+_ENGLISH = 4180186
+_OTHER_LANGUAGE = 4182503
+
+_TABLES = {
+    "concept": "concept_id INT, concept_name VARCHAR(255), domain_id VARCHAR(20), vocabulary_id VARCHAR(20), "
+               "concept_class_id VARCHAR(20), standard_concept VARCHAR(1), concept_code VARCHAR(50), "
+               "valid_start_date DATE, valid_end_date DATE, invalid_reason VARCHAR(1)",
+    "concept_synonym": "concept_id INT, concept_synonym_name VARCHAR(1000), language_concept_id INT",
+    "concept_relationship": "concept_id_1 INT, concept_id_2 INT, relationship_id VARCHAR(20), valid_start_date DATE, "
+                            "valid_end_date DATE, invalid_reason VARCHAR(1)",
+    "concept_ancestor": "ancestor_concept_id INT, descendant_concept_id INT, min_levels_of_separation INT, "
+                        "max_levels_of_separation INT",
+}
+_COPY_BATCH_SIZE = 100000
+
+
+def _names(rng: np.random.Generator, count: int, min_words: int = 2, max_words: int = 6) -> List[str]:
+    lengths = rng.integers(min_words, max_words + 1, size=count)
+    words = rng.integers(0, len(_WORDS), size=int(lengths.sum()))
+    names = []
+    offset = 0
+    for length in lengths:
+        names.append(" ".join(_WORDS[w] for w in words[offset:offset + length]))
+        offset += length
+    return names
+
+
+def _ancestors(parents: np.ndarray) -> Iterator[np.ndarray]:
+    """
+    Yields (descendant index, ancestor index, levels of separation) rows for a forest given as an array of parent
+    indices (-1 for roots), one level of separation at a time, starting with each node itself.
+    """
+    nodes = np.arange(len(parents))
+    current = nodes
+    level = 0
+    while len(nodes) > 0:
+        yield np.column_stack([nodes, current, np.full(len(nodes), level)])
+        current = parents[current]
+        keep = current >= 0
+        nodes = nodes[keep]
+        current = current[keep]
+        level += 1
+
+
+def _copy_rows(conn: psycopg.Connection, schema: str, table: str, rows: Iterator[tuple]) -> int:
+    statement = sql.SQL("COPY {schema}.{table} FROM STDIN WITH (FORMAT CSV)").format(
+        schema=sql.Identifier(schema),
+        table=sql.Identifier(table))
+    count = 0
+    with conn.cursor().copy(statement) as copy:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+            if count % _COPY_BATCH_SIZE == 0:
+                copy.write(buffer.getvalue())
+                buffer.seek(0)
+                buffer.truncate()
+        copy.write(buffer.getvalue())
+    return count
+
+
+def generate_vocabulary(connection_string: str,
+                        schema: str,
+                        concept_count: int,
+                        synonyms_per_concept: float = 1.0,
+                        source_concepts_per_concept: float = 0.5,
+                        seed: int = 0) -> Dict[str, int]:
+    """
+    Creates a synthetic OMOP vocabulary in a (new) schema: standard concepts in a random is-a hierarchy with their
+    ancestors, non-standard source concepts mapped to them, and synonyms in English and another language.
+
+    Args:
+        connection_string: The psycopg connection string of the database server.
+        schema: The schema to create. An existing schema with this name is dropped.
+        concept_count: Number of standard concepts.
+        synonyms_per_concept: Average number of synonyms per concept.
+        source_concepts_per_concept: Number of non-standard source concepts per standard concept.
+        seed: Seed of the random generator.
+
+    Returns:
+        The number of rows created per table.
+    """
+    rng = np.random.default_rng(seed)
+    source_count = int(concept_count * source_concepts_per_concept)
+    total_count = concept_count + source_count
+    concept_ids = np.arange(1, total_count + 1)
+    # Each standard concept is a child of an earlier concept of the same domain, except for a few roots:
+    domains = np.arange(concept_count) % len(_DOMAINS)
+    parents = np.full(concept_count, -1)
+    children = np.arange(len(_DOMAINS) * 10, concept_count)
+    parents[children] = domains[children] + len(_DOMAINS) * (rng.random(len(children)) *
+                                                             (children // len(_DOMAINS))).astype(int)
+    # Source concepts map to a random standard concept, and share its domain:
+    source_targets = rng.integers(0, concept_count, size=source_count)
+    concept_domains = np.concatenate([domains, domains[source_targets]])
+
+    counts = {}
+    with psycopg.connect(connection_string) as conn:
+        conn.execute(sql.SQL("DROP SCHEMA IF EXISTS {schema} CASCADE").format(schema=sql.Identifier(schema)))
+        conn.execute(sql.SQL("CREATE SCHEMA {schema}").format(schema=sql.Identifier(schema)))
+        for table, columns in _TABLES.items():
+            conn.execute(sql.SQL("CREATE TABLE {schema}.{table} ({columns})").format(
+                schema=sql.Identifier(schema),
+                table=sql.Identifier(table),
+                columns=sql.SQL(columns)))
+
+        names = _names(rng, total_count)
+        concept_rows = ((int(concept_ids[i]),
+                         names[i],
+                         _DOMAINS[concept_domains[i]],
+                         "SNOMED" if i < concept_count else "ICD10CM",
+                         "Clinical Finding" if i < concept_count else "5-char billing code",
+                         "S" if i < concept_count else None,
+                         f"C{concept_ids[i]}",
+                         "1970-01-01",
+                         "2099-12-31",
+                         None) for i in range(total_count))
+        counts["concept"] = _copy_rows(conn, schema, "concept", concept_rows)
+
+        synonym_counts = rng.poisson(synonyms_per_concept, size=total_count)
+        synonym_names = _names(rng, int(synonym_counts.sum()))
+        synonym_concepts = np.repeat(concept_ids, synonym_counts)
+        languages = np.where(rng.random(len(synonym_concepts)) < 0.9, _ENGLISH, _OTHER_LANGUAGE)
+        synonym_rows = ((int(synonym_concepts[i]), synonym_names[i], int(languages[i]))
+                        for i in range(len(synonym_concepts)))
+        counts["concept_synonym"] = _copy_rows(conn, schema, "concept_synonym", synonym_rows)
+
+        def relationship_rows():
+            for i in np.flatnonzero(parents >= 0):
+                yield int(concept_ids[i]), int(concept_ids[parents[i]]), "Is a", "1970-01-01", "2099-12-31", None
+                yield int(concept_ids[parents[i]]), int(concept_ids[i]), "Subsumes", "1970-01-01", "2099-12-31", None
+            for i in range(source_count):
+                source_id = int(concept_ids[concept_count + i])
+                target_id = int(concept_ids[source_targets[i]])
+                yield source_id, target_id, "Maps to", "1970-01-01", "2099-12-31", None
+                yield target_id, source_id, "Mapped from", "1970-01-01", "2099-12-31", None
+            for i in range(concept_count):
+                yield int(concept_ids[i]), int(concept_ids[i]), "Maps to", "1970-01-01", "2099-12-31", None
+
+        counts["concept_relationship"] = _copy_rows(conn, schema, "concept_relationship", relationship_rows())
+
+        def ancestor_rows():
+            for level_rows in _ancestors(parents):
+                for descendant, ancestor, level in level_rows:
+                    yield int(concept_ids[ancestor]), int(concept_ids[descendant]), int(level), int(level)
+
+        counts["concept_ancestor"] = _copy_rows(conn, schema, "concept_ancestor", ancestor_rows())
+        for table, column in [("concept", "concept_id"),
+                              ("concept_synonym", "concept_id"),
+                              ("concept_relationship", "concept_id_1"),
+                              ("concept_relationship", "concept_id_2"),
+                              ("concept_ancestor", "descendant_concept_id")]:
+            conn.execute(sql.SQL("CREATE INDEX ON {schema}.{table} ({column})").format(
+                schema=sql.Identifier(schema),
+                table=sql.Identifier(table),
+                column=sql.Identifier(column)))
+        conn.execute("ANALYZE")
+    logging.info(", ".join(f"{count} {table} rows" for table, count in counts.items()))
+    return counts
+
+
+def write_record_counts(file_name: str, concept_count: int, used_fraction: float = 0.3, seed: int = 0) -> int:
+    """
+    Writes a ConceptRecordCounts.csv file with Zipf-distributed record counts for a random subset of the standard
+    concepts of a synthetic vocabulary.
+
+    Returns:
+        The number of concepts with a record count.
+    """
+    rng = np.random.default_rng(seed)
+    used = np.flatnonzero(rng.random(concept_count) < used_fraction) + 1
+    record_counts = rng.zipf(1.5, size=len(used))
+    with open(file_name, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["concept_id", "record_count"])
+        writer.writerows(zip(used.tolist(), record_counts.tolist()))
+    return len(used)
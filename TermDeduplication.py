@@ -0,0 +1,131 @@
+import logging
+from typing import Tuple, Iterator, List, Optional
+
+from sqlalchemy import select, MetaData, Table, Column, Integer, String
+from sqlalchemy.engine import Engine
+
+from EmbeddingCache import normalize_text
+
+# In deduplicated mode, each unique normalized text is embedded and stored once, no matter how many concepts it is a
+# term of. The terms database gets two derived tables:
+#   unique_terms:  one row per unique normalized text, with its text_id in order of first occurrence.
+#   concept_terms: the compact mapping from each text_id to the (concept_id, term_type) pairs it is a term of.
+# and a single row in term_deduplication with the number of terms, unique texts, and concept terms, for reporting.
+
+UNIQUE_TERMS_TABLE = "unique_terms"
+CONCEPT_TERMS_TABLE = "concept_terms"
+DEDUPLICATION_TABLE = "term_deduplication"
+
+_INSERT_BATCH_SIZE = 10000
+
+
+def _get_tables(metadata: MetaData) -> Tuple[Table, Table, Table]:
+    unique_terms = Table(UNIQUE_TERMS_TABLE, metadata,
+                         Column("text_id", Integer, primary_key=True, autoincrement=False),
+                         Column("term", String))
+    concept_terms = Table(CONCEPT_TERMS_TABLE, metadata,
+                          Column("text_id", Integer),
+                          Column("concept_id", Integer),
+                          Column("term_type", String))
+    deduplication = Table(DEDUPLICATION_TABLE, metadata,
+                          Column("term_count", Integer),
+                          Column("text_count", Integer),
+                          Column("concept_term_count", Integer))
+    return unique_terms, concept_terms, deduplication
+
+
+def create_unique_terms(engine: Engine, query: select) -> Tuple[int, int]:
+    """
+    Groups the terms selected by the terms query by their normalized text (see EmbeddingCache.normalize_text), and
+    (re)creates the unique_terms and concept_terms tables. Text IDs follow the term ID of the first occurrence of each
+    text, so they are the same every time for the same terms.
+
+    Returns:
+        A tuple of the number of (concept, term type, text) rows, and the number of unique texts.
+    """
+    metadata = MetaData()
+    unique_terms, concept_terms, deduplication = _get_tables(metadata)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+
+    text_ids = {}
+    mappings = set()
+    term_count = 0
+    # Reads and writes on the same connection, as SQLite does not allow writing while reading on another connection:
+    with engine.begin() as connection:
+        result = connection.execute(query)
+        while True:
+            chunk = result.fetchmany(_INSERT_BATCH_SIZE)
+            if not chunk:
+                break
+            term_count += len(chunk)
+            new_texts = []
+            new_mappings = []
+            for row in chunk:
+                normalized = normalize_text(row.term)
+                text_id = text_ids.get(normalized)
+                if text_id is None:
+                    text_id = len(text_ids) + 1
+                    text_ids[normalized] = text_id
+                    new_texts.append({"text_id": text_id, "term": row.term})
+                # The same text can be a term of a concept more than once, e.g. as the name of several source
+                # concepts mapped to it:
+                mapping = (text_id, row.concept_id, row.term_type)
+                if mapping not in mappings:
+                    mappings.add(mapping)
+                    new_mappings.append({"text_id": text_id, "concept_id": row.concept_id, "term_type": row.term_type})
+            if new_texts:
+                connection.execute(unique_terms.insert(), new_texts)
+            if new_mappings:
+                connection.execute(concept_terms.insert(), new_mappings)
+        connection.execute(deduplication.insert(), {"term_count": term_count,
+                                                    "text_count": len(text_ids),
+                                                    "concept_term_count": len(mappings)})
+    logging.info(f"Deduplicated {term_count} terms to {len(text_ids)} unique texts, with {len(mappings)} concept terms "
+                 f"(ratio {term_count / max(1, len(text_ids)):.2f})")
+    return term_count, len(text_ids)
+
+
+def create_unique_terms_query(engine: Engine,
+                              after_text_id: Optional[int] = None,
+                              last_text_id: Optional[int] = None) -> select:
+    """
+    Creates the query for the unique texts to embed, with the text ID labeled as term_id so it is used to record and
+    resume progress like the term ID of the terms query.
+    """
+    unique_terms = Table(UNIQUE_TERMS_TABLE, MetaData(), autoload_with=engine)
+    query = select(unique_terms.c.text_id.label("term_id"), unique_terms.c.term)
+    if after_text_id is not None:
+        query = query.where(unique_terms.c.text_id > after_text_id)
+    if last_text_id is not None:
+        query = query.where(unique_terms.c.text_id <= last_text_id)
+    return query.order_by(unique_terms.c.text_id)
+
+
+def get_deduplication_counts(engine: Engine) -> Tuple[int, int, int]:
+    """
+    Returns:
+        A tuple of the number of terms, unique texts, and concept terms of the last deduplication.
+    """
+    deduplication = Table(DEDUPLICATION_TABLE, MetaData(), autoload_with=engine)
+    with engine.connect() as connection:
+        return tuple(connection.execute(select(deduplication)).one())
+
+
+def read_concept_terms(engine: Engine, batch_size: int = 100000) -> Iterator[Tuple[List[int], List[int], List[str]]]:
+    """
+    Reads the concept_terms table in batches.
+
+    Returns:
+        An iterator of tuples of the text IDs, concept IDs, and term types in each batch.
+    """
+    concept_terms = Table(CONCEPT_TERMS_TABLE, MetaData(), autoload_with=engine)
+    with engine.connect() as connection:
+        result = connection.execute(select(concept_terms.c.text_id,
+                                           concept_terms.c.concept_id,
+                                           concept_terms.c.term_type).order_by(concept_terms.c.text_id))
+        while True:
+            chunk = result.fetchmany(batch_size)
+            if not chunk:
+                break
+            yield [row[0] for row in chunk], [row[1] for row in chunk], [row[2] for row in chunk]
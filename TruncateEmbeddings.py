@@ -0,0 +1,69 @@
+import os
+import sys
+from typing import List
+
+from tqdm import tqdm
+
+from EmbeddingFiles import list_embedding_files, read_embedding_file, write_embedding_file, VECTOR_DTYPES
+from EmbeddingManifest import EmbeddingManifest, Shard, file_checksum
+from Quantization import truncate_vectors
+
+
+def truncate_folder(source_folder: str, target_folder: str, dimensions: int, vector_dtype: str = "float32") -> int:
+    """
+    Writes a copy of an embeddings folder with the vectors truncated to the given number of dimensions and
+    L2-renormalized, so a smaller vector store can be created without embedding the terms again. If the source folder
+    has a manifest, the target folder gets a manifest with the same shards.
+
+    Returns:
+        The number of vectors truncated.
+    """
+    os.makedirs(target_folder, exist_ok=True)
+    source_manifest = EmbeddingManifest(source_folder)
+    shards = {shard.file: shard for shard in source_manifest.shards}
+    new_shards = []
+    total_count = 0
+    for file_name in tqdm(list_embedding_files(source_folder)):
+        attributes, vectors = read_embedding_file(os.path.join(source_folder, file_name))
+        if vectors.shape[1] < dimensions:
+            raise ValueError(f"Cannot truncate vectors of {vectors.shape[1]} dimensions to {dimensions} dimensions")
+        target_path = os.path.join(target_folder, file_name)
+        write_embedding_file(file_name=target_path + ".tmp",
+                             columns={name: attributes.column(name) for name in attributes.column_names},
+                             vectors=truncate_vectors(vectors, dimensions),
+                             vector_dtype=vector_dtype)
+        os.replace(target_path + ".tmp", target_path)
+        if file_name in shards:
+            shard = shards[file_name]
+            new_shards.append(Shard(file=file_name,
+                                    first_term_id=shard.first_term_id,
+                                    last_term_id=shard.last_term_id,
+                                    row_count=shard.row_count,
+                                    sha256=file_checksum(target_path)))
+        total_count += attributes.num_rows
+    if source_manifest.exists():
+        target_manifest = EmbeddingManifest(target_folder)
+        target_manifest.fingerprint = source_manifest.fingerprint
+        target_manifest.replace_shards(new_shards)
+    return total_count
+
+
+def main(args: List[str]):
+    source_folder = args[0]
+    target_folder = args[1]
+    dimensions = int(args[2])
+    vector_dtype = args[3] if len(args) > 3 else "float32"
+    if vector_dtype not in VECTOR_DTYPES:
+        raise ValueError(f"vector_dtype must be one of {list(VECTOR_DTYPES.keys())}")
+    if os.path.abspath(source_folder) == os.path.abspath(target_folder):
+        raise ValueError("Source and target folder must be different")
+    total_count = truncate_folder(source_folder, target_folder, dimensions, vector_dtype)
+    print(f"Truncated {total_count} vectors to {dimensions} dimensions")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [4, 5]:
+        raise Exception("Must provide source folder, target folder, number of dimensions, and optionally the vector "
+                        "type as arguments")
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,381 @@
+import csv
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+import numpy as np
+import yaml
+from dotenv import load_dotenv
+from psycopg import sql, connection
+from tqdm import tqdm
+
+from BinaryCopy import COPY_SIGNATURE, COPY_TRAILER, encode_rows
+from EmbeddingCache import EmbeddingCache, get_cached_embedding_vectors
+from EmbeddingFiles import list_embedding_files, read_embedding_batches
+from GenAIApi import get_embedding_vectors, get_embedding_model
+from Logging import open_log
+from Metrics import instrument_stage
+from Quantization import truncate_vectors
+from Settings import Settings
+from UploadEmbeddingVectors import get_connection, get_vector_type, set_maintenance_settings, create_hnsw_index
+
+load_dotenv()
+
+# Measures the recall and latency of pgvector HNSW indexes built with a grid of parameters, against exact nearest
+# neighbours computed by brute force from the Parquet vectors. The vectors are copied into a scratch table next to the
+# vector table, which is dropped when done.
+
+_DEFAULT_M = [8, 16, 32]
+_DEFAULT_EF_CONSTRUCTION = [64, 128]
+_DEFAULT_EF_SEARCH = [10, 20, 40, 80, 160, 320]
+_WARM_UP_QUERIES = 100
+
+# Similarities returned by Postgres are rounded differently than those computed here, most of all for halfvec:
+_SIMILARITY_TOLERANCE = {"vector": 1e-5, "halfvec": 2e-3}
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def sample_query_terms(terms_db_path: str, query_count: int, seed: int = 0) -> List[str]:
+    """
+    Samples distinct terms from the terms database.
+    """
+    with sqlite3.connect(terms_db_path) as conn:
+        terms = [row[0] for row in conn.execute("SELECT DISTINCT concept_name FROM terms ORDER BY concept_name")]
+    rng = np.random.default_rng(seed)
+    return [terms[i] for i in np.sort(rng.choice(len(terms), size=min(query_count, len(terms)), replace=False))]
+
+
+def embed_queries(settings: Settings, terms: List[str], dimensions: int) -> np.ndarray:
+    """
+    Embeds the query terms, using the embedding cache if there is one (the terms were embedded before, so this is
+    normally free), and truncates and L2-normalizes them like the vectors in the table.
+    """
+    texts = [term[:settings.max_text_characters] for term in terms]
+    embed_args = dict(max_workers=settings.embedding_concurrency,
+                      requests_per_minute=settings.requests_per_minute,
+                      tokens_per_minute=settings.tokens_per_minute,
+                      max_retries=settings.embedding_max_retries,
+                      dimensions=settings.dimensions,
+                      encoding_format=settings.embedding_encoding_format)
+    if settings.embedding_cache_path:
+        model, provider = get_embedding_model()
+        cache = EmbeddingCache(path=settings.embedding_cache_path,
+                               provider=provider,
+                               model=model,
+                               dimensions=settings.dimensions,
+                               max_size_mb=settings.embedding_cache_max_mb)
+        try:
+            vectors = get_cached_embedding_vectors(texts, cache, get_embedding_vectors, **embed_args)["embeddings"]
+        finally:
+            cache.close()
+    else:
+        vectors = get_embedding_vectors(texts, **embed_args)["embeddings"]
+    return _normalize(truncate_vectors(np.asarray(vectors, dtype=np.float32), dimensions))
+
+
+def _merge_top_k(top_scores: np.ndarray,
+                 top_rows: np.ndarray,
+                 scores: np.ndarray,
+                 offset: int,
+                 k: int) -> Tuple[np.ndarray, np.ndarray]:
+    rows = np.broadcast_to(np.arange(offset, offset + scores.shape[1]), scores.shape)
+    scores = np.hstack([top_scores, scores])
+    rows = np.hstack([top_rows, rows])
+    selected = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(scores, selected, axis=1), np.take_along_axis(rows, selected, axis=1)
+
+
+def load_table_and_ground_truth(conn: connection,
+                                schema: str,
+                                table: str,
+                                vector_type: str,
+                                file_paths: List[str],
+                                dimensions: int,
+                                queries: np.ndarray,
+                                k: int) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Copies the vectors into the scratch table, each with its position in the Parquet files as row_id, and computes the
+    exact k nearest rows of each query by cosine similarity in the same pass.
+
+    Returns:
+        A tuple of the number of rows, and the (queries x k) row IDs and similarities of the exact nearest neighbours,
+        sorted from nearest to farthest.
+    """
+    top_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    top_rows = np.full((len(queries), k), -1, dtype=np.int64)
+    row_count = 0
+    with conn.cursor().copy(sql.SQL("COPY {schema}.{table} (row_id, embedding_vector) FROM STDIN WITH (FORMAT BINARY)").format(
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(table))) as copy:
+        copy.write(COPY_SIGNATURE)
+        for file_path in tqdm(file_paths):
+            for _, vectors in read_embedding_batches(file_path):
+                vectors = truncate_vectors(np.asarray(vectors, dtype=np.float32), dimensions)
+                row_ids = np.arange(row_count, row_count + len(vectors), dtype=np.int32)
+                copy.write(encode_rows([("int4", row_ids), (vector_type, vectors)]))
+                top_scores, top_rows = _merge_top_k(top_scores, top_rows, queries @ _normalize(vectors).T, row_count,
+                                                    k)
+                row_count += len(vectors)
+        copy.write(COPY_TRAILER)
+    conn.commit()
+    order = np.argsort(-top_scores, axis=1)
+    return row_count, np.take_along_axis(top_rows, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def _recall(results: List[List[Tuple[int, float]]],
+            truth_rows: np.ndarray,
+            truth_scores: np.ndarray,
+            tolerance: float) -> float:
+    # A result also counts as a hit when it is as similar as the k-th exact neighbour, so ties between rows with the
+    # same vector (e.g. the same text as a name and a synonym) are not counted as misses:
+    k = truth_rows.shape[1]
+    hits = 0
+    for result, rows, scores in zip(results, truth_rows, truth_scores):
+        expected = set(rows.tolist())
+        hits += min(k, sum(1 for row_id, similarity in result if row_id in expected or
+                           similarity >= scores[-1] - tolerance))
+    return hits / (k * len(results))
+
+
+def _create_search_statement(schema: str, table: str, vector_type: str, k: int) -> sql.Composed:
+    return sql.SQL("""
+        SELECT row_id, 1 - (embedding_vector <=> %(query)s::{vector_type}) AS similarity
+        FROM {schema}.{table}
+        ORDER BY embedding_vector <=> %(query)s::{vector_type}
+        LIMIT {k}
+        """).format(vector_type=sql.SQL(vector_type),
+                    schema=sql.Identifier(schema),
+                    table=sql.Identifier(table),
+                    k=sql.Literal(k))
+
+
+def _open_search_connection(ef_search: int) -> connection:
+    conn = get_connection()
+    conn.autocommit = True
+    conn.execute(sql.SQL("SET hnsw.ef_search = {ef_search}").format(ef_search=sql.Literal(ef_search)))
+    return conn
+
+
+def _run_queries(conn: connection,
+                 statement: sql.Composed,
+                 queries: np.ndarray) -> Tuple[List[List[Tuple[int, float]]], List[float]]:
+    results = []
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        rows = conn.execute(statement, {"query": query}).fetchall()
+        latencies.append(time.perf_counter() - start_time)
+        results.append([(row_id, similarity) for row_id, similarity in rows])
+    return results, latencies
+
+
+def measure(statement: sql.Composed, queries: np.ndarray, ef_search: int, clients: int) -> Dict[str, Any]:
+    """
+    Runs all queries, one at a time on one connection, and then spread over concurrent clients that each have their
+    own connection. Both runs follow a warm-up, so the index is in the buffer cache, and statements are prepared.
+
+    Returns:
+        The results of the single-client run, and the latency percentiles (ms) and throughput of both runs.
+    """
+    conn = _open_search_connection(ef_search)
+    try:
+        _run_queries(conn, statement, queries[:_WARM_UP_QUERIES])
+        start_time = time.perf_counter()
+        results, latencies = _run_queries(conn, statement, queries)
+        single_seconds = time.perf_counter() - start_time
+    finally:
+        conn.close()
+
+    connections = [_open_search_connection(ef_search) for _ in range(clients)]
+    concurrent_latencies = [[] for _ in range(clients)]
+    barrier = threading.Barrier(clients + 1)
+
+    def run_client(i: int) -> None:
+        try:
+            _run_queries(connections[i], statement, queries[i:_WARM_UP_QUERIES:clients])
+        except Exception:
+            barrier.abort()
+            raise
+        barrier.wait()
+        concurrent_latencies[i] = _run_queries(connections[i], statement, queries[i::clients])[1]
+
+    threads = [threading.Thread(target=run_client, args=(i,)) for i in range(clients)]
+    try:
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start_time = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        concurrent_seconds = time.perf_counter() - start_time
+    finally:
+        for conn in connections:
+            conn.close()
+    concurrent = np.concatenate([np.asarray(client_latencies) for client_latencies in concurrent_latencies])
+    return {"results": results,
+            "p50_ms": round(1000 * float(np.percentile(latencies, 50)), 3),
+            "p99_ms": round(1000 * float(np.percentile(latencies, 99)), 3),
+            "qps": round(len(queries) / single_seconds, 1),
+            "concurrent_p50_ms": round(1000 * float(np.percentile(concurrent, 50)), 3),
+            "concurrent_p99_ms": round(1000 * float(np.percentile(concurrent, 99)), 3),
+            "concurrent_qps": round(len(queries) / concurrent_seconds, 1)}
+
+
+def recommend(rows: List[Dict[str, Any]], target_recall: float) -> Optional[Dict[str, Any]]:
+    """
+    Picks the parameters with the lowest single-client p99 latency that reach the target recall.
+    """
+    candidates = [row for row in rows if row["recall"] >= target_recall]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda row: (row["p99_ms"], row["index_mb"]))
+
+
+def write_report(rows: List[Dict[str, Any]],
+                 settings: Settings,
+                 row_count: int,
+                 dimensions: int,
+                 vector_type: str,
+                 query_count: int,
+                 k: int) -> None:
+    """
+    Writes all measurements to TuneHnsw.csv, and a summary with the recommended parameters to TuneHnsw.md, in the log
+    folder.
+    """
+    columns = ["m", "ef_construction", "build_seconds", "index_mb", "ef_search", "recall", "p50_ms", "p99_ms", "qps",
+               "concurrent_p50_ms", "concurrent_p99_ms", "concurrent_qps"]
+    with open(os.path.join(settings.log_folder, "TuneHnsw.csv"), "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    best = recommend(rows, settings.tune_target_recall)
+    lines = ["# HNSW parameter tuning",
+             "",
+             f"{row_count} vectors ({vector_type}, {dimensions} dimensions), {query_count} query terms, recall@{k} "
+             f"against exact search, {settings.tune_clients} concurrent clients.",
+             ""]
+    if best is None:
+        lines.append(f"No parameters reached the target recall of {settings.tune_target_recall}.")
+    else:
+        lines.append(f"Fastest parameters reaching recall {settings.tune_target_recall}: m = {best['m']}, "
+                     f"ef_construction = {best['ef_construction']}, ef_search = {best['ef_search']} (recall "
+                     f"{best['recall']:.3f}, p99 {best['p99_ms']} ms). Set hnsw_m and hnsw_ef_construction in the "
+                     f"settings, and ef_search per search session.")
+    lines.extend(["",
+                  "| " + " | ".join(columns) + " |",
+                  "|" + "---|" * len(columns)])
+    for row in rows:
+        lines.append("| " + " | ".join(str(row[column]) for column in columns) + " |")
+    with open(os.path.join(settings.log_folder, "TuneHnsw.md"), "w", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def tune(settings: Settings, query_count: int = 1000, k: int = 10) -> None:
+    schema = os.getenv("VOCAB_SCHEMA")
+    table = f"{os.getenv('VOCAB_VECTOR_TABLE')}_hnsw_tune"
+    if settings.store_type == settings.PGVECTOR_BINARY:
+        logging.warning("Tuning the HNSW index on the full-precision vectors, not on the binary vectors")
+    vector_type = get_vector_type(settings)
+    file_paths = [os.path.join(settings.embeddings_folder, f) for f in list_embedding_files(settings.embeddings_folder)]
+    if len(file_paths) == 0:
+        raise Exception(f"No Parquet files found in {settings.embeddings_folder}")
+    _, first_vectors = next(read_embedding_batches(file_paths[0]))
+    dimensions = first_vectors.shape[1]
+    if settings.dimensions is not None:
+        dimensions = min(dimensions, settings.dimensions)
+
+    terms = sample_query_terms(settings.terms_db_path, query_count)
+    logging.info(f"Embedding {len(terms)} query terms")
+    queries = embed_queries(settings, terms, dimensions)
+
+    conn = get_connection()
+    try:
+        conn.execute(sql.SQL("DROP TABLE IF EXISTS {schema}.{table}").format(schema=sql.Identifier(schema),
+                                                                         table=sql.Identifier(table)))
+        conn.execute(sql.SQL("CREATE UNLOGGED TABLE {schema}.{table} (row_id INT, embedding_vector {vector_type}({dimensions}))").format(
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(table),
+            vector_type=sql.SQL(vector_type),
+            dimensions=sql.Literal(dimensions)))
+        logging.info(f"Copying vectors to {schema}.{table} and computing the exact {k} nearest neighbours")
+        row_count, truth_rows, truth_scores = load_table_and_ground_truth(conn, schema, table, vector_type, file_paths,
+                                                                          dimensions, queries, k)
+        conn.execute(sql.SQL("ANALYZE {schema}.{table}").format(schema=sql.Identifier(schema),
+                                                                table=sql.Identifier(table)))
+        conn.commit()
+        conn.autocommit = True
+        set_maintenance_settings(conn, settings)
+
+        statement = _create_search_statement(schema, table, vector_type, k)
+        rows = []
+        for m in settings.tune_hnsw_m or _DEFAULT_M:
+            for ef_construction in settings.tune_hnsw_ef_construction or _DEFAULT_EF_CONSTRUCTION:
+                if ef_construction < 2 * m:
+                    logging.info(f"Skipping m = {m}, ef_construction = {ef_construction}: pgvector requires "
+                                 f"ef_construction to be at least 2 * m")
+                    continue
+                conn.execute(sql.SQL("DROP INDEX IF EXISTS {schema}.{index}").format(
+                    schema=sql.Identifier(schema),
+                    index=sql.Identifier(f"{table}_embedding_vector_idx")))
+                build_seconds = create_hnsw_index(conn, schema, table, "embedding_vector", f"{vector_type}_cosine_ops",
+                                                  m, ef_construction)
+                index_bytes = conn.execute("SELECT pg_relation_size(%s::regclass)",
+                                           (f'"{schema}"."{table}_embedding_vector_idx"',)).fetchone()[0]
+                for ef_search in settings.tune_hnsw_ef_search or _DEFAULT_EF_SEARCH:
+                    measurement = measure(statement, queries, ef_search, settings.tune_clients)
+                    row = {"m": m,
+                           "ef_construction": ef_construction,
+                           "build_seconds": round(build_seconds, 1),
+                           "index_mb": round(index_bytes / 2**20, 1),
+                           "ef_search": ef_search,
+                           "recall": round(_recall(measurement.pop("results"), truth_rows, truth_scores,
+                                                   _SIMILARITY_TOLERANCE[vector_type]), 4)}
+                    row.update(measurement)
+                    rows.append(row)
+                    logging.info(f"m = {m}, ef_construction = {ef_construction}, ef_search = {ef_search}: recall@{k} "
+                                 f"{row['recall']:.3f}, p50 {row['p50_ms']} ms, p99 {row['p99_ms']} ms, "
+                                 f"{settings.tune_clients} clients: p50 {row['concurrent_p50_ms']} ms, p99 "
+                                 f"{row['concurrent_p99_ms']} ms, {row['concurrent_qps']} queries/sec")
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+        conn.execute(sql.SQL("DROP TABLE IF EXISTS {schema}.{table}").format(schema=sql.Identifier(schema),
+                                                                         table=sql.Identifier(table)))
+        conn.close()
+
+    write_report(rows, settings, row_count, dimensions, vector_type, len(queries), k)
+    best = recommend(rows, settings.tune_target_recall)
+    if best is None:
+        logging.info(f"No parameters reached the target recall of {settings.tune_target_recall}")
+    else:
+        logging.info(f"Recommended: m = {best['m']}, ef_construction = {best['ef_construction']}, ef_search = "
+                     f"{best['ef_search']} (recall {best['recall']:.3f}, p99 {best['p99_ms']} ms)")
+    logging.info(f"Report written to {os.path.join(settings.log_folder, 'TuneHnsw.md')}")
+
+
+@instrument_stage("TuneHnsw")
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = Settings(config)
+    os.makedirs(settings.log_folder, exist_ok=True)
+    open_log(os.path.join(settings.log_folder, "logTuneHnsw.txt"))
+
+    tune(settings, query_count=int(args[1]) if len(args) > 1 else 1000)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3]:
+        raise Exception("Must provide path to yaml file, and optionally the number of query terms, as arguments")
+    else:
+        main(sys.argv[1:])
@@ -1,18 +1,29 @@
 import logging
 import os
+import re
 import sys
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional
 
+import numpy as np
 import psycopg
-import pyarrow.parquet as pq
 import yaml
 from dotenv import load_dotenv
-from psycopg import sql, connection
-from pgvector.psycopg import register_vector
+from psycopg import sql, connection, Copy
+from pgvector.psycopg import register_vector, Bit
+from sqlalchemy import create_engine, inspect, text
 from tqdm import tqdm
 
+from BinaryCopy import COPY_SIGNATURE, COPY_TRAILER, encode_rows
+from EmbeddingFiles import (list_embedding_files, read_embedding_batches, get_vector_size as get_file_vector_size,
+                            CONCEPT_COLUMNS)
+from Quantization import truncate_vectors
 from Settings import Settings
 from Logging import open_log
+from Metrics import instrument_stage, timer, increment, observe
+from TermDeduplication import read_concept_terms, get_deduplication_counts
 
 load_dotenv()
 
@@ -21,79 +32,637 @@ def get_vector_size(parquet_folder: str):
     """
     Get the size of the vector from the first Parquet file in the folder.
     """
-    file_list = sorted([f for f in os.listdir(parquet_folder) if f.endswith(".parquet")])
+    file_list = list_embedding_files(parquet_folder)
     if len(file_list) == 0:
         raise Exception("No Parquet files found in the specified folder.")
-    file_path = os.path.join(parquet_folder, file_list[0])
-    parquet_file = pq.ParquetFile(file_path)
-    row_group = parquet_file.read_row_group(0)
-    return row_group.num_columns - 2
+    return get_file_vector_size(os.path.join(parquet_folder, file_list[0]))
 
-def create_table_in_pgvector(conn: connection, schema: str, table: str, vector_type: str, dimensions: int):
+def get_connection() -> connection:
+    # Unable to register_vector when using sqlalchemy, so using psycopg directly:
+    conn = psycopg.connect(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", ""))
+    # conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
+    register_vector(conn)
+    return conn
+
+def get_vector_type(settings: Settings) -> str:
+    """
+    Gets the pgvector type of the full-precision vectors. With binary quantization, these are only used for
+    re-ranking.
+    """
+    if settings.store_type == settings.PGVECTOR_BINARY:
+        return settings.binary_full_vector_type
+    return "vector" if settings.store_type == settings.PGVECTOR else "halfvec"
+
+def get_partition_domains(conn: connection, schema: str, settings: Settings) -> Optional[List[str]]:
+    """
+    Gets the domains to create a partition of the vector table for: the domains in the settings, or all domains with
+    standard concepts if the settings do not restrict the domains. Returns None when not partitioning by domain.
+    """
+    if not settings.partition_by_domain:
+        return None
+    if settings.domain_ids:
+        return list(settings.domain_ids)
+    rows = conn.execute(sql.SQL(
+        "SELECT DISTINCT domain_id FROM {schema}.concept WHERE standard_concept IS NOT NULL ORDER BY domain_id").format(
+        schema=sql.Identifier(schema))).fetchall()
+    return [row[0] for row in rows]
+
+def get_partition_name(table: str, domain_id: str) -> str:
+    return f"{table}_{re.sub(r'[^a-z0-9]+', '_', domain_id.lower()).strip('_')}"
+
+def get_concept_term_table(table: str) -> str:
+    """
+    Gets the name of the table mapping the texts in a deduplicated vector table to their concepts.
+    """
+    return f"{table}_concept_term"
+
+def get_partitions(conn: connection, schema: str, table: str) -> List[str]:
+    """
+    Gets the names of the partitions of a table, or an empty list if the table is not partitioned.
+    """
+    rows = conn.execute("SELECT child.relname FROM pg_inherits "
+                        "INNER JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                        "WHERE pg_inherits.inhparent = %s::regclass ORDER BY child.relname",
+                        (f'"{schema}"."{table}"',)).fetchall()
+    return [row[0] for row in rows]
+
+def create_table_in_pgvector(conn: connection,
+                             schema: str,
+                             table: str,
+                             vector_type: str,
+                             dimensions: int,
+                             unlogged: bool = False,
+                             binary: bool = False,
+                             partition_domains: Optional[List[str]] = None,
+                             deduplicated: bool = False):
+    """
+    Creates the vector table. If partition domains are given, the table also holds the domain, vocabulary, and
+    standard_concept flag of each concept, and is list partitioned by domain, with a partition per domain and a
+    default partition for all other domains. A deduplicated table holds one vector per unique text, identified by its
+    text_id, and a separate table maps the texts to their concepts.
+    """
+    partitioned = partition_domains is not None
     statement = sql.SQL(
-        "CREATE TABLE IF NOT EXISTS {schema}.{table} (concept_id INT, term_type VARCHAR(7), embedding_vector {vector_type}({dimensions}))").format(
+        "CREATE {unlogged} TABLE IF NOT EXISTS {schema}.{table} ({key_columns}, {concept_columns}embedding_vector {vector_type}({dimensions}){binary_vector}){partition}").format(
+        unlogged=sql.SQL("UNLOGGED" if unlogged and not partitioned else ""),
+        key_columns=sql.SQL("text_id INT" if deduplicated else "concept_id INT, term_type VARCHAR(7)"),
+        concept_columns=sql.SQL("domain_id VARCHAR(20), vocabulary_id VARCHAR(20), standard_concept VARCHAR(1), " if partitioned else ""),
+        binary_vector=sql.SQL(", binary_vector bit({dimensions})").format(dimensions=sql.Literal(dimensions)) if binary else sql.SQL(""),
         vector_type=sql.SQL(vector_type),
         schema=sql.Identifier(schema),
         table=sql.Identifier(table),
-        dimensions=sql.Literal(dimensions)
+        dimensions=sql.Literal(dimensions),
+        partition=sql.SQL(" PARTITION BY LIST (domain_id)" if partitioned else "")
     )
     conn.execute(statement)
+    if deduplicated:
+        conn.execute(sql.SQL("CREATE {unlogged} TABLE IF NOT EXISTS {schema}.{table} (text_id INT, concept_id INT, term_type VARCHAR(7))").format(
+            unlogged=sql.SQL("UNLOGGED" if unlogged else ""),
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(get_concept_term_table(table))
+        ))
+    if not partitioned:
+        return
+    # The rows of a partitioned table are stored in its partitions, so these are made unlogged instead:
+    for domain_id in partition_domains:
+        conn.execute(sql.SQL("CREATE {unlogged} TABLE IF NOT EXISTS {schema}.{partition} PARTITION OF {schema}.{table} FOR VALUES IN ({domain_id})").format(
+            unlogged=sql.SQL("UNLOGGED" if unlogged else ""),
+            schema=sql.Identifier(schema),
+            partition=sql.Identifier(get_partition_name(table, domain_id)),
+            table=sql.Identifier(table),
+            domain_id=sql.Literal(domain_id)
+        ))
+    conn.execute(sql.SQL("CREATE {unlogged} TABLE IF NOT EXISTS {schema}.{partition} PARTITION OF {schema}.{table} DEFAULT").format(
+        unlogged=sql.SQL("UNLOGGED" if unlogged else ""),
+        schema=sql.Identifier(schema),
+        partition=sql.Identifier(f"{table}_default"),
+        table=sql.Identifier(table)
+    ))
 
-def load_vectors_in_pgvector(settings: Settings):
-    # Unable to register_vector when using sqlalchemy, so using psycopg directly:
-    conn = psycopg.connect(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", ""))
+def create_copy_statement(schema: str,
+                          table: str,
+                          binary: bool = False,
+                          partitioned: bool = False,
+                          deduplicated: bool = False) -> sql.Composed:
+    """
+    Creates the binary COPY statement matching write_vectors. Rows copied into a partitioned table are routed to the
+    partition of their domain by the server.
+    """
+    key_columns = ["text_id"] if deduplicated else ["concept_id", "term_type"]
+    columns = key_columns + (CONCEPT_COLUMNS if partitioned else []) + ["embedding_vector"]
+    if binary:
+        columns.append("binary_vector")
+    return sql.SQL("COPY {schema}.{table} ({columns}) FROM STDIN WITH (FORMAT BINARY)").format(
+        schema=sql.Identifier(schema),
+        table=sql.Identifier(table),
+        columns=sql.SQL(", ").join(sql.Identifier(column) for column in columns)
+    )
 
-    # conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
-    register_vector(conn)
-    vector_type = "vector" if settings.store_type == settings.PGVECTOR else "halfvec"
+def get_copy_types(vector_type: str,
+                   binary: bool = False,
+                   partitioned: bool = False,
+                   deduplicated: bool = False) -> List[str]:
+    return ((["int4"] if deduplicated else ["int4", "varchar"]) + (["varchar"] * len(CONCEPT_COLUMNS) if partitioned else []) + [vector_type] +
+            (["bit"] if binary else []))
 
-    # Create table if it doesn't exist
-    vector_size = get_vector_size(settings.embeddings_folder)
-    create_table_in_pgvector(conn, os.getenv("VOCAB_SCHEMA"), os.getenv("VOCAB_VECTOR_TABLE"), vector_type, vector_size)
+def write_vectors(copy: Copy,
+                  attributes,
+                  vectors,
+                  vector_type: str,
+                  vectorized: bool,
+                  binary: bool = False,
+                  partitioned: bool = False,
+                  deduplicated: bool = False) -> None:
+    """
+    Writes a batch of vectors to a binary COPY stream, either encoding the whole batch at once, or row by row using
+    psycopg. When using the vectorized encoder, the caller must write the COPY signature and trailer. When binary is
+    true, the binary quantized vectors are written as an extra column. When partitioned is true, the concept columns
+    (domain_id, vocabulary_id, standard_concept) are written too. When deduplicated is true, each vector is keyed by
+    its text_id instead of its concept_id and term_type.
+    """
+    concept_columns = CONCEPT_COLUMNS if partitioned else []
+    if partitioned and "domain_id" not in attributes.column_names:
+        raise ValueError("The embedding files do not have the domain of each concept, so cannot be uploaded to a "
+                         "table partitioned by domain. Download the terms and create the embeddings again")
+    if deduplicated and "text_id" not in attributes.column_names:
+        raise ValueError("The embedding files were not created with deduplicate_terms, so cannot be uploaded to a "
+                         "deduplicated table")
+    if vectorized:
+        if deduplicated:
+            columns = [("int4", attributes.column("text_id"))]
+        else:
+            columns = [("int4", attributes.column("concept_id")),
+                       ("varchar", attributes.column("term_type"))]
+        columns.extend(("varchar", attributes.column(name)) for name in concept_columns)
+        columns.append((vector_type, vectors))
+        if binary:
+            columns.append(("bit", vectors))
+        with timer("copy_encode_seconds"):
+            buffer = encode_rows(columns)
+        with timer("copy_write_seconds"):
+            copy.write(buffer)
+        increment("copy_bytes_written", len(buffer))
+    else:
+        if deduplicated:
+            keys = [[int(text_id)] for text_id in attributes.column("text_id").to_pylist()]
+        else:
+            keys = [[int(concept_id), term_type] for concept_id, term_type in
+                    zip(attributes.column("concept_id").to_pylist(), attributes.column("term_type").to_pylist())]
+        concept_values = [attributes.column(name).to_pylist() for name in concept_columns]
+        with timer("copy_write_seconds"):
+            for j in range(len(keys)):
+                row = keys[j] + [values[j] for values in concept_values] + [vectors[j]]
+                if binary:
+                    row.append(Bit("".join(map(str, (vectors[j] > 0).astype(np.uint8)))))
+                copy.write_row(row)
+    increment("copy_rows_written", len(vectors))
 
+def copy_vectors(conn: connection,
+                 file_paths: List[str],
+                 schema: str,
+                 table: str,
+                 vector_type: str,
+                 vectorized: bool,
+                 progress: tqdm,
+                 binary: bool = False,
+                 dimensions: Optional[int] = None,
+                 partitioned: bool = False,
+                 deduplicated: bool = False,
+                 cancel: Optional[threading.Event] = None) -> int:
+    """
+    Copies the vectors in a list of Parquet files into a table using a single COPY, without committing. If dimensions
+    is set, wider vectors are truncated to that number of dimensions and L2-renormalized. If the cancel event is set,
+    the COPY is aborted before the next file.
+    """
     cur = conn.cursor()
-    statement = sql.SQL("COPY {schema}.{table} (concept_id, term_type, embedding_vector) FROM STDIN WITH (FORMAT BINARY)").format(
-        schema=sql.Identifier(os.getenv("VOCAB_SCHEMA")),
-        table=sql.Identifier(os.getenv("VOCAB_VECTOR_TABLE"))
-    )
-    with cur.copy(statement) as copy:
-        copy.set_types(["int4", "varchar", vector_type])
-
-        # Iterate over Parquet files:
-        total_count = 0
-        file_list = sorted([f for f in os.listdir(settings.embeddings_folder) if f.endswith(".parquet")])
-        for i in tqdm(range(0, len(file_list))):
-            file_name = file_list[i]
-            logging.info(f"Processing Parquet file '{file_name}'")
-            file_path = os.path.join(settings.embeddings_folder, file_name)
-            parquet_file = pq.ParquetFile(file_path)
-            for row_group_idx in range(parquet_file.num_row_groups):
-                row_group = parquet_file.read_row_group(row_group_idx)
-                concept_ids = row_group.column("concept_id").to_pylist()
-                term_types = row_group.column("term_type").to_pylist()
-                embedding_columns = [row_group.column(i).to_pylist() for i in range(2, row_group.num_columns)]
-                logging.info(f"- Inserting {len(concept_ids)} vectors")
-                # Iterate over rows
-                for j, embedding in enumerate(zip(*embedding_columns)):
-                    concept_id = int(concept_ids[j])
-                    term_type = term_types[j]
-                    copy.write_row([concept_id, term_type, embedding])
-                total_count = total_count + len(concept_ids)
-                logging.info(f"- Inserted {total_count} vectors in total")
-            # Flush data
+    total_count = 0
+    with cur.copy(create_copy_statement(schema, table, binary, partitioned, deduplicated)) as copy:
+        if vectorized:
+            copy.write(COPY_SIGNATURE)
+        else:
+            copy.set_types(get_copy_types(vector_type, binary, partitioned, deduplicated))
+        for file_path in file_paths:
+            if cancel is not None and cancel.is_set():
+                raise Exception("Upload cancelled, as another upload worker failed")
+            logging.info(f"Processing Parquet file '{os.path.basename(file_path)}'")
+            for attributes, vectors in read_embedding_batches(file_path):
+                if dimensions is not None:
+                    vectors = truncate_vectors(vectors, dimensions)
+                write_vectors(copy, attributes, vectors, vector_type, vectorized, binary, partitioned, deduplicated)
+                total_count = total_count + attributes.num_rows
+            progress.update(1)
+        if vectorized:
+            copy.write(COPY_TRAILER)
+        # Flush data
         while conn.pgconn.flush() == 1:
             pass
+    logging.info(f"- Inserted {total_count} vectors")
+    return total_count
+
+def copy_files(file_paths: List[str],
+               schema: str,
+               table: str,
+               vector_type: str,
+               vectorized: bool,
+               progress: tqdm,
+               binary: bool = False,
+               dimensions: Optional[int] = None,
+               partitioned: bool = False,
+               deduplicated: bool = False,
+               cancel: Optional[threading.Event] = None) -> int:
+    """
+    Copies the vectors in a list of Parquet files into a table on its own connection, and commits. Nothing is
+    committed if the copy fails or is cancelled.
+    """
+    conn = get_connection()
+    try:
+        total_count = copy_vectors(conn, file_paths, schema, table, vector_type, vectorized, progress, binary,
+                                   dimensions, partitioned, deduplicated, cancel)
+        conn.commit()
+    finally:
+        conn.close()
+    return total_count
+
+def copy_concept_terms(conn: connection, terms_db_path: str, schema: str, table: str) -> int:
+    """
+    Copies the concept_terms table of the terms database into the concept term table of a deduplicated vector table,
+    without committing.
+    """
+    engine = create_engine(f"sqlite:///{terms_db_path}")
+    total_count = 0
+    with conn.cursor().copy(sql.SQL("COPY {schema}.{table} (text_id, concept_id, term_type) FROM STDIN WITH (FORMAT BINARY)").format(
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(get_concept_term_table(table)))) as copy:
+        copy.write(COPY_SIGNATURE)
+        for text_ids, concept_ids, term_types in read_concept_terms(engine):
+            with timer("copy_write_seconds"):
+                copy.write(encode_rows([("int4", text_ids), ("int4", concept_ids), ("varchar", term_types)]))
+            total_count += len(text_ids)
+        copy.write(COPY_TRAILER)
+    logging.info(f"Inserted {total_count} concept terms")
+    return total_count
+
+def _log_index_progress(pid: int, stop: threading.Event, interval: float = 10.0):
+    conn = get_connection()
+    conn.autocommit = True
+    while not stop.wait(interval):
+        row = conn.execute(
+            "SELECT phase, round(100.0 * blocks_done / nullif(blocks_total, 0), 1), "
+            "round(100.0 * tuples_done / nullif(tuples_total, 0), 1) "
+            "FROM pg_stat_progress_create_index WHERE pid = %s", (pid,)
+        ).fetchone()
+        if row is not None:
+            logging.info(f"- Index build phase: {row[0]}, blocks: {row[1]}%, tuples: {row[2]}%")
+    conn.close()
+
+def set_maintenance_settings(conn: connection, settings: Settings) -> None:
+    """
+    Sets the memory and parallel workers available to index builds on this connection.
+    """
+    if settings.maintenance_work_mem:
+        conn.execute(sql.SQL("SET maintenance_work_mem = {value}").format(value=sql.Literal(settings.maintenance_work_mem)))
+    if settings.max_parallel_maintenance_workers is not None:
+        conn.execute(sql.SQL("SET max_parallel_maintenance_workers = {value}").format(
+            value=sql.Literal(settings.max_parallel_maintenance_workers)))
+
+def create_hnsw_index(conn: connection, schema: str, table: str, column: str, ops: str, m: int, ef_construction: int) -> float:
+    """
+    Creates an HNSW index named <table>_embedding_vector_idx, logging the progress of the build.
+
+    Returns:
+        The build time in seconds.
+    """
+    logging.info(f"Creating HNSW index on {table} (m = {m}, ef_construction = {ef_construction})")
+    stop = threading.Event()
+    monitor = threading.Thread(target=_log_index_progress, args=(conn.info.backend_pid, stop), daemon=True)
+    monitor.start()
+    start_time = time.time()
+    try:
+        conn.execute(sql.SQL(
+            "CREATE INDEX IF NOT EXISTS {index} ON {schema}.{table} USING hnsw ({column} {ops}) WITH (m = {m}, ef_construction = {ef_construction})").format(
+            index=sql.Identifier(f"{table}_embedding_vector_idx"),
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(table),
+            column=sql.Identifier(column),
+            ops=sql.SQL(ops),
+            m=sql.Literal(m),
+            ef_construction=sql.Literal(ef_construction)
+        ))
+    finally:
+        stop.set()
+        monitor.join()
+    seconds = time.time() - start_time
+    index_size = conn.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass))",
+                              (f'"{schema}"."{table}_embedding_vector_idx"',)).fetchone()[0]
+    observe("hnsw_build_seconds", seconds)
+    logging.info(f"Created HNSW index of {index_size} in {seconds:.0f} seconds")
+    return seconds
+
+def create_indexes(conn: connection, schema: str, table: str, vector_type: str, settings: Settings) -> float:
+    """
+    Creates the HNSW index on the vectors and the index on concept_id, logging the progress of the HNSW build. With
+    binary quantization, the HNSW index is created on the binary vectors using the Hamming distance. A partitioned
+    table gets a separate HNSW index per partition, so a search within a domain only scans the graph of that domain.
+    For a deduplicated table, the concept term table is indexed on text_id and concept_id instead.
+
+    Returns:
+        The total build time of the HNSW indexes in seconds.
+    """
+    if settings.store_type == settings.PGVECTOR_BINARY:
+        column = "binary_vector"
+        ops = "bit_hamming_ops"
+    else:
+        column = "embedding_vector"
+        ops = f"{vector_type}_cosine_ops"
+    set_maintenance_settings(conn, settings)
+    seconds = 0.0
+    for index_table in get_partitions(conn, schema, table) or [table]:
+        seconds += create_hnsw_index(conn, schema, index_table, column, ops, settings.hnsw_m,
+                                     settings.hnsw_ef_construction)
+    if settings.deduplicate_terms:
+        concept_term_table = get_concept_term_table(table)
+        for index_column in ["text_id", "concept_id"]:
+            conn.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {index} ON {schema}.{table} ({column})").format(
+                index=sql.Identifier(f"{concept_term_table}_{index_column}_idx"),
+                schema=sql.Identifier(schema),
+                table=sql.Identifier(concept_term_table),
+                column=sql.Identifier(index_column)
+            ))
+    else:
+        conn.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {index} ON {schema}.{table} (concept_id)").format(
+            index=sql.Identifier(f"{table}_concept_id_idx"),
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(table)
+        ))
+    conn.commit()
+    return seconds
+
+def swap_in_staging_table(conn: connection, schema: str, staging_table: str, table: str):
+    """
+    Replaces the table with the staging table in a single transaction, so queries never see a half-built store. The
+    partitions of a partitioned staging table, and their indexes, are renamed too, and so is the concept term table of
+    a deduplicated staging table.
+    """
+    partitions = get_partitions(conn, schema, staging_table)
+    deduplicated = conn.execute("SELECT to_regclass(%s)",
+                                (f'"{schema}"."{get_concept_term_table(staging_table)}"',)).fetchone()[0] is not None
+    with conn.transaction():
+        # The concept term table of an earlier deduplicated table is dropped too, even if the new table is not:
+        for drop_table in [table, get_concept_term_table(table)]:
+            conn.execute(sql.SQL("DROP TABLE IF EXISTS {schema}.{table}").format(
+                schema=sql.Identifier(schema),
+                table=sql.Identifier(drop_table)
+            ))
+        conn.execute(sql.SQL("ALTER TABLE {schema}.{staging_table} RENAME TO {table}").format(
+            schema=sql.Identifier(schema),
+            staging_table=sql.Identifier(staging_table),
+            table=sql.Identifier(table)
+        ))
+        for suffix in ["embedding_vector_idx", "concept_id_idx"]:
+            conn.execute(sql.SQL("ALTER INDEX IF EXISTS {schema}.{staging_index} RENAME TO {index}").format(
+                schema=sql.Identifier(schema),
+                staging_index=sql.Identifier(f"{staging_table}_{suffix}"),
+                index=sql.Identifier(f"{table}_{suffix}")
+            ))
+        if deduplicated:
+            staging_concept_term_table = get_concept_term_table(staging_table)
+            concept_term_table = get_concept_term_table(table)
+            conn.execute(sql.SQL("ALTER TABLE {schema}.{staging_table} RENAME TO {table}").format(
+                schema=sql.Identifier(schema),
+                staging_table=sql.Identifier(staging_concept_term_table),
+                table=sql.Identifier(concept_term_table)
+            ))
+            for suffix in ["text_id_idx", "concept_id_idx"]:
+                conn.execute(sql.SQL("ALTER INDEX IF EXISTS {schema}.{staging_index} RENAME TO {index}").format(
+                    schema=sql.Identifier(schema),
+                    staging_index=sql.Identifier(f"{staging_concept_term_table}_{suffix}"),
+                    index=sql.Identifier(f"{concept_term_table}_{suffix}")
+                ))
+        for partition in partitions:
+            new_partition = table + partition[len(staging_table):]
+            conn.execute(sql.SQL("ALTER TABLE {schema}.{partition} RENAME TO {new_partition}").format(
+                schema=sql.Identifier(schema),
+                partition=sql.Identifier(partition),
+                new_partition=sql.Identifier(new_partition)
+            ))
+            # Includes the indexes Postgres created on the partition for the partitioned concept_id index:
+            indexes = conn.execute("SELECT indexname FROM pg_indexes WHERE schemaname = %s AND tablename = %s",
+                                   (schema, new_partition)).fetchall()
+            for (index,) in indexes:
+                if index.startswith(partition):
+                    conn.execute(sql.SQL("ALTER INDEX {schema}.{index} RENAME TO {new_index}").format(
+                        schema=sql.Identifier(schema),
+                        index=sql.Identifier(index),
+                        new_index=sql.Identifier(new_partition + index[len(partition):])
+                    ))
+    conn.commit()
+
+def finalize_table(conn: connection, schema: str, target_table: str, table: str, vector_type: str, settings: Settings):
+    """
+    Completes a loaded table: creates the indexes if requested, and swaps in the staging table when one is used.
+    """
+    build_seconds = None
+    if settings.create_indexes:
+        build_seconds = create_indexes(conn, schema, target_table, vector_type, settings)
+    if settings.use_staging_table:
+        if settings.unlogged_staging_table:
+            logging.info("Making staging table logged")
+            logged_tables = get_partitions(conn, schema, target_table) or [target_table]
+            if settings.deduplicate_terms:
+                logged_tables.append(get_concept_term_table(target_table))
+            for logged_table in logged_tables:
+                conn.execute(sql.SQL("ALTER TABLE {schema}.{table} SET LOGGED").format(
+                    schema=sql.Identifier(schema),
+                    table=sql.Identifier(logged_table)
+                ))
+            conn.commit()
+        swap_in_staging_table(conn, schema, target_table, table)
+        logging.info(f"Swapped staging table into {table}")
 
     query = sql.SQL("SELECT COUNT(*) FROM {schema}.{table}").format(
-        schema=sql.Identifier(os.getenv("VOCAB_SCHEMA")),
-        table=sql.Identifier(os.getenv("VOCAB_VECTOR_TABLE"))
+        schema=sql.Identifier(schema),
+        table=sql.Identifier(table)
     )
-    result = cur.execute(query)
+    result = conn.execute(query)
     count = result.fetchone()[0]
     logging.info(f"Index size is now {count} records")
+    for partition in get_partitions(conn, schema, table):
+        partition_count = conn.execute(sql.SQL("SELECT COUNT(*) FROM {schema}.{table}").format(
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(partition)
+        )).fetchone()[0]
+        logging.info(f"- Partition {partition}: {partition_count} records")
+    # A partitioned table itself is empty, so sum the sizes of its partitions:
+    table_bytes = sum(conn.execute("SELECT pg_total_relation_size(%s::regclass)",
+                                   (f'"{schema}"."{size_table}"',)).fetchone()[0]
+                      for size_table in get_partitions(conn, schema, table) or [table])
+    table_size = conn.execute("SELECT pg_size_pretty(%s::BIGINT)", (table_bytes,)).fetchone()[0]
+    logging.info(f"Total size of the table and its indexes is {table_size}")
+    if settings.deduplicate_terms:
+        log_deduplication(conn, settings, schema, table, count, build_seconds)
+    conn.commit()
+
+def log_deduplication(conn: connection,
+                      settings: Settings,
+                      schema: str,
+                      table: str,
+                      vector_count: int,
+                      build_seconds: Optional[float]):
+    """
+    Logs how many terms share each vector, and how much the deduplication saves. The savings of the HNSW index are
+    estimated from its size and build time, assuming both grow at least linearly with the number of vectors.
+    """
+    term_count, _, concept_term_count = get_deduplication_counts(create_engine(f"sqlite:///{settings.terms_db_path}"))
+    ratio = term_count / max(1, vector_count)
+    concept_term_bytes = conn.execute("SELECT pg_total_relation_size(%s::regclass)",
+                                      (f'"{schema}"."{get_concept_term_table(table)}"',)).fetchone()[0]
+    logging.info(f"Deduplication: {term_count} terms share {vector_count} vectors (ratio {ratio:.2f}), mapped to "
+                 f"their concepts by {concept_term_count} concept terms, taking {concept_term_bytes / 2**20:.1f} MB "
+                 f"including indexes")
+    increment("dedup_terms", term_count)
+    increment("dedup_vectors", vector_count)
+    index_bytes = conn.execute("SELECT pg_relation_size(to_regclass(%s))",
+                               (f'"{schema}"."{table}_embedding_vector_idx"',)).fetchone()[0]
+    if index_bytes is not None and build_seconds is not None:
+        logging.info(f"The HNSW index of {index_bytes / 2**20:.1f} MB was built in {build_seconds:.0f} seconds. "
+                     f"With a vector per term, it would be about {index_bytes * (ratio - 1) / 2**20:.1f} MB larger, "
+                     f"and take at least {build_seconds * (ratio - 1):.0f} seconds longer to build")
+
+def load_vectors_in_pgvector(settings: Settings):
+    conn = get_connection()
+    schema = os.getenv("VOCAB_SCHEMA")
+    table = os.getenv("VOCAB_VECTOR_TABLE")
+    vector_type = get_vector_type(settings)
+
+    # Each upload worker commits its own COPY, so without a staging table a failed worker would leave the files of
+    # the other workers in the vector table:
+    if settings.upload_workers > 1 and not settings.use_staging_table:
+        raise ValueError("upload_workers > 1 requires use_staging_table")
+
+    # When using a staging table, load into a fresh copy of the table, and only swap it in once it is complete:
+    target_table = f"{table}_staging" if settings.use_staging_table else table
+    if settings.use_staging_table:
+        # Including the concept term table of a staging table left by a failed upload, which would otherwise get a
+        # second copy of the concept terms:
+        for drop_table in [target_table, get_concept_term_table(target_table)]:
+            conn.execute(sql.SQL("DROP TABLE IF EXISTS {schema}.{table}").format(
+                schema=sql.Identifier(schema),
+                table=sql.Identifier(drop_table)
+            ))
+
+    # Create table if it doesn't exist
+    vector_size = get_vector_size(settings.embeddings_folder)
+    if settings.dimensions is not None and settings.dimensions < vector_size:
+        logging.info(f"Truncating vectors from {vector_size} to {settings.dimensions} dimensions")
+        vector_size = settings.dimensions
+    binary = settings.store_type == settings.PGVECTOR_BINARY
+    if settings.deduplicate_terms and settings.partition_by_domain:
+        raise ValueError("deduplicate_terms cannot be combined with partition_by_domain, as a text can be a term of "
+                         "concepts in several domains")
+    partition_domains = get_partition_domains(conn, schema, settings)
+    create_table_in_pgvector(conn,
+                             schema,
+                             target_table,
+                             vector_type,
+                             vector_size,
+                             unlogged=settings.use_staging_table and settings.unlogged_staging_table,
+                             binary=binary,
+                             partition_domains=partition_domains,
+                             deduplicated=settings.deduplicate_terms)
+    if settings.deduplicate_terms:
+        copy_concept_terms(conn, settings.terms_db_path, schema, target_table)
     conn.commit()
 
+    # Spread the Parquet files over the workers, each using its own connection:
+    file_list = list_embedding_files(settings.embeddings_folder)
+    file_paths = [os.path.join(settings.embeddings_folder, file_name) for file_name in file_list]
+    workers = max(1, min(settings.upload_workers, len(file_paths)))
+    start_time = time.time()
+    cancel = threading.Event()
+    with tqdm(total=len(file_paths)) as progress:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(copy_files,
+                                       file_paths[i::workers],
+                                       schema,
+                                       target_table,
+                                       vector_type,
+                                       settings.vectorized_copy,
+                                       progress,
+                                       binary,
+                                       settings.dimensions,
+                                       settings.partition_by_domain,
+                                       settings.deduplicate_terms,
+                                       cancel) for i in range(workers)]
+            try:
+                total_count = sum(future.result() for future in as_completed(futures))
+            except Exception:
+                # Stop the other workers, as the staging table will not be swapped in:
+                cancel.set()
+                raise
+    logging.info(f"Inserted {total_count} vectors using {workers} connections in {time.time() - start_time:.0f} seconds")
+
+    finalize_table(conn, schema, target_table, table, vector_type, settings)
+    conn.close()
+
+
+def apply_delta(settings: Settings):
+    """
+    Applies the delta of an incremental refresh to the existing vector table: removes all vectors of the changed
+    concepts, and inserts their new vectors, in a single transaction. Existing indexes are kept.
+    """
+    if settings.deduplicate_terms:
+        raise ValueError("deduplicate_terms cannot be combined with incremental_refresh")
+    engine = create_engine(f"sqlite:///{settings.terms_db_path}")
+    with engine.connect() as sqlite_connection:
+        delta_concept_ids = [row[0] for row in sqlite_connection.execute(text("SELECT concept_id FROM delta_concepts"))]
+    schema = os.getenv("VOCAB_SCHEMA")
+    table = os.getenv("VOCAB_VECTOR_TABLE")
+    conn = get_connection()
+    start_time = time.time()
+    deleted = 0
+    for i in range(0, len(delta_concept_ids), settings.delta_batch_size):
+        batch = delta_concept_ids[i:i + settings.delta_batch_size]
+        result = conn.execute(sql.SQL("DELETE FROM {schema}.{table} WHERE concept_id = ANY(%s)").format(
+            schema=sql.Identifier(schema),
+            table=sql.Identifier(table)
+        ), (batch,))
+        deleted += result.rowcount
+    logging.info(f"Deleted {deleted} vectors of {len(delta_concept_ids)} changed concepts")
 
+    file_list = list_embedding_files(settings.delta_embeddings_folder)
+    file_paths = [os.path.join(settings.delta_embeddings_folder, file_name) for file_name in file_list]
+    with tqdm(total=len(file_paths)) as progress:
+        inserted = copy_vectors(conn,
+                                file_paths,
+                                schema,
+                                table,
+                                get_vector_type(settings),
+                                settings.vectorized_copy,
+                                progress,
+                                settings.store_type == settings.PGVECTOR_BINARY,
+                                settings.dimensions,
+                                settings.partition_by_domain)
+    conn.commit()
+    seconds = time.time() - start_time
+    count = conn.execute(sql.SQL("SELECT COUNT(*) FROM {schema}.{table}").format(
+        schema=sql.Identifier(schema),
+        table=sql.Identifier(table)
+    )).fetchone()[0]
+    conn.close()
+    logging.info(f"Applied delta of {deleted} deleted and {inserted} inserted vectors in {seconds:.0f} seconds, "
+                 f"leaving {count - inserted} of {count} vectors and their index entries untouched")
+    if inserted > 0:
+        # Not counting the index build of a full upload, so the actual saving is larger:
+        saved = seconds / inserted * (count - inserted)
+        logging.info(f"Saved an estimated {saved:.0f} seconds compared to uploading all {count} vectors")
+    # The delta has been applied, so later runs embed and upload all terms again, until DownloadTerms finds a new
+    # delta:
+    with engine.begin() as sqlite_connection:
+        sqlite_connection.execute(text("DROP TABLE delta_concepts"))
+    logging.info("Removed the delta_concepts table of the applied delta")
+
+
+@instrument_stage("UploadEmbeddingVectors")
 def main(args: List[str]):
     with open(args[0]) as file:
         config = yaml.safe_load(file)
@@ -102,7 +671,10 @@ def main(args: List[str]):
     open_log(os.path.join(settings.log_folder, "logUploadEmbeddingVectors.txt"))
 
     logging.info("Starting uploading embedding vectors")
-    load_vectors_in_pgvector(settings=settings)
+    if settings.incremental_refresh and inspect(create_engine(f"sqlite:///{settings.terms_db_path}")).has_table("delta_concepts"):
+        apply_delta(settings=settings)
+    else:
+        load_vectors_in_pgvector(settings=settings)
     logging.info("Finished uploading embedding vectors")
 
 
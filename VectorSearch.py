@@ -0,0 +1,482 @@
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Dict, Any, Tuple
+
+import numpy as np
+import pyarrow.parquet as pq
+import yaml
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+from EmbeddingFiles import list_embedding_files, read_embedding_batches
+from Logging import open_log
+from Metrics import instrument_stage
+from Quantization import QUANTIZATIONS, quantize_int8, quantize_binary, binary_to_signs, truncate_vectors
+from Settings import Settings
+
+load_dotenv()
+
+# Files of a local index folder. The vectors are L2-normalized, so the dot product equals the cosine similarity:
+VECTORS_FILE = "vectors.npy"
+CONCEPT_IDS_FILE = "concept_ids.npy"
+TERM_TYPES_FILE = "term_types.npy"
+INDEX_INFO_FILE = "index_info.json"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_ORDER_FILE = "ivf_order.npy"
+IVF_OFFSETS_FILE = "ivf_offsets.npy"
+INT8_VECTORS_FILE = "vectors_int8.npy"
+INT8_SCALES_FILE = "int8_scales.npy"
+BINARY_VECTORS_FILE = "vectors_binary.npy"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def build_local_index(embeddings_folder: str, index_folder: str, vector_dtype: str = "float16") -> int:
+    """
+    Consolidates the vectors in an embeddings folder into a single memory-mappable matrix, with the concept IDs and
+    term types stored alongside.
+
+    Returns:
+        The number of vectors in the index.
+    """
+    os.makedirs(index_folder, exist_ok=True)
+    file_paths = [os.path.join(embeddings_folder, f) for f in list_embedding_files(embeddings_folder)]
+    if len(file_paths) == 0:
+        raise Exception(f"No Parquet files found in {embeddings_folder}")
+    row_count = sum(pq.ParquetFile(file_path).metadata.num_rows for file_path in file_paths)
+    _, first_vectors = next(read_embedding_batches(file_paths[0]))
+    dimensions = first_vectors.shape[1]
+
+    vectors = np.lib.format.open_memmap(os.path.join(index_folder, VECTORS_FILE),
+                                        mode="w+",
+                                        dtype=np.dtype(vector_dtype),
+                                        shape=(row_count, dimensions))
+    concept_ids = np.empty(row_count, dtype=np.int32)
+    term_type_codes = np.empty(row_count, dtype=np.uint8)
+    term_types: List[str] = []
+    offset = 0
+    for file_path in tqdm(file_paths):
+        for attributes, batch_vectors in read_embedding_batches(file_path):
+            if "concept_id" not in attributes.column_names:
+                raise Exception("Embeddings created with deduplicate_terms cannot be used for a local index")
+            n = attributes.num_rows
+            vectors[offset:offset + n] = _normalize(batch_vectors)
+            concept_ids[offset:offset + n] = attributes.column("concept_id").to_numpy()
+            batch_term_types, inverse = np.unique(attributes.column("term_type").to_numpy(zero_copy_only=False),
+                                                  return_inverse=True)
+            for term_type in batch_term_types:
+                if term_type not in term_types:
+                    term_types.append(term_type)
+            codes = np.array([term_types.index(term_type) for term_type in batch_term_types], dtype=np.uint8)
+            term_type_codes[offset:offset + n] = codes[inverse]
+            offset += n
+    vectors.flush()
+    del vectors
+    np.save(os.path.join(index_folder, CONCEPT_IDS_FILE), concept_ids)
+    np.save(os.path.join(index_folder, TERM_TYPES_FILE), term_type_codes)
+    with open(os.path.join(index_folder, INDEX_INFO_FILE), "w") as file:
+        json.dump({"row_count": row_count, "dimensions": dimensions, "term_types": term_types}, file)
+    return row_count
+
+
+def quantize_local_index(index_folder: str, quantization: str, block_size: int = 65536) -> None:
+    """
+    Adds a quantized copy of the vectors to a local index, which is searched first, after which only the best
+    candidates are re-ranked using the full vectors.
+
+    Args:
+        index_folder: The local index folder created by build_local_index.
+        quantization: 'int8' (scalar quantization) or 'binary' (one bit per dimension).
+        block_size: Number of vectors quantized at a time.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"quantization must be one of {QUANTIZATIONS}")
+    vectors = np.load(os.path.join(index_folder, VECTORS_FILE), mmap_mode="r")
+    n, dimensions = vectors.shape
+    if quantization == "int8":
+        codes = np.lib.format.open_memmap(os.path.join(index_folder, INT8_VECTORS_FILE),
+                                          mode="w+",
+                                          dtype=np.int8,
+                                          shape=(n, dimensions))
+        scales = np.empty(n, dtype=np.float32)
+        for start in range(0, n, block_size):
+            codes[start:start + block_size], scales[start:start + block_size] = quantize_int8(
+                vectors[start:start + block_size])
+        codes.flush()
+        np.save(os.path.join(index_folder, INT8_SCALES_FILE), scales)
+    else:
+        bits = np.lib.format.open_memmap(os.path.join(index_folder, BINARY_VECTORS_FILE),
+                                         mode="w+",
+                                         dtype=np.uint8,
+                                         shape=(n, (dimensions + 7) // 8))
+        for start in range(0, n, block_size):
+            bits[start:start + block_size] = quantize_binary(vectors[start:start + block_size])
+        bits.flush()
+
+
+def build_ivf(index_folder: str, n_lists: int, sample_size: int = 100000, iterations: int = 10, seed: int = 0):
+    """
+    Builds an approximate inverted-file (IVF) index on a local index: the vectors are clustered using spherical
+    k-means on a sample, and each vector is assigned to its nearest cluster. A search then only scores the vectors in
+    the clusters nearest to the query.
+    """
+    vectors = np.load(os.path.join(index_folder, VECTORS_FILE), mmap_mode="r")
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(vectors.shape[0], size=min(sample_size, vectors.shape[0]), replace=False))
+    sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+    centroids = sample[rng.choice(sample.shape[0], size=min(n_lists, sample.shape[0]), replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for j in range(centroids.shape[0]):
+            members = sample[assignment == j]
+            if len(members) > 0:
+                centroids[j] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+
+    assignment = np.empty(vectors.shape[0], dtype=np.int32)
+    block_size = 65536
+    for start in range(0, vectors.shape[0], block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        assignment[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    order = np.argsort(assignment, kind="stable").astype(np.int64)
+    offsets = np.searchsorted(assignment[order], np.arange(centroids.shape[0] + 1)).astype(np.int64)
+    np.save(os.path.join(index_folder, IVF_CENTROIDS_FILE), centroids)
+    np.save(os.path.join(index_folder, IVF_ORDER_FILE), order)
+    np.save(os.path.join(index_folder, IVF_OFFSETS_FILE), offsets)
+
+
+def load_record_counts(csv_path: str) -> Dict[int, float]:
+    """
+    Loads concept record counts from a CSV file with concept_id and record_count columns.
+    """
+    record_counts = {}
+    with open(csv_path, "r", encoding="utf-8-sig") as file:
+        for row in csv.DictReader(file):
+            record_counts[int(row["concept_id"])] = float(row["record_count"])
+    return record_counts
+
+
+def load_record_counts_from_database(record_count_table: str) -> Dict[int, float]:
+    """
+    Loads concept record counts from the record count table in the vocabulary database.
+    """
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(os.getenv("VOCAB_CONNECTION_STRING"))
+    table = f"{os.getenv('VOCAB_SCHEMA')}.{record_count_table}" if os.getenv("VOCAB_SCHEMA") else record_count_table
+    with engine.connect() as connection:
+        rows = connection.execute(text(f"SELECT concept_id, record_count FROM {table}"))
+        return {int(concept_id): float(record_count) for concept_id, record_count in rows}
+
+
+def _align_record_counts(record_counts: Dict[int, float], concept_ids: np.ndarray) -> np.ndarray:
+    """
+    Looks up the record count of each row of the index. Concepts without a record count get a count of 0.
+    """
+    count_concept_ids = np.fromiter(record_counts.keys(), dtype=np.int64, count=len(record_counts))
+    counts = np.fromiter(record_counts.values(), dtype=np.float64, count=len(record_counts))
+    order = np.argsort(count_concept_ids)
+    count_concept_ids = np.append(count_concept_ids[order], -1)
+    counts = np.append(counts[order], 0.0)
+    positions = np.searchsorted(count_concept_ids[:-1], concept_ids)
+    found = count_concept_ids[positions] == concept_ids
+    return np.where(found, counts[positions], 0.0)
+
+
+def _merge_top_k(scores_a: np.ndarray,
+                 rows_a: np.ndarray,
+                 scores_b: np.ndarray,
+                 rows_b: np.ndarray,
+                 k: int) -> Tuple[np.ndarray, np.ndarray]:
+    scores = np.concatenate([scores_a, scores_b], axis=1)
+    rows = np.concatenate([rows_a, rows_b], axis=1)
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        rows = np.take_along_axis(rows, top, axis=1)
+    return scores, rows
+
+
+class LocalVectorIndex:
+    """
+    Nearest-neighbour search over a local index folder created by build_local_index. The vector matrix is
+    memory-mapped, so only the blocks being scored are read into memory.
+
+    Args:
+        index_folder: The local index folder.
+        record_counts: Optional record counts per concept ID, for filtering and re-ranking.
+        quantization: If 'int8' or 'binary', the exact search scores the quantized vectors created by
+                      quantize_local_index, and re-ranks the best candidates using the full vectors. Binary vectors
+                      are scored against the full-precision query.
+    """
+
+    def __init__(self,
+                 index_folder: str,
+                 record_counts: Optional[Dict[int, float]] = None,
+                 quantization: Optional[str] = None):
+        self.vectors = np.load(os.path.join(index_folder, VECTORS_FILE), mmap_mode="r")
+        self.quantization = quantization
+        if quantization == "int8":
+            self.quantized_vectors = np.load(os.path.join(index_folder, INT8_VECTORS_FILE), mmap_mode="r")
+            self.int8_scales = np.load(os.path.join(index_folder, INT8_SCALES_FILE))
+        elif quantization == "binary":
+            self.quantized_vectors = np.load(os.path.join(index_folder, BINARY_VECTORS_FILE), mmap_mode="r")
+        elif quantization is not None:
+            raise ValueError(f"quantization must be one of {QUANTIZATIONS}")
+        self.concept_ids = np.load(os.path.join(index_folder, CONCEPT_IDS_FILE))
+        self.term_type_codes = np.load(os.path.join(index_folder, TERM_TYPES_FILE))
+        with open(os.path.join(index_folder, INDEX_INFO_FILE), "r") as file:
+            self.term_types = json.load(file)["term_types"]
+        self.row_counts = None
+        if record_counts is not None:
+            self.row_counts = _align_record_counts(record_counts, self.concept_ids)
+        self.ivf_centroids = None
+        if os.path.isfile(os.path.join(index_folder, IVF_CENTROIDS_FILE)):
+            self.ivf_centroids = np.load(os.path.join(index_folder, IVF_CENTROIDS_FILE))
+            self.ivf_order = np.load(os.path.join(index_folder, IVF_ORDER_FILE), mmap_mode="r")
+            self.ivf_offsets = np.load(os.path.join(index_folder, IVF_OFFSETS_FILE))
+
+    def _score_block(self, queries: np.ndarray, start: int, end: int) -> np.ndarray:
+        if self.quantization == "int8":
+            block = np.asarray(self.quantized_vectors[start:end], dtype=np.float32)
+            return (queries @ block.T) * self.int8_scales[start:end]
+        if self.quantization == "binary":
+            block = binary_to_signs(self.quantized_vectors[start:end], self.vectors.shape[1])
+            return queries @ block.T
+        block = np.asarray(self.vectors[start:end], dtype=np.float32)
+        return queries @ block.T
+
+    def _rerank(self,
+                queries: np.ndarray,
+                candidate_scores: np.ndarray,
+                candidate_rows: np.ndarray,
+                k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((queries.shape[0], k), dtype=np.int64)
+        for i in range(queries.shape[0]):
+            candidates = np.unique(candidate_rows[i][np.isfinite(candidate_scores[i])])
+            exact_scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ queries[i]
+            top = np.argsort(-exact_scores)[:k]
+            scores[i, :len(top)] = exact_scores[top]
+            best_rows[i, :len(top)] = candidates[top]
+        return scores, best_rows
+
+    def _search_rows(self,
+                     queries: np.ndarray,
+                     start: int,
+                     end: int,
+                     k: int,
+                     block_size: int,
+                     allowed: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        best_scores = np.full((queries.shape[0], 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((queries.shape[0], 0), dtype=np.int64)
+        for block_start in range(start, end, block_size):
+            block_end = min(block_start + block_size, end)
+            scores = self._score_block(queries, block_start, block_end)
+            if allowed is not None:
+                scores[:, ~allowed[block_start:block_end]] = -np.inf
+            rows = np.broadcast_to(np.arange(block_start, block_end), scores.shape)
+            best_scores, best_rows = _merge_top_k(best_scores, best_rows, scores, rows, k)
+        return best_scores, best_rows
+
+    def _search_exact(self,
+                      queries: np.ndarray,
+                      k: int,
+                      block_size: int,
+                      threads: int,
+                      allowed: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        n = self.vectors.shape[0]
+        if threads <= 1:
+            return self._search_rows(queries, 0, n, k, block_size, allowed)
+        # NumPy releases the GIL during matrix multiplication, so threads can score different parts of the matrix:
+        part_size = (n + threads - 1) // threads
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(self._search_rows, queries, start, min(start + part_size, n), k, block_size,
+                                       allowed) for start in range(0, n, part_size)]
+            results = [future.result() for future in futures]
+        best_scores, best_rows = results[0]
+        for scores, rows in results[1:]:
+            best_scores, best_rows = _merge_top_k(best_scores, best_rows, scores, rows, k)
+        return best_scores, best_rows
+
+    def _search_ivf(self,
+                    queries: np.ndarray,
+                    k: int,
+                    probes: int,
+                    allowed: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        lists = np.argsort(-(queries @ self.ivf_centroids.T), axis=1)[:, :probes]
+        best_scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((queries.shape[0], k), dtype=np.int64)
+        for i in range(queries.shape[0]):
+            candidates = np.concatenate([self.ivf_order[self.ivf_offsets[j]:self.ivf_offsets[j + 1]]
+                                         for j in lists[i]])
+            candidates.sort()
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            if len(candidates) == 0:
+                continue
+            scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ queries[i]
+            top = np.argsort(-scores)[:k]
+            best_scores[i, :len(top)] = scores[top]
+            best_rows[i, :len(top)] = candidates[top]
+        return best_scores, best_rows
+
+    def search(self,
+               query_vectors: np.ndarray,
+               k: int = 10,
+               block_size: int = 65536,
+               threads: int = 1,
+               approximate: bool = False,
+               probes: int = 8,
+               min_record_count: float = 0,
+               record_count_weight: float = 0.0,
+               rerank_factor: int = 4,
+               rerank_candidates: int = 100) -> List[List[Dict[str, Any]]]:
+        """
+        Finds the nearest terms for a batch of query vectors by cosine similarity.
+
+        Args:
+            query_vectors: A (queries x dimensions) matrix of query vectors. Vectors wider than the index are
+                           truncated.
+            k: Number of results per query.
+            block_size: Number of index vectors scored per matrix multiplication.
+            threads: Number of threads used for exact search.
+            approximate: Use the IVF index instead of exact search. Requires build_ivf to have been run.
+            probes: Number of IVF clusters searched per query.
+            min_record_count: Exclude concepts with fewer records than this. Requires record counts.
+            record_count_weight: If larger than 0, the top k * rerank_factor results are re-ranked by the cosine
+                                 similarity plus this weight times log10(1 + record count). Requires record counts.
+            rerank_factor: Number of candidates retrieved per result when re-ranking.
+            rerank_candidates: Number of candidates found using the quantized vectors that are re-ranked using the
+                               full vectors.
+
+        Returns:
+            For each query, a list of results with concept_id, term_type, similarity, record_count, and score.
+        """
+        queries = _normalize(truncate_vectors(np.atleast_2d(query_vectors), self.vectors.shape[1]))
+        if (min_record_count > 0 or record_count_weight > 0) and self.row_counts is None:
+            raise ValueError("Filtering or re-ranking by record count requires record counts")
+        allowed = None
+        if min_record_count > 0:
+            allowed = self.row_counts >= min_record_count
+        candidates = k * rerank_factor if record_count_weight > 0 else k
+        candidates = min(candidates, self.vectors.shape[0])
+        if approximate:
+            if self.ivf_centroids is None:
+                raise ValueError("No approximate index found. Please run build_ivf first")
+            scores, rows = self._search_ivf(queries, candidates, probes, allowed)
+        elif self.quantization is not None:
+            quantized_candidates = min(max(candidates, rerank_candidates), self.vectors.shape[0])
+            scores, rows = self._search_exact(queries, quantized_candidates, block_size, threads, allowed)
+            scores, rows = self._rerank(queries, scores, rows, candidates)
+        else:
+            scores, rows = self._search_exact(queries, candidates, block_size, threads, allowed)
+
+        results = []
+        for i in range(queries.shape[0]):
+            hits = []
+            for score, row in zip(scores[i], rows[i]):
+                if not np.isfinite(score):
+                    continue
+                record_count = None if self.row_counts is None else float(self.row_counts[row])
+                final_score = float(score)
+                if record_count_weight > 0:
+                    final_score += record_count_weight * float(np.log10(1.0 + record_count))
+                hits.append({
+                    "concept_id": int(self.concept_ids[row]),
+                    "term_type": self.term_types[self.term_type_codes[row]],
+                    "similarity": float(score),
+                    "record_count": record_count,
+                    "score": final_score,
+                })
+            hits.sort(key=lambda hit: hit["score"], reverse=True)
+            results.append(hits[:k])
+        return results
+
+
+def _open_index(settings: Settings) -> LocalVectorIndex:
+    record_counts = None
+    if settings.record_counts_path:
+        record_counts = load_record_counts(settings.record_counts_path)
+    elif settings.min_record_count > 0 or settings.record_count_weight > 0:
+        record_counts = load_record_counts_from_database(settings.record_count_table)
+    return LocalVectorIndex(settings.local_index_folder,
+                            record_counts=record_counts,
+                            quantization=settings.local_index_quantization)
+
+
+def map_terms(settings: Settings, input_path: str, output_path: str, k: int = 10) -> None:
+    """
+    Maps the terms in the 'term' column of a CSV file to their nearest concepts, writing the top k per term.
+    """
+    from GenAIApi import get_embedding_vectors
+
+    with open(input_path, "r", encoding="utf-8-sig") as file:
+        terms = [row["term"] for row in csv.DictReader(file)]
+    index = _open_index(settings)
+    start_time = time.time()
+    with open(output_path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["term", "rank", "concept_id", "term_type", "similarity", "record_count", "score"])
+        for start in range(0, len(terms), settings.local_search_batch_size):
+            batch = terms[start:start + settings.local_search_batch_size]
+            query_vectors = get_embedding_vectors(batch,
+                                                  max_workers=settings.embedding_concurrency,
+                                                  dimensions=settings.dimensions)["embeddings"]
+            results = index.search(query_vectors,
+                                   k=k,
+                                   block_size=settings.local_search_block_size,
+                                   threads=settings.local_search_threads,
+                                   approximate=settings.local_ivf_lists is not None,
+                                   probes=settings.local_ivf_probes,
+                                   min_record_count=settings.min_record_count,
+                                   record_count_weight=settings.record_count_weight,
+                                   rerank_candidates=settings.rerank_candidates)
+            for term, hits in zip(batch, results):
+                for rank, hit in enumerate(hits):
+                    writer.writerow([term, rank + 1, hit["concept_id"], hit["term_type"], hit["similarity"],
+                                     hit["record_count"], hit["score"]])
+    logging.info(f"Mapped {len(terms)} terms in {time.time() - start_time:.1f} seconds")
+
+
+@instrument_stage("VectorSearch")
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = Settings(config)
+    os.makedirs(settings.log_folder, exist_ok=True)
+    open_log(os.path.join(settings.log_folder, "logVectorSearch.txt"))
+
+    if args[1] == "build":
+        logging.info("Starting building local vector index")
+        row_count = build_local_index(embeddings_folder=settings.embeddings_folder,
+                                      index_folder=settings.local_index_folder,
+                                      vector_dtype=settings.local_index_dtype)
+        logging.info(f"Consolidated {row_count} vectors")
+        if settings.local_index_quantization is not None:
+            logging.info(f"Quantizing vectors to {settings.local_index_quantization}")
+            quantize_local_index(settings.local_index_folder, settings.local_index_quantization)
+        if settings.local_ivf_lists is not None:
+            logging.info(f"Building approximate index with {settings.local_ivf_lists} lists")
+            build_ivf(settings.local_index_folder, settings.local_ivf_lists)
+        logging.info("Finished building local vector index")
+    else:
+        map_terms(settings, input_path=args[1], output_path=args[2])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[2] == "build" or len(sys.argv) == 4:
+        main(sys.argv[1:])
+    else:
+        raise Exception("Must provide path to yaml file and 'build', or path to yaml file, input CSV file, and "
+                        "output CSV file as arguments")
@@ -0,0 +1,386 @@
+import argparse
+import hashlib
+import importlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Dict, Any, Callable
+
+import yaml
+from dotenv import load_dotenv
+
+from EmbeddingManifest import EmbeddingManifest, file_checksum
+from Logging import open_log
+from Settings import Settings
+
+load_dotenv()
+
+# Runs the stages of building the vector store as a DAG, skipping stages whose inputs did not change since they last
+# completed. The inputs of a stage are summarized in a fingerprint: the settings that change its output, the version of
+# the source vocabulary, the embedding model, and the hashes of the outputs of its upstream stages. After a stage runs,
+# the hash of its output is recorded, so when a stage is rerun but produces the same output, its downstream stages
+# are still skipped. Only this module and its light dependencies are imported up front. The module of a stage, with
+# its heavy dependencies (sqlalchemy, psycopg, pyarrow, openai), is only imported when the stage runs.
+
+STATE_FILE_NAME = "VocabVecState.json"
+
+_HASH_BATCH_SIZE = 100000
+
+
+@dataclass
+class Stage:
+    """
+    A stage of the DAG. The name is also the name of the module whose main function runs the stage.
+    """
+    name: str
+    upstream: List[str]
+    # The settings changing the output of the stage. Settings that only change how fast it runs are not included:
+    settings_fields: List[str]
+    # The environment variables changing the output of the stage:
+    environment_variables: List[str]
+    reads_vocabulary: bool
+    uses_model: bool
+    # Whether the stage continues where it left off when it is rerun with the same inputs after failing:
+    resumable: bool
+    output_exists: Callable[[Settings], bool]
+    clear_output: Callable[[Settings], None]
+    hash_output: Callable[[Settings], Optional[str]]
+    input_files: Callable[[Settings], List[str]] = field(default=lambda settings: [])
+
+
+def _connect_to_vocabulary():
+    import psycopg
+    return psycopg.connect(os.getenv("VOCAB_CONNECTION_STRING").replace("+psycopg", ""))
+
+
+def _table_exists(table: str) -> bool:
+    with _connect_to_vocabulary() as conn:
+        return conn.execute("SELECT to_regclass(%s)", (f'"{os.getenv("VOCAB_SCHEMA")}"."{table}"',)).fetchone()[0] \
+            is not None
+
+
+def _drop_table(table: str) -> None:
+    from psycopg import sql
+    with _connect_to_vocabulary() as conn:
+        conn.execute(sql.SQL("DROP TABLE IF EXISTS {schema}.{table}").format(
+            schema=sql.Identifier(os.getenv("VOCAB_SCHEMA")),
+            table=sql.Identifier(table)))
+
+
+def _hash_rows(sha256: Any, cursor: sqlite3.Cursor) -> None:
+    while True:
+        rows = cursor.fetchmany(_HASH_BATCH_SIZE)
+        if not rows:
+            break
+        sha256.update("\n".join(repr(row) for row in rows).encode("utf-8"))
+
+
+def get_vocabulary_version() -> str:
+    """
+    Returns the version of the source vocabulary, as recorded in the vocabulary table. Vocabularies without that table
+    (such as synthetic vocabularies) are identified by the number of concepts and the highest concept ID instead.
+    """
+    from psycopg import sql
+    schema = sql.Identifier(os.getenv("VOCAB_SCHEMA"))
+    with _connect_to_vocabulary() as conn:
+        if conn.execute("SELECT to_regclass(%s)", (f'"{os.getenv("VOCAB_SCHEMA")}".vocabulary',)).fetchone()[0]:
+            version = conn.execute(sql.SQL("SELECT vocabulary_version FROM {schema}.vocabulary "
+                                           "WHERE vocabulary_id = 'None'").format(schema=schema)).fetchone()
+            if version is not None:
+                return version[0]
+        count, max_concept_id = conn.execute(sql.SQL("SELECT COUNT(*), MAX(concept_id) FROM {schema}.concept").format(
+            schema=schema)).fetchone()
+        return f"{count} concepts, up to {max_concept_id}"
+
+
+def get_embedding_model_identity() -> str:
+    """
+    Returns the provider and model GenAIApi embeds with, read from the same environment variables, so the OpenAI
+    client does not have to be imported.
+    """
+    return f"{os.getenv('GENAI_PROVIDER')}/{os.getenv('EMBEDDING_MODEL')}"
+
+
+def _hash_record_counts(settings: Settings) -> str:
+    from psycopg import sql
+    with _connect_to_vocabulary() as conn:
+        row = conn.execute(sql.SQL("SELECT COUNT(*), SUM(concept_id::BIGINT), SUM(record_count) FROM {schema}.{table}").format(
+            schema=sql.Identifier(os.getenv("VOCAB_SCHEMA")),
+            table=sql.Identifier(settings.record_count_table))).fetchone()
+    return hashlib.sha256(repr(tuple(row)).encode("utf-8")).hexdigest()
+
+
+def _hash_terms(settings: Settings) -> str:
+    """
+    Hashes the terms table, and the delta of an incremental refresh, which is all CreateEmbeddings reads.
+    """
+    sha256 = hashlib.sha256()
+    connection = sqlite3.connect(settings.terms_db_path)
+    try:
+        _hash_rows(sha256, connection.execute("SELECT * FROM terms ORDER BY rowid"))
+        if connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'delta_concepts'").fetchone()[0]:
+            sha256.update(b"delta")
+            _hash_rows(sha256, connection.execute("SELECT concept_id FROM delta_concepts ORDER BY concept_id"))
+    finally:
+        connection.close()
+    return sha256.hexdigest()
+
+
+def _get_embeddings_folder(settings: Settings) -> str:
+    # The folder CreateEmbeddings writes to, which is the delta folder when refreshing incrementally:
+    if settings.incremental_refresh and os.path.exists(settings.terms_db_path):
+        connection = sqlite3.connect(settings.terms_db_path)
+        try:
+            if connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'delta_concepts'").fetchone()[0]:
+                return settings.delta_embeddings_folder
+        finally:
+            connection.close()
+    return settings.embeddings_folder
+
+
+def _hash_embeddings(settings: Settings) -> str:
+    # The manifest has the checksum of every shard, so the Parquet files do not have to be read again:
+    manifest = EmbeddingManifest(_get_embeddings_folder(settings))
+    sha256 = hashlib.sha256(manifest.fingerprint.encode("utf-8"))
+    for shard in sorted(manifest.shards, key=lambda shard: shard.first_term_id):
+        sha256.update(shard.sha256.encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def _clear_terms(settings: Settings) -> None:
+    # An incremental refresh compares the new terms with the existing ones, so keeps the terms database:
+    if not settings.incremental_refresh and os.path.exists(settings.terms_db_path):
+        logging.info(f"Removing {settings.terms_db_path}")
+        os.remove(settings.terms_db_path)
+
+
+def _clear_embeddings(settings: Settings) -> None:
+    folder = _get_embeddings_folder(settings)
+    if os.path.isdir(folder):
+        logging.info(f"Removing {folder}")
+        shutil.rmtree(folder)
+
+
+def _clear_vector_table(settings: Settings) -> None:
+    # A full upload without a staging table appends to the vector table, so the table is dropped first, together with
+    # its partitions and concept term table. A staging table replaces the vector table as a whole, and an incremental
+    # refresh replaces the vectors of the changed concepts:
+    if settings.use_staging_table or _get_embeddings_folder(settings) != settings.embeddings_folder:
+        return
+    table = os.getenv("VOCAB_VECTOR_TABLE")
+    for drop_table in [table, f"{table}_concept_term"]:
+        logging.info(f"Dropping {drop_table}")
+        _drop_table(drop_table)
+
+
+STAGES = [
+    Stage(name="CreateConceptRecordCountTable",
+          upstream=[],
+          settings_fields=["record_count_table", "record_count_files", "ancestor_cache_path"],
+          environment_variables=["VOCAB_SCHEMA"],
+          reads_vocabulary=True,
+          uses_model=False,
+          resumable=False,
+          output_exists=lambda settings: _table_exists(settings.record_count_table),
+          clear_output=lambda settings: _drop_table(settings.record_count_table),
+          hash_output=_hash_record_counts,
+          input_files=lambda settings: settings.record_count_files or ["ConceptRecordCounts.csv"]),
+    Stage(name="DownloadTerms",
+          upstream=["CreateConceptRecordCountTable"],
+          settings_fields=["domain_ids", "include_classification_concepts", "classification_vocabularies",
+                           "restrict_to_used_concepts", "incremental_refresh", "lexical_index"],
+          environment_variables=["VOCAB_SCHEMA"],
+          reads_vocabulary=True,
+          uses_model=False,
+          resumable=False,
+          output_exists=lambda settings: os.path.exists(settings.terms_db_path),
+          clear_output=_clear_terms,
+          hash_output=_hash_terms),
+    Stage(name="CreateEmbeddings",
+          upstream=["DownloadTerms"],
+          settings_fields=["include_synonyms", "include_mapped_terms", "max_text_characters", "dimensions",
+                           "deduplicate_terms", "parquet_vector_dtype", "embeddings_folder",
+                           "delta_embeddings_folder"],
+          environment_variables=[],
+          reads_vocabulary=False,
+          uses_model=True,
+          resumable=True,
+          output_exists=lambda settings: EmbeddingManifest(_get_embeddings_folder(settings)).exists(),
+          clear_output=_clear_embeddings,
+          hash_output=_hash_embeddings),
+    Stage(name="UploadEmbeddingVectors",
+          upstream=["CreateEmbeddings"],
+          settings_fields=["store_type", "binary_full_vector_type", "dimensions", "deduplicate_terms",
+                           "partition_by_domain", "domain_ids", "create_indexes", "hnsw_m", "hnsw_ef_construction"],
+          environment_variables=["VOCAB_SCHEMA", "VOCAB_VECTOR_TABLE"],
+          reads_vocabulary=False,
+          uses_model=False,
+          resumable=False,
+          output_exists=lambda settings: _table_exists(os.getenv("VOCAB_VECTOR_TABLE")),
+          clear_output=_clear_vector_table,
+          hash_output=lambda settings: None),
+]
+
+
+def get_stages(settings: Settings, names: Optional[List[str]] = None) -> List[Stage]:
+    """
+    Returns the stages to run, in order. The record count table is only created when concepts are restricted to the
+    used concepts, or record count files are configured.
+    """
+    if names is not None:
+        unknown = set(names) - set(stage.name for stage in STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+        return [stage for stage in STAGES if stage.name in names]
+    return [stage for stage in STAGES
+            if stage.name != "CreateConceptRecordCountTable" or settings.restrict_to_used_concepts or
+            settings.record_count_files]
+
+
+class StageState:
+    """
+    The fingerprint, status ('running' or 'complete'), and output hash of each stage, persisted as a JSON file that
+    is replaced atomically.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.stages = json.load(file)
+
+    def get(self, stage: str) -> Dict[str, Any]:
+        return self.stages.get(stage, {})
+
+    def set(self, stage: str, **values: Any) -> None:
+        self.stages[stage] = values
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(self.stages, file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+def get_fingerprint(stage: Stage,
+                    settings: Settings,
+                    upstream_hashes: Dict[str, Optional[str]],
+                    vocabulary_version: Optional[str]) -> str:
+    inputs = {"stage": stage.name,
+              "settings": {name: getattr(settings, name, None) for name in stage.settings_fields},
+              "environment": {name: os.getenv(name) for name in stage.environment_variables},
+              "upstream": upstream_hashes,
+              "files": {file_name: file_checksum(file_name) if os.path.exists(file_name) else None
+                        for file_name in stage.input_files(settings)}}
+    if stage.reads_vocabulary:
+        inputs["vocabulary_version"] = vocabulary_version
+    if stage.uses_model:
+        inputs["model"] = get_embedding_model_identity()
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def run_stages(settings_path: str,
+               stage_names: Optional[List[str]] = None,
+               force: Optional[List[str]] = None,
+               dry_run: bool = False) -> Dict[str, str]:
+    """
+    Runs the stages whose fingerprint changed since they last completed, or whose output is missing.
+
+    Args:
+        settings_path: Path to the settings yaml file, which is passed to the main function of each stage.
+        stage_names: The stages to consider. Defaults to all stages.
+        force: Stages to run even when their fingerprint did not change.
+        dry_run: Only report which stages would run.
+
+    Returns:
+        For each stage, what was done: 'skipped', 'ran', 'would run', or 'may run' (in a dry run, when an upstream
+        stage would run, so its output is not known yet).
+    """
+    with open(settings_path) as file:
+        settings = Settings(yaml.safe_load(file))
+    force = force or []
+    state = StageState(os.path.join(settings.log_folder, STATE_FILE_NAME))
+    stages = get_stages(settings, stage_names)
+    vocabulary_version = None
+    if any(stage.reads_vocabulary for stage in stages):
+        vocabulary_version = get_vocabulary_version()
+        logging.info(f"Vocabulary version: {vocabulary_version}")
+    # Upstream stages that are not part of the DAG with these settings are not inputs:
+    dag = [stage.name for stage in get_stages(settings)]
+    outcomes = {}
+    for stage in stages:
+        upstream = [name for name in stage.upstream if name in dag]
+        if stage.name == "DownloadTerms" and not settings.restrict_to_used_concepts:
+            # Only reads the record count table when restricting to the used concepts:
+            upstream = []
+        upstream_hashes = {name: state.get(name).get("output_hash") for name in upstream}
+        if dry_run and any(outcomes.get(name) in ("would run", "may run") for name in upstream_hashes):
+            outcomes[stage.name] = "may run"
+            logging.info(f"{stage.name}: may run, depending on the output of its upstream stages")
+            continue
+        fingerprint = get_fingerprint(stage, settings, upstream_hashes, vocabulary_version)
+        previous = state.get(stage.name)
+        if previous.get("fingerprint") != fingerprint:
+            reason = "inputs changed" if previous else "never ran"
+        elif previous.get("status") != "complete":
+            reason = "did not complete"
+        elif not stage.output_exists(settings):
+            reason = "output is missing"
+        elif stage.name in force:
+            reason = "forced"
+        else:
+            outcomes[stage.name] = "skipped"
+            logging.info(f"{stage.name}: skipped, inputs unchanged since {previous.get('finished')}")
+            continue
+        if dry_run:
+            outcomes[stage.name] = "would run"
+            logging.info(f"{stage.name}: would run ({reason})")
+            continue
+        logging.info(f"{stage.name}: running ({reason})")
+        # A resumable stage that did not complete with the same inputs continues where it left off. Otherwise, its
+        # earlier output is removed first, as the stages refuse to overwrite or mix with output from other inputs:
+        if not (stage.resumable and previous.get("fingerprint") == fingerprint and previous.get("status") == "running"):
+            stage.clear_output(settings)
+        state.set(stage.name, fingerprint=fingerprint, status="running")
+        start_time = time.time()
+        module = importlib.import_module(stage.name)
+        module.main([settings_path])
+        seconds = time.time() - start_time
+        output_hash = stage.hash_output(settings)
+        if output_hash is not None and output_hash == previous.get("output_hash"):
+            logging.info(f"{stage.name}: output unchanged, so downstream stages need not run")
+        state.set(stage.name,
+                  fingerprint=fingerprint,
+                  status="complete",
+                  output_hash=output_hash,
+                  finished=time.strftime("%Y-%m-%d %H:%M:%S"),
+                  seconds=round(seconds, 1))
+        outcomes[stage.name] = "ran"
+        logging.info(f"{stage.name}: finished in {seconds:.1f} seconds")
+    return outcomes
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Runs the stages of building the vector store that are out of date")
+    parser.add_argument("settings", help="Path to the settings yaml file")
+    parser.add_argument("--stages", nargs="+", choices=[stage.name for stage in STAGES],
+                        help="Only consider these stages")
+    parser.add_argument("--force", nargs="+", choices=[stage.name for stage in STAGES], default=[],
+                        help="Run these stages even if their inputs did not change")
+    parser.add_argument("--dry-run", action="store_true", help="Only report which stages would run")
+    args = parser.parse_args(args)
+    with open(args.settings) as file:
+        settings = Settings(yaml.safe_load(file))
+    os.makedirs(settings.log_folder, exist_ok=True)
+    # The stages log to this file too, as only the first log opened in a process is used:
+    open_log(os.path.join(settings.log_folder, "logVocabVec.txt"))
+    outcomes = run_stages(args.settings, stage_names=args.stages, force=args.force, dry_run=args.dry_run)
+    for name, outcome in outcomes.items():
+        print(f"{name}: {outcome}")
+
+
+if __name__ == "__main__":
+    main()
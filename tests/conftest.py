@@ -0,0 +1,26 @@
+import pytest
+
+import GenAIApi
+from MockEmbeddingServer import MockEmbeddingServer
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    """
+    Starts a mock embedding server with the given options, and points the embedding client at it. Backoff between
+    retries is shortened so failures are retried quickly.
+    """
+    servers = []
+
+    def start(**kwargs) -> MockEmbeddingServer:
+        server = MockEmbeddingServer(**kwargs).start()
+        servers.append(server)
+        monkeypatch.setenv("GENAI_PROVIDER", "lm-studio")
+        monkeypatch.setenv("LM_STUDIO_ENDPOINT", server.url)
+        monkeypatch.setenv("EMBEDDING_MODEL", "mock")
+        return server
+
+    monkeypatch.setattr(GenAIApi, "_BACKOFF_BASE", 0.01)
+    yield start
+    for server in servers:
+        server.stop()
@@ -0,0 +1,51 @@
+import struct
+
+import numpy as np
+import pytest
+
+from BinaryCopy import encode_rows
+
+
+def _encode_field(pg_type: str, value) -> bytes:
+    if pg_type == "int4":
+        return struct.pack(">ii", 4, value)
+    if pg_type == "varchar":
+        if value is None:
+            return struct.pack(">i", -1)
+        data = value.encode("utf-8")
+        return struct.pack(">i", len(data)) + data
+    if pg_type == "vector":
+        return struct.pack(">ihh", 4 + 4 * len(value), len(value), 0) + np.asarray(value, dtype=">f4").tobytes()
+    if pg_type == "bit":
+        data = np.packbits(np.asarray(value) > 0).tobytes()
+        return struct.pack(">ii", 4 + len(data), len(value)) + data
+    raise ValueError(pg_type)
+
+
+def _encode_reference(columns) -> bytes:
+    rows = []
+    for values in zip(*[values for _, values in columns]):
+        fields = [_encode_field(pg_type, value) for (pg_type, _), value in zip(columns, values)]
+        rows.append(struct.pack(">h", len(fields)) + b"".join(fields))
+    return b"".join(rows)
+
+
+@pytest.mark.parametrize("dimensions", [1, 5, 8, 9, 16, 17])
+def test_bit_vectors_of_any_width(dimensions):
+    rng = np.random.default_rng(dimensions)
+    vectors = rng.standard_normal((10, dimensions)).astype(np.float32)
+    columns = [("int4", np.arange(10)), ("bit", vectors)]
+    assert bytes(encode_rows(columns)) == _encode_reference(columns)
+
+
+@pytest.mark.parametrize("dimensions", [1, 3])
+def test_narrow_float_vectors(dimensions):
+    vectors = np.arange(4 * dimensions, dtype=np.float32).reshape(4, dimensions)
+    columns = [("int4", np.arange(4)), ("vector", vectors)]
+    assert bytes(encode_rows(columns)) == _encode_reference(columns)
+
+
+def test_strings_of_mixed_lengths():
+    strings = ["a", "", None, "bc", "d", "éf"]
+    columns = [("varchar", strings), ("int4", np.arange(len(strings)))]
+    assert bytes(encode_rows(columns)) == _encode_reference(columns)
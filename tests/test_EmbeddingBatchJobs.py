@@ -0,0 +1,142 @@
+import os
+import random
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+import EmbeddingBatchJobs
+from EmbeddingBatchJobs import BatchEmbedder, BatchJobState, has_unfinished_batch_jobs
+from EmbeddingManifest import EmbeddingManifest
+from Settings import Settings
+
+DIMENSIONS = 16
+
+Term = namedtuple("Term", ["term_id", "term"])
+
+# Term IDs with gaps, like the rowids of a terms table with some sources excluded:
+TERMS = [Term(term_id, f"concept term {term_id}" + " y" * (term_id % 5)) for term_id in range(1, 400) if term_id % 7]
+
+
+def _create_settings(**overrides) -> Settings:
+    settings = Settings()
+    settings.embedding_batch_size = 25
+    settings.max_text_characters = 1000
+    settings.embedding_max_batch_items = 10
+    settings.batch_max_inputs = 100
+    settings.batch_max_jobs_in_flight = 2
+    settings.batch_poll_seconds = 0.05
+    for key, value in overrides.items():
+        setattr(settings, key, value)
+    return settings
+
+
+def _read_chunks(after_term_id, last_term_id, batch_size=25):
+    terms = [term for term in TERMS
+             if (after_term_id is None or term.term_id > after_term_id) and
+             (last_term_id is None or term.term_id <= last_term_id)]
+    for i in range(0, len(terms), batch_size):
+        yield terms[i:i + batch_size]
+
+
+def _create_embedder(settings: Settings, folder: str) -> BatchEmbedder:
+    manifest = EmbeddingManifest(folder)
+    manifest.open("fingerprint")
+
+    def write_shard(chunk, vectors):
+        file_name = f"Shard_{chunk[0].term_id}_{chunk[-1].term_id}.npz"
+        np.savez(os.path.join(folder, file_name), term_ids=[row.term_id for row in chunk], vectors=vectors)
+        manifest.add_shard(file_name, chunk[0].term_id, chunk[-1].term_id, len(chunk))
+
+    return BatchEmbedder(settings=settings,
+                         folder=os.path.join(folder, "BatchJobs"),
+                         manifest=manifest,
+                         read_chunks=_read_chunks,
+                         write_shard=write_shard)
+
+
+def _check_embeddings(server, folder: str) -> None:
+    manifest = EmbeddingManifest(folder)
+    term_ids = []
+    vectors = []
+    for file_name in manifest.file_names():
+        with np.load(os.path.join(folder, file_name)) as data:
+            term_ids.extend(data["term_ids"].tolist())
+            vectors.append(data["vectors"])
+    # Every term exactly once, in order, with its own vector:
+    assert term_ids == [term.term_id for term in TERMS]
+    expected = np.stack([server.embed(term.term, DIMENSIONS) for term in TERMS])
+    np.testing.assert_allclose(np.concatenate(vectors), expected, atol=1e-6)
+
+
+def _count_batches(batch_folder: str) -> int:
+    return sum(1 for name in os.listdir(batch_folder) if name.startswith("batch_") and name.endswith(".json"))
+
+
+def test_batch_jobs_create_all_embeddings(mock_server, tmp_path):
+    server = mock_server(dimensions=DIMENSIONS, batch_folder=str(tmp_path / "server"))
+    folder = str(tmp_path / "embeddings")
+    os.makedirs(folder)
+    embedder = _create_embedder(_create_settings(), folder)
+    embedder.run()
+    _check_embeddings(server, folder)
+    assert embedder.row_count == len(TERMS)
+    state = BatchJobState(os.path.join(folder, "BatchJobs"))
+    # Jobs are limited to batch_max_inputs texts, and only whole shards go in a job:
+    assert len(state.jobs) == 4
+    assert _count_batches(str(tmp_path / "server")) == len(state.jobs)
+    assert not has_unfinished_batch_jobs(os.path.join(folder, "BatchJobs"))
+
+
+def test_failed_requests_are_retried_in_new_jobs(mock_server, tmp_path):
+    random.seed(2)
+    server = mock_server(dimensions=DIMENSIONS, batch_folder=str(tmp_path / "server"), server_error_rate=0.2)
+    folder = str(tmp_path / "embeddings")
+    os.makedirs(folder)
+    _create_embedder(_create_settings(embedding_max_retries=10), folder).run()
+    _check_embeddings(server, folder)
+    state = BatchJobState(os.path.join(folder, "BatchJobs"))
+    assert server.failure_count > 0
+    assert any(job.attempt > 0 for job in state.jobs)
+
+
+def test_restart_continues_submitted_jobs(mock_server, tmp_path, monkeypatch):
+    # created_at is in whole seconds, so this keeps the jobs in progress for at least half a second:
+    server = mock_server(dimensions=DIMENSIONS, batch_folder=str(tmp_path / "server"), batch_latency=1.5)
+    folder = str(tmp_path / "embeddings")
+    os.makedirs(folder)
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(seconds):
+        raise Interrupted()
+
+    # Stop the first run at its first wait for a job, after the state of the submitted jobs is persisted:
+    with monkeypatch.context() as patch:
+        patch.setattr(EmbeddingBatchJobs.time, "sleep", interrupt)
+        with pytest.raises(Interrupted):
+            _create_embedder(_create_settings(), folder).run()
+    state = BatchJobState(os.path.join(folder, "BatchJobs"))
+    assert [job.status for job in state.jobs] == ["submitted", "submitted", "written", "written"]
+    assert has_unfinished_batch_jobs(os.path.join(folder, "BatchJobs"))
+
+    _create_embedder(_create_settings(), folder).run()
+    _check_embeddings(server, folder)
+    # No job was submitted twice:
+    assert _count_batches(str(tmp_path / "server")) == 4
+
+
+def test_shards_failing_all_retries_are_retried_by_a_rerun(mock_server, tmp_path):
+    server = mock_server(dimensions=DIMENSIONS, batch_folder=str(tmp_path / "server"), server_error_rate=1.0)
+    folder = str(tmp_path / "embeddings")
+    os.makedirs(folder)
+    with pytest.raises(Exception, match="could not be embedded"):
+        _create_embedder(_create_settings(embedding_max_retries=1), folder).run()
+    state = BatchJobState(os.path.join(folder, "BatchJobs"))
+    assert sum(1 for job in state.jobs if job.status == "failed") > 0
+    assert EmbeddingManifest(folder).row_count() == 0
+
+    server.server_error_rate = 0.0
+    _create_embedder(_create_settings(embedding_max_retries=1), folder).run()
+    _check_embeddings(server, folder)
@@ -0,0 +1,63 @@
+import random
+
+import numpy as np
+import pytest
+
+import GenAIApi
+from GenAIApi import get_embedding_vectors, BatchLimits
+
+DIMENSIONS = 16
+
+
+def _texts(count: int):
+    # Texts of different lengths, so packing them shortest first changes their order:
+    return [f"term {i} " + "x" * (i * 7 % 23) for i in range(count)]
+
+
+def _expected(server, texts):
+    return np.stack([server.embed(text, DIMENSIONS) for text in texts])
+
+
+def test_concurrent_requests_return_vectors_in_text_order(mock_server):
+    server = mock_server(dimensions=DIMENSIONS)
+    texts = _texts(100)
+    result = get_embedding_vectors(texts, max_workers=4, batch_limits=BatchLimits(max_items=7))
+    np.testing.assert_allclose(result["embeddings"], _expected(server, texts), atol=1e-6)
+    assert server.request_count == 15
+
+
+def test_rate_limited_and_failed_requests_are_retried(mock_server):
+    random.seed(1)
+    server = mock_server(dimensions=DIMENSIONS, failure_rate=0.2, server_error_rate=0.2)
+    texts = _texts(100)
+    result = get_embedding_vectors(texts, max_workers=4, max_retries=20, batch_limits=BatchLimits(max_items=10))
+    np.testing.assert_allclose(result["embeddings"], _expected(server, texts), atol=1e-6)
+    assert server.failure_count > 0
+    assert server.request_count == 10 + server.failure_count
+
+
+def test_float16_vectors(mock_server):
+    server = mock_server(dimensions=DIMENSIONS)
+    texts = _texts(20)
+    result = get_embedding_vectors(texts, max_workers=2, vector_dtype="float16", encoding_format="float")
+    assert result["embeddings"].dtype == np.float16
+    np.testing.assert_allclose(result["embeddings"], _expected(server, texts), atol=1e-3)
+
+
+def test_workers_stop_after_first_failure(mock_server, monkeypatch):
+    server = mock_server(dimensions=DIMENSIONS)
+    create_embeddings = GenAIApi._create_embeddings
+
+    def fail_on_marker(**kwargs):
+        # Like a request rejected with a 400, which is not retried:
+        if "fail" in kwargs["batch"]:
+            raise ValueError("Request rejected")
+        return create_embeddings(**kwargs)
+
+    monkeypatch.setattr(GenAIApi, "_create_embeddings", fail_on_marker)
+    # The shortest text is in the first batch:
+    texts = ["fail"] + _texts(999)
+    with pytest.raises(ValueError):
+        get_embedding_vectors(texts, max_workers=4, max_retries=0, batch_limits=BatchLimits(max_items=10))
+    # The other workers finish the batches they are sending, but do not take any more:
+    assert server.request_count <= 3